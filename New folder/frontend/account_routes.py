@@ -0,0 +1,156 @@
+"""
+Local account routing index for the account retrieval app
+Maps account_no -> (server_id, external_id, external_id_types) per environment
+in a SQLite file, built from external_id_acct_map@KCA1 through a customer DB.
+Users can enter an account number and the search is routed to its customer DB
+without knowing the server ID. A refresh reads the map rows of the accounts
+changed since the previous refresh (less an overlap) and replaces their routes;
+single lookups that miss are read from the map table and stored.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    environment TEXT NOT NULL,
+    account_no TEXT NOT NULL,
+    server_id INTEGER NOT NULL,
+    external_id TEXT,
+    external_id_types TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (environment, account_no)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    environment TEXT PRIMARY KEY,
+    watermark TEXT,
+    refreshed_at REAL,
+    rows INTEGER
+);
+"""
+
+# The map table lives in the catalog DB and is read through the DB link of customer DB1
+LOOKUP_DB_INDEX = 0
+ROUTE_SQL = "SELECT server_id, external_id_type, external_id FROM external_id_acct_map@KCA1 WHERE account_no = ?"
+# Every current row of the accounts with a row activated since the watermark
+CHANGES_SQL = ("SELECT account_no, server_id, external_id_type, external_id, active_date "
+               "FROM external_id_acct_map@KCA1 WHERE account_no IN "
+               "(SELECT account_no FROM external_id_acct_map@KCA1 WHERE active_date >= ?) ORDER BY account_no")
+
+EPOCH = datetime(1900, 1, 1)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# group_id prefix per external_id_type, as derived in Definitive.sh (TV wins over BB)
+GROUP_PREFIXES = (("51", 1, "TV"), ("61", 3, "BB"))
+
+
+def group_for_route(route):
+    """(group_id, account type) of a route, or (None, None) for types without a SIN group"""
+    for external_id_type, prefix, account_type in GROUP_PREFIXES:
+        if external_id_type in route["external_id_types"]:
+            return int(f"{prefix}{route['server_id'] - 2}"), account_type
+    return None, None
+
+
+class AccountRouteIndex:
+    """Routing index shared by all sessions of the Streamlit process"""
+
+    def __init__(self, db_path, pool, overlap_hours=24, fetch_size=5000):
+        self.pool = pool
+        self.overlap = timedelta(hours=overlap_hours)
+        self.fetch_size = fetch_size
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def lookup(self, environment, account_no):
+        """
+        Route of an account as (route, source); source is "index" or "database"
+        The map table is only read when the account is not indexed yet; route is
+        None when the account is not in the map table either.
+        """
+        account_no = str(account_no).strip()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT server_id, external_id, external_id_types FROM routes WHERE environment = ? AND account_no = ?",
+                (environment, account_no)).fetchone()
+        if row:
+            return {"server_id": row[0], "external_id": row[1], "external_id_types": row[2].split()}, "index"
+
+        with self.pool.connection((environment, LOOKUP_DB_INDEX)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(ROUTE_SQL, [account_no])
+            rows = cursor.fetchall()
+            cursor.close()
+        if not rows or rows[0][0] is None:
+            return None, "database"
+        self._merge(environment, [(account_no,) + tuple(row) for row in rows])
+        return self.lookup(environment, account_no)[0], "database"
+
+    def refresh(self, environment):
+        """Replace the routes of accounts changed since the last refresh, returns the number of rows read"""
+        with self._lock:
+            row = self._conn.execute("SELECT watermark FROM refreshes WHERE environment = ?", (environment,)).fetchone()
+        watermark = datetime.strptime(row[0], TIMESTAMP_FORMAT) if row and row[0] else None
+        since = watermark - self.overlap if watermark else EPOCH
+        count = 0
+        replaced = set()
+        with self.pool.connection((environment, LOOKUP_DB_INDEX)) as conn:
+            cursor = conn.cursor()
+            cursor.execute(CHANGES_SQL, [since])
+            cursor.arraysize = self.fetch_size
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                # An account's rows may span fetches; rows read earlier in this refresh are kept
+                replaced |= self._merge(environment, [r[:4] for r in rows], keep=replaced)
+                active_dates = [r[4] for r in rows if isinstance(r[4], datetime)]
+                if active_dates:
+                    watermark = max([watermark or EPOCH] + active_dates)
+                count += len(rows)
+            cursor.close()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)",
+                (environment, watermark.strftime(TIMESTAMP_FORMAT) if watermark else None, time.time(), count))
+        return count
+
+    def status(self, environment):
+        with self._lock:
+            accounts = self._conn.execute("SELECT COUNT(*) FROM routes WHERE environment = ?",
+                                          (environment,)).fetchone()[0]
+            row = self._conn.execute("SELECT watermark, refreshed_at FROM refreshes WHERE environment = ?",
+                                     (environment,)).fetchone()
+        return {"accounts": accounts, "watermark": row[0] if row else None, "refreshed_at": row[1] if row else None}
+
+    def _merge(self, environment, rows, keep=()):
+        """
+        Store (account_no, server_id, external_id_type, external_id) rows, returns the accounts stored
+        The rows replace an account's route, except for accounts in keep, whose
+        indexed external_id and types are kept and extended.
+        """
+        routes = {}
+        for account_no, server_id, external_id_type, external_id in rows:
+            if server_id is None:
+                continue
+            route = routes.setdefault(str(account_no).strip(),
+                                      [int(server_id), str(external_id or "").strip().strip("'") or None, set()])
+            if external_id_type is not None:
+                route[2].add(str(external_id_type).strip())
+        with self._lock, self._conn:
+            for account_no, (server_id, external_id, types) in routes.items():
+                known = self._conn.execute(
+                    "SELECT external_id, external_id_types FROM routes WHERE environment = ? AND account_no = ?",
+                    (environment, account_no)).fetchone() if account_no in keep else None
+                if known:
+                    external_id = known[0] or external_id
+                    types |= set(known[1].split())
+                self._conn.execute("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?)",
+                                   (environment, account_no, server_id, external_id, " ".join(sorted(types)), time.time()))
+        return set(routes)
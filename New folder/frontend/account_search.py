@@ -0,0 +1,249 @@
+"""
+Account search against the Kenan customer databases
+Builds the filtered account query and runs it against one customer DB or,
+concurrently, against every customer DB of an environment. Results of the
+databases are merged as they answer, de-duplicated on account_no and tagged
+with the server_id they came from. Rows are read with fetchmany() in batches of
+fetch_size; the UI pages through results by account_no (keyset pagination), so
+only one page per database is fetched at a time, and CSV exports are written
+to disk batch by batch.
+"""
+
+import csv
+import logging
+import threading
+import time
+from concurrent.futures import TimeoutError as FuturesTimeout, as_completed
+
+# Customer server IDs 3-8 live in customer DB1-6 (db_config index 0-5)
+SERVER_ID_TO_INDEX = {3: 0, 4: 1, 5: 2, 6: 3, 7: 4, 8: 5}
+
+# external_id_type per account type, as checked by Definitive.sh; types without an
+# entry cannot be searched yet
+ACCOUNT_TYPE_IDS = {"TV": 51, "BB": 61}
+
+# cmf.pay_method codes of the payment types
+PAYMENT_METHODS = {"Postal": 1, "CDC": 2, "RID": 3}
+
+RESULT_COLUMNS = ["account_no", "external_id", "server_id"]
+
+
+def build_search_query(filters, server_id, after=None):
+    """(sql, params) of the account query for one customer DB, one row per account ordered by account_no"""
+    account_type = filters["account_type"]
+    if account_type not in ACCOUNT_TYPE_IDS:
+        raise ValueError(f"No external_id_type configured for account type {account_type}")
+    sql = (
+        "SELECT c.account_no, MIN(m.external_id) FROM cmf c "
+        "JOIN external_id_acct_map@KCA1 m ON m.account_no = c.account_no "
+        "WHERE m.external_id_type = ? AND m.server_id = ? "
+        "AND c.date_active <= ? AND (c.date_inactive IS NULL OR c.date_inactive > ?)"
+    )
+    params = [ACCOUNT_TYPE_IDS[account_type], server_id, filters["active_date"], filters["active_date"]]
+    if filters["payment_type"] != "Any":
+        sql += " AND c.pay_method = ?"
+        params.append(PAYMENT_METHODS[filters["payment_type"]])
+    if filters["in_collection"] == "Yes":
+        sql += " AND c.collection_indicator = 1"
+    elif filters["in_collection"] == "No":
+        sql += " AND (c.collection_indicator IS NULL OR c.collection_indicator = 0)"
+    if filters["open_invoice"] != "Any":
+        sql += (" AND " + ("" if filters["open_invoice"] == "Yes" else "NOT ") +
+                "EXISTS (SELECT 1 FROM cmf_balance b WHERE b.account_no = c.account_no AND b.closed_date IS NULL)")
+    if filters["component_id"]:
+        sql += (" AND EXISTS (SELECT 1 FROM cmf_package_component p WHERE p.parent_account_no = c.account_no "
+                "AND p.component_id = ? AND p.inactive_dt IS NULL)")
+        params.append(filters["component_id"])
+    if filters["account_no"]:
+        sql += " AND c.account_no = ?"
+        params.append(filters["account_no"])
+    if after is not None:
+        sql += " AND c.account_no > ?"
+        params.append(after)
+    return sql + " GROUP BY c.account_no ORDER BY c.account_no", params
+
+
+def fetch_batches(cursor, fetch_size):
+    """Yield lists of up to fetch_size rows until the cursor is exhausted"""
+    cursor.arraysize = fetch_size
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_customer_db(pool, environment, server_id, filters, timeout, fetch_size, after=None, cursors=None):
+    """
+    Yield batches of (account_no, external_id) rows of one customer DB
+    The connection stays checked out while the caller iterates; the query is
+    cancelled after timeout seconds. The open cursor is kept in cursors[server_id]
+    so another thread can cancel it.
+    """
+    sql, params = build_search_query(filters, server_id, after)
+    with pool.connection((environment, SERVER_ID_TO_INDEX[server_id])) as conn:
+        conn.timeout = timeout
+        cursor = conn.cursor()
+        if cursors is not None:
+            cursors[server_id] = cursor
+        try:
+            cursor.execute(sql, params)
+            yield from fetch_batches(cursor, fetch_size)
+        finally:
+            if cursors is not None:
+                cursors.pop(server_id, None)
+            cursor.close()
+            conn.timeout = 0
+
+
+def search_customer_db(pool, environment, server_id, filters, timeout, limit, fetch_size, after=None, cursors=None):
+    """Up to limit rows (account_no, external_id) of one customer DB after account_no after"""
+    rows = []
+    batches = iter_customer_db(pool, environment, server_id, filters, timeout, min(fetch_size, limit), after,
+                               cursors)
+    try:
+        for batch in batches:
+            rows.extend(batch)
+            if len(rows) >= limit:
+                break
+    finally:
+        batches.close()
+    return rows[:limit]
+
+
+def normalize_filters(filters):
+    """Hashable form of the filters; equivalent searches give the same tuple"""
+    return (
+        filters["account_type"].strip().upper(),
+        filters["payment_type"],
+        filters["in_collection"],
+        filters["active_date"].isoformat(),
+        filters["open_invoice"],
+        filters["component_id"].strip(),
+        filters["account_no"].strip(),
+    )
+
+
+def cache_prefix(environment, server_id, filters):
+    """Leading part of the cache keys of a search, shared by all of its pages"""
+    return (environment, server_id, normalize_filters(filters))
+
+
+def search_customer_dbs(pool, executor, environment, server_ids, filters, timeout, limit, fetch_size,
+                        after=None, cache=None, logger=None):
+    """
+    Query customer DBs of an environment concurrently, limit rows each
+    Yields (server_id, rows, error, seconds, cached) as each database answers.
+    Databases found in the cache answer first without a query; databases that
+    have not answered within timeout seconds are reported with an error, and
+    their running queries are cancelled.
+    """
+    logger = logger or logging.getLogger(__name__)
+    started = time.monotonic()
+    hits, futures, cursors = {}, {}, {}
+    for server_id in server_ids:
+        key = cache_prefix(environment, server_id, filters) + (after, limit)
+        rows = cache.get(key) if cache else None
+        if rows is not None:
+            hits[server_id] = rows
+        else:
+            futures[executor.submit(search_customer_db, pool, environment, server_id, filters, timeout, limit,
+                                    fetch_size, after, cursors)] = (server_id, key)
+    for server_id, rows in hits.items():
+        yield server_id, rows, None, time.monotonic() - started, True
+
+    pending = set(futures)
+    try:
+        # Logins and queries are bounded separately, so allow both before giving up
+        for future in as_completed(futures, timeout=timeout + pool.login_timeout + pool.acquire_timeout):
+            pending.discard(future)
+            server_id, key = futures[future]
+            seconds = time.monotonic() - started
+            try:
+                rows = future.result()
+            except Exception as e:
+                logger.error(f"Search failed in {environment} server_id={server_id}: {e}")
+                yield server_id, [], str(e), seconds, False
+                continue
+            if cache:
+                cache.put(key, rows)
+            yield server_id, rows, None, seconds, False
+    except FuturesTimeout:
+        for future in pending:
+            server_id, _ = futures[future]
+            if future.cancel():
+                state = "never started"
+            else:
+                # A running search only stops when its statement is cancelled on the server
+                cursor = cursors.get(server_id)
+                state = "still connecting"
+                if cursor is not None:
+                    try:
+                        cursor.cancel()
+                        state = "query cancelled"
+                    except Exception as e:
+                        state = f"cancel failed: {e}"
+            logger.error(f"Search timed out in {environment} server_id={server_id} ({state})")
+            yield server_id, [], f"No answer within {timeout}s ({state})", time.monotonic() - started, False
+
+
+def export_csv(pool, executor, environment, server_ids, filters, path, timeout, fetch_size, logger=None):
+    """
+    Write every matching account of the customer DBs to a CSV file
+    Databases are read concurrently and each batch is written as it comes off
+    the cursor, so only one batch of rows per database is held at a time. The
+    account numbers already written are kept to drop duplicates across
+    databases, so that set grows with the export (about 100 bytes per account).
+    Returns (rows written, {server_id: error}).
+    """
+    logger = logger or logging.getLogger(__name__)
+    lock = threading.Lock()
+    seen = set()
+    written = [0]
+
+    def export_db(server_id):
+        for batch in iter_customer_db(pool, environment, server_id, filters, timeout, fetch_size):
+            with lock:
+                for account_no, external_id in batch:
+                    key = str(account_no).strip()
+                    if key not in seen:
+                        seen.add(key)
+                        writer.writerow([key, str(external_id or "").strip(), server_id])
+                        written[0] += 1
+
+    errors = {}
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_COLUMNS)
+        futures = {executor.submit(export_db, server_id): server_id for server_id in server_ids}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors[futures[future]] = str(e)
+                logger.error(f"Export failed in {environment} server_id={futures[future]}: {e}")
+    return written[0], errors
+
+
+class MergedResults:
+    """Rows of several customer DBs, one per account_no, tagged with their server_id"""
+
+    def __init__(self):
+        self.rows = []
+        self.duplicates = 0
+        self._seen = set()
+
+    def add(self, server_id, rows):
+        for account_no, external_id in rows:
+            key = str(account_no).strip()
+            if key in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(key)
+            self.rows.append({"account_no": key, "external_id": str(external_id or "").strip(),
+                              "server_id": server_id})
+
+    def page(self, size):
+        """The first size rows in account_no order and whether more rows follow"""
+        rows = sorted(self.rows, key=lambda row: int(row["account_no"]))
+        return rows[:size], len(rows) > size
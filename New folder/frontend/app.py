@@ -1,8 +1,15 @@
 import streamlit as st
 from datetime import date
+import functools
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from db_config import db_config
+from connection_pool import ConnectionPool, VALIDATION_SQL
+from account_search import SERVER_ID_TO_INDEX, ACCOUNT_TYPE_IDS, MergedResults, cache_prefix, export_csv, search_customer_dbs
+from result_cache import ResultCache
+from account_routes import AccountRouteIndex, group_for_route
 
 # Setup logging
 log_dir = "logs"
@@ -15,6 +22,65 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s %(message)s"
 )
 
+# Pooled connections per (environment, customer DB index)
+pool_settings = {
+    "max_size": 4,          # connections per customer DB
+    "idle_timeout": 600,    # seconds before an idle connection is closed
+    "validate_after": 30,   # idle seconds before a connection is re-checked
+    "acquire_timeout": 30,  # seconds to wait when all connections are in use
+    "login_timeout": 15,
+}
+
+# Account searches
+search_settings = {
+    "db_timeout": 60,       # seconds a customer DB query may run
+    "max_workers": 12,      # concurrent customer DB queries across all sessions
+    "page_size": 100,       # accounts shown per page
+    "fetch_size": 500,      # rows per fetchmany() round-trip
+}
+
+# Search results cached per environment, customer DB, filters and page
+cache_settings = {
+    "ttl": 300,             # seconds a cached result is reused
+    "max_entries": 500,     # cached pages across all sessions
+    "max_rows": 200000,     # cached rows across all sessions
+}
+
+# Local account -> customer DB routing index
+route_settings = {
+    "db_path": os.path.join("cache", "account_routes.db"),
+    "overlap_hours": 24,    # hours re-read before the last refresh for late map rows
+    "fetch_size": 5000,     # map rows per fetchmany() round-trip during a refresh
+}
+
+export_dir = "exports"
+
+
+@st.cache_resource
+def get_connection_pool():
+    # Cached per process, so the pool survives reruns and is shared by all sessions
+    return ConnectionPool(db_config, logger=logging.getLogger("account_search"), **pool_settings)
+
+
+@st.cache_resource
+def get_search_executor():
+    return ThreadPoolExecutor(max_workers=search_settings["max_workers"], thread_name_prefix="account-search")
+
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(**cache_settings)
+
+
+@st.cache_resource
+def get_route_index():
+    return AccountRouteIndex(pool=get_connection_pool(), **route_settings)
+
+
+pool = get_connection_pool()
+result_cache = get_result_cache()
+route_index = get_route_index()
+
 
 # Add Invoice button to redirect to Invoicing UI
 st.markdown('<a href="https://accountsui.streamlit.app/" target="_blank"><button style="background-color:#4CAF50;color:white;padding:10px 24px;border:none;border-radius:4px;cursor:pointer;">Invoice</button></a>', unsafe_allow_html=True)
@@ -35,57 +101,188 @@ component_id = st.text_input("Component ID (optional)")
 env_options = list(db_config.keys())
 environment = st.selectbox("Environment", env_options)
 
-customer_server_ids = [3, 4, 5, 6, 7, 8]
-server_id_to_index = {3: 0, 4: 1, 5: 2, 6: 3, 7: 4, 8: 5}
-customer_server_id = st.selectbox("Customer Server ID", customer_server_ids)
+with st.sidebar:
+    st.subheader("Account route index")
+    if st.button("Refresh route index"):
+        with st.spinner(f"Refreshing route index for {environment}..."):
+            started = time.monotonic()
+            try:
+                count = route_index.refresh(environment)
+                logging.info(f"Route index refreshed for {environment}: {count} rows in {time.monotonic() - started:.1f}s")
+                st.success(f"Read {count} account map rows")
+            except Exception as e:
+                st.error(f"Route index refresh failed: {e}")
+                logging.error(f"Route index refresh failed for {environment}: {e}")
+        st.session_state.pop("routes", None)
+    route_status = route_index.status(environment)
+    st.write(f"{route_status['accounts']} accounts indexed for {environment}")
+    if route_status["refreshed_at"]:
+        st.caption(f"Last refresh {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(route_status['refreshed_at']))}, "
+                   f"map rows active up to {route_status['watermark']}")
 
-if st.button("Test Connection"):
-    try:
-        import pyodbc
-        env_conf = db_config[environment]
-        cust_db_index = server_id_to_index[customer_server_id]
-        db_conf = env_conf["customer"][cust_db_index]
-        conn_str = (
-            f"DRIVER={{Oracle in OraClient12Home1}};"
-            f"DBQ={db_conf['host']}:{db_conf['port']}/{db_conf['service_name']};"
-            f"UID={db_conf['user']};PWD={db_conf['password']}"
-        )
-        # Log connection details (excluding password)
-        logging.info(f"Testing connection: env={environment}, DB{cust_db_index+1}, host={db_conf['host']}, port={db_conf['port']}, service={db_conf['service_name']}, user={db_conf['user']}")
-        conn = pyodbc.connect(conn_str)
-        conn.close()
-        st.success(f"Connection to {environment} Customer DB{cust_db_index+1} successful!")
-    except Exception as e:
-        st.error(f"Connection test failed: {e}")
-        logging.error(f"Connection test failed for env={environment}, DB{cust_db_index+1}: {e}")
-
-if st.button("Search"):
-    try:
-        import pyodbc
-        env_conf = db_config[environment]
-        cust_db_index = server_id_to_index[customer_server_id]
-        db_conf = env_conf["customer"][cust_db_index]
-        # Use direct Oracle connection string
-        conn_str = (
-            f"DRIVER={{Oracle in OraClient12Home1}};"
-            f"DBQ={db_conf['host']}:{db_conf['port']}/{db_conf['service_name']};"
-            f"UID={db_conf['user']};PWD={db_conf['password']}"
-        )
-        conn = pyodbc.connect(conn_str)
+account_no = st.text_input("Account No (optional)", help="Routes the search to the customer DB of the account").strip()
+route = None
+if account_no:
+    # Routes are kept per session, so reruns do not look up a missing account again
+    routes = st.session_state.setdefault("routes", {})
+    if (environment, account_no) not in routes:
+        try:
+            routes[(environment, account_no)] = route_index.lookup(environment, account_no)
+            found, source = routes[(environment, account_no)]
+            logging.info(f"Route of account {account_no} in {environment} from {source}: "
+                         + (f"server_id {found['server_id']}" if found else "not found"))
+        except Exception as e:
+            st.error(f"Could not look up the route of account {account_no}: {e}")
+            logging.error(f"Route lookup failed for account {account_no} in {environment}: {e}")
+    route, route_source = routes.get((environment, account_no), (None, None))
+    if route is None and route_source:
+        st.warning(f"Account {account_no} is not in external_id_acct_map of {environment}")
+    elif route and route["server_id"] not in SERVER_ID_TO_INDEX:
+        st.warning(f"Account {account_no} lives on server_id {route['server_id']}, which is not a customer DB")
+        route = None
+    elif route:
+        group_id, route_type = group_for_route(route)
+        st.info(f"Account {account_no}: server_id {route['server_id']} (Customer DB{SERVER_ID_TO_INDEX[route['server_id']]+1}), "
+                f"group_id {group_id if group_id else 'N/A'}{f' ({route_type})' if route_type else ''}, "
+                f"external_id {route['external_id'] or 'N/A'}, external_id_types {', '.join(route['external_id_types']) or 'N/A'} "
+                f"[{'route index' if route_source == 'index' else 'account map'}]")
+
+ALL_CUSTOMER_DBS = "All customer DBs"
+customer_server_ids = list(SERVER_ID_TO_INDEX) + [ALL_CUSTOMER_DBS]
+if route:
+    customer_server_id = st.selectbox("Customer Server ID", customer_server_ids,
+                                      index=customer_server_ids.index(route["server_id"]), disabled=True)
+else:
+    customer_server_id = st.selectbox("Customer Server ID", customer_server_ids)
+search_all = customer_server_id == ALL_CUSTOMER_DBS
+
+filters = {
+    "account_type": account_type,
+    "payment_type": payment_type,
+    "in_collection": in_collection,
+    "active_date": active_date,
+    "open_invoice": open_invoice,
+    "component_id": component_id.strip(),
+    "account_no": account_no,
+}
+filter_text = f"AccountType={account_type}, PaymentType={payment_type}, InCollection={in_collection}, ActiveDate={active_date}, OpenInvoice={open_invoice}, ComponentID={component_id if component_id else 'N/A'}, AccountNo={account_no if account_no else 'N/A'}, CustomerServerID={customer_server_id}"
+
+
+def test_connection(server_id):
+    cust_db_index = SERVER_ID_TO_INDEX[server_id]
+    db_conf = db_config[environment]["customer"][cust_db_index]
+    # Log connection details (excluding password)
+    logging.info(f"Testing connection: env={environment}, DB{cust_db_index+1}, host={db_conf['host']}, port={db_conf['port']}, service={db_conf['service_name']}, user={db_conf['user']}")
+    # Pooled connections are only validated after validate_after idle seconds, so always run the check here;
+    # a connection that fails it is discarded by the pool
+    with pool.connection((environment, cust_db_index)) as conn:
         cursor = conn.cursor()
-        # Build SQL query with optional component_id
-        # sql = f"SELECT account_id FROM accounts WHERE ..."
-        # if component_id:
-        #     sql += f" AND component_id = '{component_id}'"
-        # cursor.execute(sql)
-        # results = [row[0] for row in cursor.fetchall()]
-        st.success(f"Connected to {environment} Customer DB{cust_db_index+1}!")
-        st.write(["AccountID1", "AccountID2"])
-        logging.info(f"Search successful in {environment} Customer DB{cust_db_index+1} for filters: AccountType={account_type}, PaymentType={payment_type}, InCollection={in_collection}, ActiveDate={active_date}, OpenInvoice={open_invoice}, ComponentID={component_id if component_id else 'N/A'}, CustomerServerID={customer_server_id}")
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        st.error(f"DB connection failed: {e}")
-        logging.error(f"DB connection/search failed in {environment} Customer DB{customer_server_id}: {e}")
+        try:
+            cursor.execute(VALIDATION_SQL)
+            cursor.fetchone()
+        finally:
+            cursor.close()
+
+
+if st.button("Test Connection"):
+    server_ids = list(SERVER_ID_TO_INDEX) if search_all else [customer_server_id]
+    futures = {server_id: get_search_executor().submit(test_connection, server_id) for server_id in server_ids}
+    for server_id, future in futures.items():
+        cust_db_index = SERVER_ID_TO_INDEX[server_id]
+        try:
+            future.result()
+            st.success(f"Connection to {environment} Customer DB{cust_db_index+1} successful!")
+        except Exception as e:
+            st.error(f"Connection test failed for Customer DB{cust_db_index+1}: {e}")
+            logging.error(f"Connection test failed for env={environment}, DB{cust_db_index+1}: {e}")
+
+search_key = (environment, customer_server_id, tuple(filters.values()))
+search_server_ids = list(SERVER_ID_TO_INDEX) if search_all else [customer_server_id]
+
+
+def change_page(step):
+    st.session_state.search["page"] += step
+
+
+def read_export(path):
+    """Contents of an export file, read only when the download is clicked"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+col_search, col_refresh, col_export = st.columns(3)
+refresh = col_refresh.button("Refresh", help="Search again without cached results")
+if refresh:
+    for server_id in search_server_ids:
+        result_cache.invalidate(cache_prefix(environment, server_id, filters))
+if col_search.button("Search") or refresh:
+    if account_type not in ACCOUNT_TYPE_IDS:
+        st.error(f"Searching {account_type} accounts is not supported yet")
+    else:
+        # Only the first account_no of each visited page is kept between reruns
+        st.session_state.search = {"key": search_key, "page": 0, "page_starts": [None]}
+
+if col_export.button("Export CSV"):
+    if account_type not in ACCOUNT_TYPE_IDS:
+        st.error(f"Searching {account_type} accounts is not supported yet")
+    else:
+        os.makedirs(export_dir, exist_ok=True)
+        export_path = os.path.join(export_dir, f"accounts_{environment.replace(' ', '_')}_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+        with st.spinner("Exporting accounts..."):
+            started = time.monotonic()
+            count, errors = export_csv(pool, get_search_executor(), environment, search_server_ids, filters, export_path,
+                                       search_settings["db_timeout"], search_settings["fetch_size"],
+                                       logger=logging.getLogger("account_search"))
+        logging.info(f"Exported {count} accounts from {environment} to {export_path} in {time.monotonic() - started:.1f}s for filters: {filter_text}")
+        for server_id, error in errors.items():
+            st.error(f"Customer DB{SERVER_ID_TO_INDEX[server_id]+1} (server_id {server_id}) failed: {error}")
+        st.session_state.export = {"key": search_key, "path": export_path, "count": count}
+
+export = st.session_state.get("export")
+if export and export["key"] == search_key and os.path.exists(export["path"]):
+    st.download_button(f"Download {export['count']} accounts (CSV)", functools.partial(read_export, export["path"]),
+                       file_name=os.path.basename(export["path"]), mime="text/csv", on_click="ignore")
+
+search = st.session_state.get("search")
+if search and search["key"] == search_key:
+    page, page_size = search["page"], search_settings["page_size"]
+    after = search["page_starts"][page]
+    results = MergedResults()
+    # Show each customer DB's rows as soon as it answers
+    progress = st.empty()
+    table = st.empty()
+    answered = []
+    failed = False
+    for server_id, rows, error, seconds, cached in search_customer_dbs(
+            pool, get_search_executor(), environment, search_server_ids, filters, search_settings["db_timeout"],
+            page_size + 1, search_settings["fetch_size"], after=after, cache=result_cache,
+            logger=logging.getLogger("account_search")):
+        results.add(server_id, rows)
+        cust_db_index = SERVER_ID_TO_INDEX[server_id]
+        if error:
+            failed = True
+            answered.append(f"Customer DB{cust_db_index+1} (server_id {server_id}): failed - {error}")
+            logging.error(f"DB connection/search failed in {environment} Customer DB{cust_db_index+1}: {error}")
+        else:
+            source = "cached" if cached else f"{seconds:.1f}s"
+            answered.append(f"Customer DB{cust_db_index+1} (server_id {server_id}): {len(rows)} rows ({source})")
+            logging.info(f"Search successful in {environment} Customer DB{cust_db_index+1} ({len(rows)} rows, page {page+1}, {source}) for filters: {filter_text}")
+        if search_all:
+            progress.info(f"{len(answered)} of {len(search_server_ids)} customer DBs answered\n\n" + "\n\n".join(answered))
+        table.dataframe(results.page(page_size)[0], width="stretch")
 
+    rows, has_next = results.page(page_size)
+    stats = result_cache.stats()
+    logging.info(f"Result cache: hits={stats['hits']}, misses={stats['misses']}, evictions={stats['evictions']}, entries={stats['entries']}, rows={stats['rows']}, hit_rate={stats['hit_rate']}")
+    if has_next and len(search["page_starts"]) == page + 1:
+        search["page_starts"].append(int(rows[-1]["account_no"]))
+    if failed and not search_all:
+        progress.error(answered[0])
         st.warning("Could not retrieve data. Please check your connection or try a different environment.")
+    else:
+        first = page * page_size + 1 if rows else 0
+        st.success(f"Accounts {first}-{page * page_size + len(rows)} in {environment}" + (" (more available)" if has_next else ""))
+    col_prev, col_page, col_next = st.columns(3)
+    col_prev.button("Previous page", disabled=page == 0, on_click=change_page, args=(-1,))
+    col_page.write(f"Page {page + 1}")
+    col_next.button("Next page", disabled=not has_next, on_click=change_page, args=(1,))
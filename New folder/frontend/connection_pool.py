@@ -0,0 +1,181 @@
+"""
+Process-wide pool of customer DB connections
+Streamlit reruns app.py on every interaction, so connections opened in the
+button handlers were thrown away after each click and every search paid for a
+new ODBC login. The pool is created once per process (st.cache_resource) and
+keeps connections keyed by (environment, customer DB index) between reruns.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+ODBC_DRIVER = "Oracle in OraClient12Home1"
+VALIDATION_SQL = "SELECT 1 FROM dual"
+
+
+class PoolExhausted(Exception):
+    """Raised when a database already has max_size connections checked out"""
+
+
+def connection_string(db_conf):
+    return (
+        f"DRIVER={{{ODBC_DRIVER}}};"
+        f"DBQ={db_conf['host']}:{db_conf['port']}/{db_conf['service_name']};"
+        f"UID={db_conf['user']};PWD={db_conf['password']}"
+    )
+
+
+class ConnectionPool:
+    """
+    Connections keyed by (environment, customer DB index)
+    At most max_size connections (idle and checked out) exist per database.
+    An idle connection is validated with a cheap query before it is handed out
+    if it has not been used for validate_after seconds, and it is closed once
+    idle for idle_timeout seconds.
+    """
+
+    def __init__(self, db_config, max_size=4, idle_timeout=600, validate_after=30,
+                 acquire_timeout=30, login_timeout=15, logger=None):
+        self.db_config = db_config
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.validate_after = validate_after
+        self.acquire_timeout = acquire_timeout
+        self.login_timeout = login_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self._idle = {}
+        self._open = {}
+        self._cond = threading.Condition()
+        self._reaper = threading.Thread(target=self._reap, name="db-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def connect(self, key):
+        """Open a new connection for (environment, customer DB index)"""
+        import pyodbc
+        environment, cust_db_index = key
+        db_conf = self.db_config[environment]["customer"][cust_db_index]
+        started = time.monotonic()
+        conn = pyodbc.connect(connection_string(db_conf), timeout=self.login_timeout)
+        self.logger.info(f"Opened pooled connection: env={environment}, DB{cust_db_index+1}, "
+                         f"host={db_conf['host']}, service={db_conf['service_name']}, "
+                         f"login={time.monotonic() - started:.2f}s")
+        return conn
+
+    def acquire(self, key):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                while True:
+                    idle = self._idle.get(key)
+                    if idle:
+                        conn, last_used = idle.pop()
+                        break
+                    if self._open.get(key, 0) < self.max_size:
+                        self._open[key] = self._open.get(key, 0) + 1
+                        conn = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted(f"All {self.max_size} connections to {key[0]} "
+                                            f"DB{key[1]+1} are in use")
+                    self._cond.wait(remaining)
+            if conn is None:
+                try:
+                    return self.connect(key)
+                except Exception:
+                    self._forget(key)
+                    raise
+            if time.monotonic() - last_used < self.validate_after or self._valid(conn):
+                return conn
+            self.logger.info(f"Discarding stale pooled connection: env={key[0]}, DB{key[1]+1}")
+            self._close(conn)
+            self._forget(key)
+
+    def release(self, key, conn, discard=False):
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard:
+            self._close(conn)
+            self._forget(key)
+            return
+        with self._cond:
+            self._idle.setdefault(key, []).append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, key):
+        conn = self.acquire(key)
+        try:
+            yield conn
+        except GeneratorExit:
+            # A generator reading from the connection was closed early; the connection is still usable
+            self.release(key, conn)
+            raise
+        except BaseException:
+            self.release(key, conn, discard=True)
+            raise
+        self.release(key, conn)
+
+    def stats(self):
+        """Open and idle connection counts per database"""
+        with self._cond:
+            return {f"{key[0]}/DB{key[1]+1}": {"open": count, "idle": len(self._idle.get(key, []))}
+                    for key, count in self._open.items() if count}
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, {}
+            for key, conns in idle.items():
+                self._open[key] -= len(conns)
+        for conns in idle.values():
+            for conn, _ in conns:
+                self._close(conn)
+
+    def evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            for key, conns in self._idle.items():
+                stale = [conn for conn, last_used in conns if now - last_used > self.idle_timeout]
+                if stale:
+                    self._idle[key] = [(c, t) for c, t in conns if now - t <= self.idle_timeout]
+                    self._open[key] -= len(stale)
+                    expired.extend((key, conn) for conn in stale)
+            if expired:
+                self._cond.notify_all()
+        for key, conn in expired:
+            self.logger.info(f"Closing idle pooled connection: env={key[0]}, DB{key[1]+1}")
+            self._close(conn)
+
+    def _forget(self, key):
+        with self._cond:
+            self._open[key] -= 1
+            self._cond.notify()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            self.evict_idle()
+
+    @staticmethod
+    def _valid(conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(VALIDATION_SQL)
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
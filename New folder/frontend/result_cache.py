@@ -0,0 +1,76 @@
+"""
+In-process cache of account search results
+Entries expire after ttl seconds. The least recently used entries are evicted
+once the cache holds more than max_entries results or max_rows rows in total.
+The cache is shared by all sessions of the Streamlit process, so it is guarded
+by a lock; hits, misses and evictions are counted for the search log.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """TTL + LRU cache of row lists keyed by tuples"""
+
+    def __init__(self, ttl=300, max_entries=500, max_rows=200000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Cached rows for key, or None when missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, rows):
+        rows = list(rows)
+        if len(rows) > self.max_rows:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), rows)
+            self._rows += len(rows)
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, prefix):
+        """Drop every entry whose key starts with the prefix tuple, returns how many were dropped"""
+        with self._lock:
+            keys = [key for key in self._entries if key[:len(prefix)] == prefix]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "rows": self._rows,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+    def _remove(self, key):
+        _, rows = self._entries.pop(key)
+        self._rows -= len(rows)
@@ -33,7 +33,12 @@ echolog() {
   echo "$(date '+%Y-%m-%d %H:%M:%S') $*" >> "$LOG_FILE"
 }
 
-read -p "Enter the Account no to run Definitive: " account_no
+# Account no can be passed as the first argument (non-interactive) or entered at the prompt
+if [ -n "$1" ]; then
+  account_no="$1"
+else
+  read -p "Enter the Account no to run Definitive: " account_no
+fi
 
 # Get DB credentials using GetConfVal.sh
 conf_name_input="ARBCUST_6"
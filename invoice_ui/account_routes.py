@@ -0,0 +1,219 @@
+"""
+Local routing index built from external_id_acct_map
+Every Definitive run starts by reading server_id, external_id_type and
+external_id of the account from external_id_acct_map@KCA1. AccountRouteIndex
+keeps account_no -> (server_id, external_id, external_id_types) per environment
+in a SQLite file, so runs can pick the customer database and group_id without
+the link-table lookup. A refresh reads the map rows of the accounts changed
+since the previous refresh (less an overlap for late inserts) and replaces their
+routes; accounts missing from the index are added when a run looks them up.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    environment TEXT NOT NULL,
+    account_no TEXT NOT NULL,
+    server_id INTEGER NOT NULL,
+    external_id TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (environment, account_no)
+);
+CREATE TABLE IF NOT EXISTS route_types (
+    environment TEXT NOT NULL,
+    account_no TEXT NOT NULL,
+    external_id_type TEXT NOT NULL,
+    PRIMARY KEY (environment, account_no, external_id_type)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    environment TEXT PRIMARY KEY,
+    watermark TEXT,
+    refreshed_at REAL,
+    rows INTEGER
+);
+"""
+
+# Watermark of an environment that was never refreshed: the first refresh reads the whole map
+EPOCH = datetime(1900, 1, 1)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# SQLite limits the number of bind variables per statement
+LOOKUP_CHUNK = 500
+
+
+def as_datetime(value):
+    """active_date as a datetime; Oracle returns datetimes, the SQLite stand-in text"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value)[:19], TIMESTAMP_FORMAT if len(str(value)) > 10 else '%Y-%m-%d')
+
+
+class AccountRouteIndex:
+    """Thread-safe access to the routing index database"""
+
+    def __init__(self, db_path, overlap_hours=24):
+        self.db_path = db_path
+        self.overlap = timedelta(hours=overlap_hours)
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+
+    def lookup(self, environment, account_no):
+        """Route of one account, or None when it is not indexed"""
+        return self.lookup_many(environment, [account_no]).get(str(account_no).strip())
+
+    def lookup_many(self, environment, accounts):
+        """{account_no: {'server_id', 'external_id', 'external_id_types'}} for the indexed accounts"""
+        accounts = [str(account_no).strip() for account_no in accounts]
+        routes = {}
+        with self._lock:
+            for start in range(0, len(accounts), LOOKUP_CHUNK):
+                chunk = accounts[start:start + LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    "SELECT r.account_no, r.server_id, r.external_id, GROUP_CONCAT(t.external_id_type, ' ') "
+                    "FROM routes r LEFT JOIN route_types t "
+                    "ON t.environment = r.environment AND t.account_no = r.account_no "
+                    f"WHERE r.environment = ? AND r.account_no IN ({', '.join('?' * len(chunk))}) "
+                    "GROUP BY r.account_no, r.server_id, r.external_id", [environment] + chunk).fetchall()
+                for account_no, server_id, external_id, types in rows:
+                    routes[account_no] = {'server_id': server_id, 'external_id': external_id,
+                                          'external_id_types': sorted((types or '').split())}
+        return routes
+
+    def record(self, environment, rows):
+        """
+        Store accounts read from external_id_acct_map by a run
+        rows are (account_no, server_id, external_id_type, external_id); the routes
+        of these accounts are replaced, since the live lookup is authoritative.
+        """
+        with self._lock, self._conn:
+            self._delete(environment, {str(row[0]).strip() for row in rows})
+            self._apply(environment, rows)
+
+    def forget(self, environment, account_no):
+        """Drop an account whose indexed route turned out to be wrong"""
+        with self._lock, self._conn:
+            self._delete(environment, [str(account_no).strip()])
+
+    def refresh(self, environment, fetch_changes):
+        """
+        Replace the routes of accounts changed since the last refresh, returns the number of rows read
+        fetch_changes(since) yields batches of (account_no, server_id, external_id_type,
+        external_id, active_date) rows: every current map row of each account that has
+        a row with active_date >= since. An account's rows may span batches.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT watermark FROM refreshes WHERE environment = ?",
+                                     (environment,)).fetchone()
+        watermark = as_datetime(row[0]) if row and row[0] else None
+        since = watermark - self.overlap if watermark else EPOCH
+        count = 0
+        replaced = set()
+        for batch in fetch_changes(since):
+            accounts = {str(r[0]).strip() for r in batch}
+            with self._lock, self._conn:
+                # Rows read earlier in this refresh are part of the new route, so each account is cleared once
+                self._delete(environment, accounts - replaced)
+                self._apply(environment, [r[:4] for r in batch])
+            replaced |= accounts
+            for r in batch:
+                if r[4] is not None:
+                    active = as_datetime(r[4])
+                    watermark = active if watermark is None or active > watermark else watermark
+            count += len(batch)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO refreshes (environment, watermark, refreshed_at, rows) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (environment) DO UPDATE SET watermark = excluded.watermark, "
+                "refreshed_at = excluded.refreshed_at, rows = excluded.rows",
+                (environment, watermark.strftime(TIMESTAMP_FORMAT) if watermark else None, time.time(), count))
+        return count
+
+    def status(self):
+        """Indexed accounts and last refresh per environment"""
+        with self._lock:
+            counts = dict(self._conn.execute(
+                "SELECT environment, COUNT(*) FROM routes GROUP BY environment").fetchall())
+            refreshes = self._conn.execute(
+                "SELECT environment, watermark, refreshed_at, rows FROM refreshes").fetchall()
+        status = {environment: {'accounts': count} for environment, count in counts.items()}
+        for environment, watermark, refreshed_at, rows in refreshes:
+            status.setdefault(environment, {'accounts': 0}).update(
+                watermark=watermark, refreshed_at=refreshed_at, last_refresh_rows=rows)
+        return status
+
+    def _delete(self, environment, accounts):
+        """Drop the routes of accounts; the caller holds the lock and the transaction"""
+        for table in ('route_types', 'routes'):
+            self._conn.executemany(f"DELETE FROM {table} WHERE environment = ? AND account_no = ?",
+                                   [(environment, account_no) for account_no in accounts])
+
+    def _apply(self, environment, rows):
+        """Merge map rows into the index; the caller holds the lock and the transaction"""
+        now = time.time()
+        routes, types = {}, set()
+        for account_no, server_id, external_id_type, external_id in rows:
+            if server_id is None:
+                continue
+            account_no = str(account_no).strip()
+            routes.setdefault(account_no, (int(server_id), str(external_id or '').strip().strip("'") or None))
+            if external_id_type is not None:
+                types.add((environment, account_no, str(external_id_type).strip()))
+        self._conn.executemany(
+            "INSERT INTO routes (environment, account_no, server_id, external_id, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (environment, account_no) DO UPDATE SET "
+            "server_id = excluded.server_id, external_id = COALESCE(routes.external_id, excluded.external_id), "
+            "updated_at = excluded.updated_at",
+            [(environment, account_no, server_id, external_id, now)
+             for account_no, (server_id, external_id) in routes.items()])
+        self._conn.executemany("INSERT OR IGNORE INTO route_types VALUES (?, ?, ?)", sorted(types))
+
+
+class RouteIndexRefresher:
+    """
+    Refreshes the routing index of every environment on an interval
+    refresh_environment(env_key, env_config) is called for each environment that
+    get_environments() returns and that has databases configured.
+    """
+
+    def __init__(self, refresh_environment, get_environments, interval=900, logger=None):
+        self.refresh_environment = refresh_environment
+        self.get_environments = get_environments
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='route-refresher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            for env_key, env_config in list(self.get_environments().items()):
+                if self._stop.is_set():
+                    return
+                if not env_config.get('databases'):
+                    continue
+                started = time.monotonic()
+                try:
+                    rows = self.refresh_environment(env_key, env_config)
+                    self.logger.info(f"Route index refreshed for {env_key}: {rows} rows "
+                                     f"in {time.monotonic() - started:.1f}s")
+                except Exception as e:
+                    self.logger.warning(f"Route index refresh failed for {env_key}: {e}")
+            self._stop.wait(self.interval)
@@ -4,17 +4,39 @@ Flask Web Application for Multi-Environment Invoice Generation
 Supports Proforma and Definitive invoices across IT, ST, System Test, and UAT environments
 """
 
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for
+from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, Response, send_file
 import subprocess
 import os
 import glob
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
+import csv
 import paramiko
 from io import StringIO
+from urllib.parse import urlencode
 import re
+import shlex
+import time
+import threading
 import logging
 from logging.handlers import RotatingFileHandler
+from jobs import Job, JobManager, JobQueueFull, RunRegistry, IdempotencyConflict
+from ssh_pool import SSHConnectionPool
+from channel_reader import OutputBuffer, read_channel_output, wait_for_prompt
+from invoice_index import InvoiceIndexRegistry
+from sftp_download import SFTPDownloader
+import log_reader
+from run_logs import RunLogManager
+from metrics import MetricsRegistry, log_event, timed_phase
+from script_events import ScriptOutputParser, describe_event
+from health_probe import HealthProber, EnvironmentBusy, STATUS_OK, STATUS_ERROR, STATUS_BUSY
+from definitive_pipeline import (DatabasePool, DefinitivePipeline, SSHCommandRunner, StageFailed, LOOKUP_DB_INDEX,
+                                 SERVER_DB_INDEX, connect_database, get_dialect, group_for_account_types)
+from account_routes import AccountRouteIndex, RouteIndexRefresher
+from batch_poller import BatchStatusPoller
+from definitive_batch import DefinitiveBatch, summarize_outcomes
+from run_history import (RunHistory, FILTER_COLUMNS, STATUS_SUCCEEDED, STATUS_FAILED, STATUS_REJECTED,
+                         STATUS_COALESCED)
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
@@ -22,6 +44,10 @@ app.secret_key = 'your-secret-key-change-this-in-production'
 # Configuration
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.json')
 LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs')
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+TEMP_DIR = os.path.join(os.path.dirname(__file__), 'temp')
+HISTORY_DB = os.path.join(LOG_DIR, 'run_history.db')
+ROUTES_DB = os.path.join(CACHE_DIR, 'account_routes.db')
 
 # Create logs directory if it doesn't exist
 if not os.path.exists(LOG_DIR):
@@ -37,61 +63,13 @@ if not os.path.exists(CONFIG_FILE):
     else:
         print(f"ERROR: {CONFIG_FILE} not found. Please create it from config_template.json")
 
-def get_next_log_sequence():
-    """Get next sequence number for log file"""
-    today = datetime.now().strftime('%Y%m%d')
-    pattern = os.path.join(LOG_DIR, f'invoice_{today}*.log')
-    existing_logs = glob.glob(pattern)
-    
-    if not existing_logs:
-        return 1
-    
-    # Extract sequence numbers
-    sequences = []
-    for log_file in existing_logs:
-        basename = os.path.basename(log_file)
-        # Extract sequence from invoice_YYYYMMDDHHMMSS_XXXXX.log
-        match = re.search(r'_(\d{5})\.log$', basename)
-        if match:
-            sequences.append(int(match.group(1)))
-    
-    return max(sequences) + 1 if sequences else 1
-
 def setup_invoice_logger():
-    """Create a new logger for each invoice generation run"""
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    sequence = get_next_log_sequence()
-    log_filename = f'invoice_{timestamp}_{sequence:05d}.log'
-    log_path = os.path.join(LOG_DIR, log_filename)
-    
-    # Create logger
-    logger = logging.getLogger(log_filename)
-    logger.setLevel(logging.DEBUG)
-    logger.propagate = False
-    
-    # Clear any existing handlers
-    logger.handlers = []
-    
-    # File handler
-    file_handler = logging.FileHandler(log_path, encoding='utf-8')
-    file_handler.setLevel(logging.DEBUG)
-    
-    # Console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    
-    # Formatter
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-    
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
-    return logger, log_path
+    """Create the logger and log file for an invoice generation run"""
+    return RUN_LOGS.open_run()
+
+def close_invoice_logger(logger):
+    """Release a run logger once its run has finished"""
+    RUN_LOGS.close_run(logger)
 
 # Environment server configurations
 ENVIRONMENTS = {
@@ -153,24 +131,197 @@ ENVIRONMENTS = {
     }
 }
 
+# Application settings (overridable from the top-level sections of config.json)
+APP_SETTINGS = {
+    'jobs': {
+        'max_workers': 4,
+        'max_pending': 50,
+        'retention_seconds': 3600,
+        'max_output_lines': 5000
+    },
+    'ssh_pool': {
+        'max_size': 2,
+        'idle_timeout': 300,
+        'keepalive_interval': 30,
+        'acquire_timeout': 30,
+        'health_check_after': 60
+    },
+    'output': {
+        'script_timeout': 600,
+        'prompt_timeout': 60,
+        'chunk_size': 32768,
+        'spill_threshold': 1048576,
+        'max_bytes': 52428800,
+        'response_bytes': 1048576
+    },
+    'downloads': {
+        'block_size': 32768,
+        'max_concurrent_requests': 64,
+        'verify_checksum': True,
+        'max_cache_bytes': 1073741824
+    },
+    'log_viewer': {
+        'page_bytes': 262144,
+        'max_page_bytes': 4194304,
+        'tail_lines': 200,
+        'max_search_matches': 500,
+        'follow_interval': 1,
+        'follow_idle_timeout': 300
+    },
+    'history': {
+        'page_size': 25
+    },
+    'run_logs': {
+        'queue_size': 10000,
+        'put_timeout': 1.0
+    },
+    'coalescing': {
+        'idempotency_ttl': 600,
+        'wait_timeout': 900
+    },
+    'health': {
+        'enabled': True,
+        'interval': 60,
+        'jitter': 0.2,
+        'max_backoff': 600
+    },
+    'batch': {
+        'default_limit': 1,
+        'limits': {},
+        'max_rows': 500
+    },
+    'pipeline': {
+        'arborbin': '/appl_sw/kenan_sw/KFX4.0-1/bin',
+        'starter': '/appl_sw/custbill/BIN/STARTER',
+        'text_file_script': '/appl_sw/custbill/BIN/Testing/text_file.sh',
+        'merger_dir': '/appl_sw/custbill/LOG/FATTURAZIONE/MERGER/DEFINITIVO',
+        'command_timeout': 600,
+        'batch_timeout': 7200
+    },
+    'batch_poller': {
+        'min_interval': 2,
+        'max_interval': 60,
+        'backoff': 1.5
+    },
+    'db_pool': {
+        'max_idle': 2,
+        'idle_timeout': 300,
+        'validate_after': 60,
+        'max_size': 8,
+        'acquire_timeout': 60
+    },
+    'routing': {
+        'enabled': True,
+        'refresh_interval': 900,
+        'overlap_hours': 24
+    },
+    'server': {
+        'host': '0.0.0.0',
+        'port': 5000,
+        'threads': 16,
+        'connection_limit': 200,
+        'channel_timeout': 120,
+        'drain_timeout': 900
+    }
+}
+
+# Serializes config reloads and shutdown, which replace the shared singletons below
+CONFIG_LOCK = threading.Lock()
+
 def load_config():
-    """Load configuration from config.json and update ENVIRONMENTS"""
-    global ENVIRONMENTS
-    try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-            
-            # Load environment configs from config file
-            if 'environments' in config:
-                for env_key, env_data in config['environments'].items():
-                    if env_key in ENVIRONMENTS:
-                        ENVIRONMENTS[env_key].update(env_data)
-                print(f"Configuration loaded from {CONFIG_FILE}")
-        else:
-            print(f"Warning: {CONFIG_FILE} not found. Using default configuration.")
-    except Exception as e:
-        print(f"Error loading config: {str(e)}")
+    """Load configuration from config.json and update ENVIRONMENTS and APP_SETTINGS"""
+    global ENVIRONMENTS, JOB_MANAGER, SSH_POOL, DOWNLOADER, RUN_LOGS, HEALTH_PROBER, RUN_REGISTRY, DB_POOL
+    global BATCH_POLLER, ROUTE_REFRESHER
+    with CONFIG_LOCK:
+        try:
+            if os.path.exists(CONFIG_FILE):
+                with open(CONFIG_FILE, 'r') as f:
+                    config = json.load(f)
+                
+                # Load environment configs from config file
+                if 'environments' in config:
+                    for env_key, env_data in config['environments'].items():
+                        if env_key in ENVIRONMENTS:
+                            # Replaced, not updated in place, so runs holding the old config see a consistent one
+                            ENVIRONMENTS[env_key] = {**ENVIRONMENTS[env_key], **env_data}
+                    print(f"Configuration loaded from {CONFIG_FILE}")
+                
+                # Load application settings sections
+                for section, defaults in APP_SETTINGS.items():
+                    if isinstance(config.get(section), dict):
+                        defaults.update(config[section])
+                
+                JOB_MANAGER = JobManager(**APP_SETTINGS['jobs'])
+                RUN_REGISTRY = RunRegistry(APP_SETTINGS['coalescing']['idempotency_ttl'])
+                SSH_POOL.close_all()
+                SSH_POOL = SSHConnectionPool(create_ssh_client, **APP_SETTINGS['ssh_pool'])
+                DOWNLOADER = SFTPDownloader(CACHE_DIR, **APP_SETTINGS['downloads'])
+                RUN_LOGS.stop()
+                RUN_LOGS = RunLogManager(LOG_DIR, **APP_SETTINGS['run_logs'])
+                HEALTH_PROBER.stop()
+                HEALTH_PROBER = create_health_prober()
+                DB_POOL.close_all()
+                DB_POOL = DatabasePool(connect_pipeline_db, **APP_SETTINGS['db_pool'])
+                BATCH_POLLER.stop()
+                BATCH_POLLER = create_batch_poller()
+                ROUTE_INDEX.overlap = timedelta(hours=APP_SETTINGS['routing']['overlap_hours'])
+                ROUTE_REFRESHER.stop()
+                ROUTE_REFRESHER = create_route_refresher()
+            else:
+                print(f"Warning: {CONFIG_FILE} not found. Using default configuration.")
+        except Exception as e:
+            print(f"Error loading config: {str(e)}")
+
+# Per-run log files, written by a background thread
+RUN_LOGS = RunLogManager(LOG_DIR, **APP_SETTINGS['run_logs'])
+
+# Pooled database connections for the python Definitive backend
+def connect_pipeline_db(key):
+    """Open a connection for an (environment, database index) pool key"""
+    environment, db_index = key
+    return connect_database(ENVIRONMENTS[environment].get('databases', {}), db_index)
+
+DB_POOL = DatabasePool(connect_pipeline_db, **APP_SETTINGS['db_pool'])
+
+def create_batch_poller():
+    """Shared ESTUNI/MERGER status poller for python backend runs"""
+    return BatchStatusPoller(DB_POOL, lambda key: get_dialect(ENVIRONMENTS[key[0]].get('databases', {})),
+                             **APP_SETTINGS['batch_poller'])
+
+BATCH_POLLER = create_batch_poller()
+
+# Local account_no -> server_id/external_id index, refreshed from external_id_acct_map
+ROUTE_INDEX = AccountRouteIndex(ROUTES_DB, APP_SETTINGS['routing']['overlap_hours'])
+
+def fetch_route_changes(environment, since, batch_size=5000):
+    """Yield batches of external_id_acct_map rows activated since a datetime"""
+    dialect = get_dialect(ENVIRONMENTS[environment].get('databases', {}))
+    with DB_POOL.connection((environment, LOOKUP_DB_INDEX), dialect) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(dialect.sql('route_changes'), {'since': dialect.timestamp_value(since)})
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+def create_route_refresher():
+    """Background refresh of the route index for environments with databases configured"""
+    refresher = RouteIndexRefresher(
+        lambda env_key, env_config: ROUTE_INDEX.refresh(env_key, lambda since: fetch_route_changes(env_key, since)),
+        lambda: ENVIRONMENTS, APP_SETTINGS['routing']['refresh_interval'])
+    return refresher.start() if APP_SETTINGS['routing']['enabled'] else refresher
+
+ROUTE_REFRESHER = create_route_refresher()
+
+# Background worker pool for asynchronous invoice runs
+JOB_MANAGER = JobManager(**APP_SETTINGS['jobs'])
+
+# In-flight runs by (environment, invoice_type, account_no) and idempotency keys
+RUN_REGISTRY = RunRegistry(APP_SETTINGS['coalescing']['idempotency_ttl'])
 
 def create_ssh_client(env_config):
     """Create and return an SSH client connection"""
@@ -202,97 +353,47 @@ def create_ssh_client(env_config):
     except Exception as e:
         return None, f"SSH connection failed: {str(e)}"
 
-def test_connection():
-    """Test SSH connection to an environment using Plink"""
-    try:
-        data = request.get_json()
-        env_key = data.get('environment')
-        if env_key not in ENVIRONMENTS:
-            return jsonify({'success': False, 'message': 'Invalid environment'}), 400
-        env_config = ENVIRONMENTS[env_key]
-        
-        # Use Plink for all environments (supports jump hosts/CyberArk)
-        plink_path = r'C:\Program Files\PuTTY\plink.exe'
-        remote_command = 'echo "Connection successful"'
-        
-        user = env_config.get('user', env_config.get('username', ''))
-        password = env_config.get('password', '')
-        host = env_config.get('host', '')
-        
-        if not user or not host:
-            return jsonify({'success': False, 'message': 'User or host not configured'}), 400
-        
-        # Construct connection string
-        connection_string = f"{user}@{host}"
-        
-        try:
-            # Use plink with password authentication
-            result = subprocess.run(
-                [plink_path, '-ssh', connection_string, '-pw', password, '-batch', remote_command],
-                capture_output=True, text=True, timeout=30
-            )
-            if 'Connection successful' in result.stdout:
-                return jsonify({'success': True, 'message': f'Connection successful to {env_key}!'})
-            else:
-                error_msg = result.stderr if result.stderr else result.stdout
-                return jsonify({'success': False, 'message': f'Connection failed: {error_msg}'}), 500
-        except subprocess.TimeoutExpired:
-            return jsonify({'success': False, 'message': 'Connection timeout'}), 500
-        except Exception as e:
-            return jsonify({'success': False, 'message': f'Plink error: {str(e)}'}), 500
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
-        if env_config.get('key_file') and os.path.exists(env_config['key_file']):
-            key = paramiko.RSAKey.from_private_key_file(env_config['key_file'])
-            client.connect(
-                hostname=env_config['host'],
-                port=env_config['port'],
-                username=env_config['username'],
-                pkey=key,
-                timeout=30
-            )
-        else:
-            client.connect(
-                hostname=env_config['host'],
-                port=env_config['port'],
-                username=env_config['username'],
-                password=env_config['password'],
-                timeout=30
-            )
-        
-        return client, None
-    except Exception as e:
-        return None, f"SSH connection failed: {str(e)}"
+# Shared pool of authenticated SSH connections
+SSH_POOL = SSHConnectionPool(create_ssh_client, **APP_SETTINGS['ssh_pool'])
 
-def extract_external_id_from_output(output):
-    """Extract external_id from script output"""
-    try:
-        # Look for patterns like "external_id=XXXXX" or similar in the output
-        import re
-        
-        # Try common patterns
-        patterns = [
-            r'external_id[:\s=]+([A-Z0-9_]+)',
-            r'External_id[:\s=]+([A-Z0-9_]+)',
-            r'EXTERNAL_ID[:\s=]+([A-Z0-9_]+)',
-            r'external_id found:\s*([A-Z0-9_]+)',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, output, re.IGNORECASE)
-            if match:
-                external_id = match.group(1).strip()
-                if external_id and len(external_id) > 0:
-                    return external_id
-        
-        return None
-    except Exception as e:
-        return None
+# Incremental indexes of remote invoice output directories
+INVOICE_INDEXES = InvoiceIndexRegistry()
 
-def find_latest_invoice_file_remote(ssh_client, output_path, invoice_type, external_id=None, logger=None):
+# Cached SFTP downloads of invoice files
+DOWNLOADER = SFTPDownloader(CACHE_DIR, **APP_SETTINGS['downloads'])
+
+# Run metrics exposed on /metrics
+METRICS = MetricsRegistry()
+PHASE_SECONDS = METRICS.histogram('invoice_phase_duration_seconds',
+                                  'Duration of invoice run phases', ('environment', 'phase'))
+RUNS_TOTAL = METRICS.counter('invoice_runs_total',
+                             'Finished invoice runs by outcome and script exit code',
+                             ('environment', 'invoice_type', 'outcome', 'exit_code'))
+RUNS_IN_FLIGHT = METRICS.gauge('invoice_runs_in_flight', 'Invoice runs currently executing', ('environment',))
+
+def create_health_prober():
+    """Build the background prober from the health settings and start it if enabled"""
+    settings = dict(APP_SETTINGS['health'])
+    enabled = settings.pop('enabled', True)
+    prober = HealthProber(lambda env_key, env_config: check_environment(env_key, env_config),
+                          lambda: ENVIRONMENTS, **settings)
+    return prober.start() if enabled else prober
+
+# Cached connection status of every environment
+HEALTH_PROBER = create_health_prober()
+
+# Index of invoice runs behind /logs; existing log files are imported once
+RUN_HISTORY = RunHistory(HISTORY_DB)
+if RUN_HISTORY.is_new:
+    RUN_HISTORY.backfill(LOG_DIR)
+
+def find_latest_invoice_file_remote(ssh_client, output_path, invoice_type, external_id=None, logger=None,
+                                    environment=None, since=None):
     """
-    Find the most recently created invoice file on remote server
+    Find the most recently created invoice file on remote server, returns (InvoiceFile, message)
     Optionally verify it contains the external_id
+    Uses the incremental SFTP index of output_path, so only changed directories are listed;
+    the entry carries the file's size and mtime, which key the download cache
     Examples:
       Definitive: 20240101_BILR_60784_00001_N.txt (60784 is external_id)
       Proforma: FZ______FN_8_20211001_20260202165856.txt (FZ______FN_8 is external_id)
@@ -301,83 +402,226 @@ def find_latest_invoice_file_remote(ssh_client, output_path, invoice_type, exter
         logger = logging.getLogger(__name__)
     
     try:
-        # Find the most recent .txt file created in the last 10 minutes
-        command = f"find {output_path} -name '*.txt' -type f -mmin -10 -printf '%T@ %p\\n' 2>/dev/null | sort -rn | head -5"
-        logger.debug(f"Find command: {command}")
-        
-        stdin, stdout, stderr = ssh_client.exec_command(command, timeout=10)
-        output_lines = stdout.read().decode().strip().split('\n')
-        
-        logger.debug(f"Find command output: {output_lines}")
-        
-        if not output_lines or output_lines[0] == '':
-            logger.warning("No .txt file found in output directory (searched files created in last 10 minutes)")
-            return None, "No .txt file found in output directory (searched files created in last 10 minutes)"
+        index = INVOICE_INDEXES.get(environment, output_path)
+        with timed_phase(logger, PHASE_SECONDS, 'find_invoice_file', environment=environment):
+            sftp = SSH_POOL.open_sftp(ssh_client)
+            try:
+                changed = index.refresh(sftp)
+            finally:
+                SSH_POOL.close_sftp(ssh_client, sftp)
+        logger.debug(f"Invoice index refreshed: {changed} new/changed files, {index.last_refresh_stats}")
         
-        logger.info(f"Found {len(output_lines)} recent files, checking for external_id match...")
+        # Default to files created in the last 10 minutes
+        if since is None:
+            since = time.time() - 600
         
-        # If external_id provided, find file containing it
         if external_id:
-            for line in output_lines:
-                if ' ' in line:
-                    timestamp, filepath = line.split(' ', 1)
-                    filename = filepath.split('/')[-1]
-                    logger.debug(f"Checking file: {filename}")
-                    
-                    # Check if external_id is in the filename
-                    if external_id in filename:
-                        logger.info(f"Found matching invoice file: {filename}")
-                        return filepath.strip(), None
+            match = index.find(external_id, invoice_type, since=since)
+            if match:
+                logger.info(f"Found matching invoice file: {match.name}")
+                return match, None
             
-            # If we reach here, external_id not found in any recent file
+            # external_id not found in any recent file
+            recent = index.latest(since=since, limit=1)
+            if not recent:
+                logger.warning("No .txt file found in output directory (searched files created in last 10 minutes)")
+                return None, "No .txt file found in output directory (searched files created in last 10 minutes)"
             logger.warning(f"No file found containing external_id '{external_id}'. Using most recent file.")
-            most_recent = output_lines[0].split(' ', 1)[1].strip() if ' ' in output_lines[0] else None
-            return most_recent, f"Warning: Most recent file found but does not contain external_id '{external_id}'. Proceeding with most recent file."
-        else:
-            # No external_id provided, return most recent
-            if ' ' in output_lines[0]:
-                latest_file = output_lines[0].split(' ', 1)[1].strip()
-                logger.info(f"Found most recent file: {latest_file}")
-                return latest_file, None
-            else:
-                logger.error("Could not parse file listing")
-                return None, "Could not parse file listing"
+            return recent[0], f"Warning: Most recent file found but does not contain external_id '{external_id}'. Proceeding with most recent file."
+        
+        # No external_id provided, return most recent
+        match = index.find(invoice_type=invoice_type, since=since)
+        if not match:
+            logger.warning("No .txt file found in output directory (searched files created in last 10 minutes)")
+            return None, "No .txt file found in output directory (searched files created in last 10 minutes)"
+        logger.info(f"Found most recent file: {match.path}")
+        return match, None
             
     except Exception as e:
         logger.error(f"Error finding invoice file: {str(e)}")
         return None, f"Error finding invoice file: {str(e)}"
 
-def download_file_from_server(ssh_client, remote_path, local_path):
-    """Download file from remote server using SFTP"""
-    try:
-        sftp = ssh_client.open_sftp()
-        sftp.get(remote_path, local_path)
-        sftp.close()
-        return True, None
-    except Exception as e:
-        return False, f"Failed to download file: {str(e)}"
-
-def download_file_from_server(ssh_client, remote_path, local_path, logger=None):
-    """Download file from remote server using SFTP"""
+def download_file_from_server(ssh_client, remote_path, local_path, logger=None, environment=None,
+                               size=None, mtime=None):
+    """
+    Download file from remote server using SFTP
+    Goes through the local download cache; pass size and mtime (e.g. from the
+    invoice index) to serve an already fetched file without contacting the server
+    """
     if logger is None:
         logger = logging.getLogger(__name__)
     
+    sftp = None
+    def get_sftp():
+        nonlocal sftp
+        if sftp is None:
+            sftp = SSH_POOL.open_sftp(ssh_client)
+        return sftp
+    
     try:
         logger.info(f"Downloading file via SFTP...")
         logger.debug(f"Remote path: {remote_path}")
         logger.debug(f"Local path: {local_path}")
-        sftp = ssh_client.open_sftp()
-        sftp.get(remote_path, local_path)
-        sftp.close()
+        with timed_phase(logger, PHASE_SECONDS, 'sftp_download', environment=environment) as span:
+            success, error = DOWNLOADER.download(get_sftp, remote_path, local_path, namespace=environment or '',
+                                                 size=size, mtime=mtime, ssh_client=ssh_client, logger=logger)
+            if not success:
+                span['outcome'] = 'error'
+        if not success:
+            logger.error(f"Failed to download file: {error}")
+            return False, f"Failed to download file: {error}"
         logger.info("File downloaded successfully")
         return True, None
     except Exception as e:
         logger.error(f"Failed to download file: {str(e)}")
         return False, f"Failed to download file: {str(e)}"
+    finally:
+        if sftp is not None:
+            SSH_POOL.close_sftp(ssh_client, sftp)
+
+def locate_invoice_file(environment, invoice_type, external_id, ssh_client, logger):
+    """
+    Response fields pointing at the invoice file of a finished run
+    Only a file whose name carries the run's external_id is offered, so a
+    download never hands out another account's invoice.
+    """
+    output_path = ENVIRONMENTS[environment].get('output_path')
+    if not output_path or not external_id or ssh_client is None:
+        return {}
+    invoice, message = find_latest_invoice_file_remote(ssh_client, output_path, invoice_type, external_id,
+                                                       logger, environment)
+    if invoice is None or message:
+        logger.info(f"No invoice file offered for download: {message}")
+        return {}
+    query = urlencode({'environment': environment, 'path': invoice.path})
+    return {'invoice_file': {'name': invoice.name, 'size': invoice.size, 'mtime': invoice.mtime},
+            'download_url': f"/download_invoice?{query}"}
+
+DEFAULT_SCRIPT_PROMPT = r'Enter the Account no'
+
+def get_script_setting(env_config, key, invoice_type, default):
+    """Read a per-script setting that may be a single value or a dict keyed by invoice type"""
+    value = env_config.get(key)
+    if isinstance(value, dict):
+        return value.get(invoice_type, default)
+    return value or default
+
+def start_invoice_script(ssh_client, env_config, invoice_type, script_path, account_no, buffer, logger, on_text=None):
+    """
+    Start the invoice script and hand it the account number
+    exec_mode 'argument' runs the script without a PTY and passes the account number
+    as its first argument. The default 'interactive' mode runs it in a shell and
+    answers the read -p prompt once the configured prompt text appears.
+    """
+    exec_mode = get_script_setting(env_config, 'exec_modes', invoice_type, 'interactive')
+    
+    if exec_mode == 'argument':
+        command = f"bash {shlex.quote(script_path)} {shlex.quote(account_no)}"
+        logger.info(f"Executing command: {command}")
+        channel = ssh_client.get_transport().open_session()
+        channel.exec_command(command)
+        channel.shutdown_write()
+        return channel
+    
+    # Interactive mode; exit the shell with the script status so the channel ends with it
+    command = f"bash {shlex.quote(script_path)}; exit $?"
+    logger.info(f"Executing command: {command}")
+    channel = ssh_client.invoke_shell()
+    channel.send(f"{command}\n")
+    
+    prompt = get_script_setting(env_config, 'script_prompts', invoice_type, DEFAULT_SCRIPT_PROMPT)
+    prompt_timeout = APP_SETTINGS['output']['prompt_timeout']
+    logger.info(f"Waiting for prompt '{prompt}' (timeout: {prompt_timeout} seconds)...")
+    if wait_for_prompt(channel, buffer, prompt, timeout=prompt_timeout,
+                       chunk_size=APP_SETTINGS['output']['chunk_size'], on_text=on_text):
+        logger.info("Prompt received")
+    else:
+        logger.warning("Prompt not seen before timeout, sending customer ID anyway")
+    
+    # Send account number
+    logger.info(f"Sending customer ID: {account_no}")
+    channel.send(f"{account_no}\n")
+    return channel
+
+def handle_script_event(event, environment, logger, job=None):
+    """Log a parsed script event and update job progress and metrics from it"""
+    log_event(logger, 'script', **event.to_dict())
+    if event.type in ('batch_finished', 'batch_failed') and 'duration' in event.data:
+        PHASE_SECONDS.observe(event.data['duration'], environment=environment, phase=event.data['module'].lower())
+    if job:
+        job.update_script_values({k: v for k, v in event.data.items()
+                                  if k not in ('module', 'status', 'message', 'duration')})
+        progress = describe_event(event)
+        if progress:
+            job.set_progress(progress)
+
+def run_script_channel(environment, env_config, invoice_type, script_path, account_no, ssh_client, logger, job,
+                       on_text):
+    """Run the invoice script over an SSH channel, returns (exit_status, output)"""
+    output_settings = APP_SETTINGS['output']
+    buffer = OutputBuffer(output_settings['spill_threshold'], output_settings['max_bytes'])
+    
+    # Includes waiting for the account prompt in interactive mode
+    with timed_phase(logger, PHASE_SECONDS, 'prompt_wait', environment=environment):
+        channel = start_invoice_script(ssh_client, env_config, invoice_type, script_path,
+                                       account_no, buffer, logger, on_text)
+    
+    script_timeout = output_settings['script_timeout']
+    logger.info(f"Waiting for script execution (timeout: {script_timeout} seconds)...")
+    if job:
+        job.set_progress(f"Running {invoice_type} script")
+    
+    # Collect output until the channel reaches EOF or the timeout expires
+    error_note = ""
+    with timed_phase(logger, PHASE_SECONDS, 'script_execution', environment=environment) as span:
+        try:
+            read_channel_output(channel, buffer, timeout=script_timeout,
+                                chunk_size=output_settings['chunk_size'],
+                                on_text=on_text)
+        except Exception as e:
+            logger.warning(f"Timeout or error during output collection: {str(e)}")
+            error_note = f"\n[Timeout or error: {str(e)}]"
+            span['outcome'] = 'timeout'
+    
+    if buffer.spilled:
+        logger.info(f"Script output spilled to disk ({buffer.size} bytes)")
+    # Only the tail goes into the response; job output has already been streamed
+    output = buffer.getvalue(output_settings['response_bytes']) + error_note
+    buffer.close()
+    
+    exit_status = channel.recv_exit_status() if channel.exit_status_ready() else -1
+    channel.close()
+    return exit_status, output
 
+def create_definitive_pipeline(environment, env_config, ssh_client, logger):
+    """Native Definitive pipeline running Kenan commands over ssh_client"""
+    settings = {key: value for key, value in APP_SETTINGS['pipeline'].items()
+                if key not in ('command_timeout', 'batch_timeout')}
+    
+    def on_stage(name, seconds, outcome):
+        PHASE_SECONDS.observe(seconds, environment=environment, phase=f"pipeline_{name}")
+        log_event(logger, 'phase', phase=f"pipeline_{name}", duration=round(seconds, 4),
+                  environment=environment, outcome=outcome)
+    
+    return DefinitivePipeline(DB_POOL, get_dialect(env_config.get('databases', {})),
+                              SSHCommandRunner(ssh_client, APP_SETTINGS['pipeline']['command_timeout']),
+                              waiter=BATCH_POLLER, on_stage=on_stage, logger=logger,
+                              routes=ROUTE_INDEX if APP_SETTINGS['routing']['enabled'] else None, **settings)
 
+def run_definitive_pipeline(environment, env_config, account_no, ssh_client, logger, job, on_text):
+    """Run Definitive with the native python pipeline, returns (exit_status, output)"""
+    pipeline = create_definitive_pipeline(environment, env_config, ssh_client, logger)
+    logger.info(f"Running native Definitive pipeline for account {account_no}")
+    if job:
+        job.set_progress("Running Definitive pipeline")
+    with timed_phase(logger, PHASE_SECONDS, 'script_execution', environment=environment) as span:
+        exit_status, output, _ = pipeline.run(environment, account_no, on_text=on_text,
+                                              timeout=APP_SETTINGS['output']['script_timeout'])
+        if exit_status != 0:
+            span['outcome'] = 'error'
+    return exit_status, output
 
-def run_remote_invoice_script(environment, invoice_type, account_no, logger=None):
+def run_remote_invoice_script(environment, invoice_type, account_no, logger=None, job=None):
     """Execute invoice script on remote server via SSH"""
     if logger is None:
         logger = logging.getLogger(__name__)
@@ -393,15 +637,24 @@ def run_remote_invoice_script(environment, invoice_type, account_no, logger=None
             logger.error(f"Server host not configured for {environment}")
             return False, "", f"Server host not configured for {environment}", None
         
-        # Get script path
+        # Get script path; the python backend runs Definitive without the script
+        backend = get_script_setting(env_config, 'backends', invoice_type, 'script')
         script_path = env_config['script_paths'].get(invoice_type)
-        if not script_path:
+        if backend == 'python' and invoice_type != 'Definitive':
+            logger.error(f"The python backend does not support {invoice_type} invoices")
+            return False, "", f"The python backend does not support {invoice_type} invoices", None
+        if backend != 'python' and not script_path:
             logger.error(f"Script path not configured for {invoice_type}")
             return False, "", f"Script path not configured for {invoice_type}", None
         
-        # Create SSH connection
+        # Borrow SSH connection from the pool
+        if job:
+            job.set_progress(f"Connecting to {environment}")
         logger.info(f"Connecting to {env_config['host']}:{env_config.get('port', 22)}...")
-        ssh_client, error = create_ssh_client(env_config)
+        with timed_phase(logger, PHASE_SECONDS, 'ssh_connect', environment=environment) as span:
+            ssh_client, error = SSH_POOL.acquire(environment, env_config, logger)
+            if error:
+                span['outcome'] = 'error'
         if error:
             logger.error(f"SSH connection failed: {error}")
             return False, "", error, None
@@ -409,47 +662,22 @@ def run_remote_invoice_script(environment, invoice_type, account_no, logger=None
         logger.info("SSH connection established successfully")
         
         try:
-            # Execute script with account_no as input
-            command = f"bash {script_path}"
-            logger.info(f"Executing command: {command}")
-            
-            # Create channel for interactive command
-            channel = ssh_client.invoke_shell()
-            channel.send(f"{command}\n")
-            
-            # Wait a moment for prompt
-            import time
-            time.sleep(2)
-            
-            # Send account number
-            logger.info(f"Sending customer ID: {account_no}")
-            channel.send(f"{account_no}\n")
-            logger.info("Waiting for script execution (timeout: 10 minutes)...")
+            parser = ScriptOutputParser(on_event=lambda event: handle_script_event(event, environment, logger, job))
             
-            # Collect output with timeout
-            output = ""
-            channel.settimeout(600)  # 10 minutes timeout
+            def on_text(text):
+                parser.feed(text)
+                if job:
+                    job.append_output(text)
             
-            try:
-                while True:
-                    if channel.recv_ready():
-                        chunk = channel.recv(4096).decode('utf-8', errors='ignore')
-                        output += chunk
-                    
-                    if channel.exit_status_ready():
-                        # Get any remaining output
-                        while channel.recv_ready():
-                            chunk = channel.recv(4096).decode('utf-8', errors='ignore')
-                            output += chunk
-                        break
-                    
-                    time.sleep(0.5)
-            except Exception as e:
-                logger.warning(f"Timeout or error during output collection: {str(e)}")
-                output += f"\n[Timeout or error: {str(e)}]"
-            
-            exit_status = channel.recv_exit_status()
-            channel.close()
+            if backend == 'python':
+                exit_status, output = run_definitive_pipeline(environment, env_config, account_no, ssh_client,
+                                                              logger, job, on_text)
+            else:
+                exit_status, output = run_script_channel(environment, env_config, invoice_type, script_path,
+                                                         account_no, ssh_client, logger, job, on_text)
+            parser.finish()
+            if job:
+                job.set_exit_code(exit_status)
             
             logger.info(f"Script execution completed with exit code: {exit_status}")
             logger.debug(f"Script output:\n{output}")
@@ -459,12 +687,12 @@ def run_remote_invoice_script(environment, invoice_type, account_no, logger=None
                 return True, output, None, ssh_client
             else:
                 logger.error(f"Script failed with exit code {exit_status}")
-                ssh_client.close()
+                SSH_POOL.release(ssh_client)
                 return False, output, f"Script exited with code {exit_status}", None
         
         except Exception as e:
             logger.error(f"Error during script execution: {str(e)}")
-            ssh_client.close()
+            SSH_POOL.release(ssh_client, discard=True)
             return False, "", str(e), None
     
     except Exception as e:
@@ -480,73 +708,115 @@ def index():
 
 
 
-@app.route('/generate_invoice', methods=['POST'])
-def generate_invoice():
-    """Handle invoice generation request"""
-    # Setup logger for this run
-    logger, log_path = setup_invoice_logger()
+def validate_invoice_request(data, logger):
+    """Validate invoice request fields, returns (params, error_message)"""
+    environment = (data.get('environment') or '').strip()
+    invoice_type = (data.get('invoice_type') or '').strip()
+    account_no = str(data.get('account_no') or '').strip()
     
-    logger.info("="*80)
-    logger.info("INVOICE GENERATION STARTED")
-    logger.info("="*80)
+    # Log input parameters
+    logger.info("Input Parameters:")
+    logger.info(f"  Environment: {environment}")
+    logger.info(f"  Invoice Type: {invoice_type}")
+    logger.info(f"  Customer ID: {account_no}")
     
+    # Validate inputs
+    logger.info("Validating input parameters...")
+    if not environment:
+        logger.error("Validation failed: Environment is required")
+        return None, 'Environment is required'
+    
+    if not invoice_type:
+        logger.error("Validation failed: Invoice type is required")
+        return None, 'Invoice type is required'
+    
+    if not account_no:
+        logger.error("Validation failed: Customer ID is required")
+        return None, 'Customer ID is required'
+    
+    logger.info("Input validation passed")
+    
+    # Get environment configuration
+    logger.info(f"Loading configuration for environment: {environment}")
+    env_config = ENVIRONMENTS.get(environment)
+    if not env_config:
+        logger.error(f"Unknown environment: {environment}")
+        return None, f'Unknown environment: {environment}'
+    
+    # Log server connection details (mask password)
+    logger.info("Server Connection Details:")
+    logger.info(f"  Host: {env_config.get('host', 'Not configured')}")
+    logger.info(f"  Port: {env_config.get('port', 22)}")
+    logger.info(f"  Username: {env_config.get('username', 'Not configured')}")
+    logger.info(f"  Auth Method: {'SSH Key' if env_config.get('key_file') else 'Password'}")
+    logger.info(f"  Script Path: {env_config['script_paths'].get(invoice_type, 'Not configured')}")
+    logger.info(f"  Output Path: {env_config.get('output_path', 'Not configured')}")
+    
+    # Check if script path is configured
+    if not env_config['script_paths'].get(invoice_type):
+        logger.error(f"Script path not configured for {invoice_type}")
+        return None, f'Script path not configured for {invoice_type}'
+    
+    return {'environment': environment, 'invoice_type': invoice_type, 'account_no': account_no}, None
+
+def output_fields(stdout, job):
+    """
+    Script output to include in the response
+    Background jobs stream their output, so only a short tail is returned
+    """
+    if job is None:
+        return {'output': stdout}
+    return {'output_tail': '\n'.join(job.output_tail(20))}
+
+def execute_invoice_run(environment, invoice_type, account_no, logger, log_path, job=None, tracker=None):
+    """Run the invoice script and record it in the run history, returns (payload, status_code)"""
+    log_file = os.path.basename(log_path)
+    # Sync runs get a tracker job too so the exit code is captured
+    tracker = job or tracker or Job(log_file=log_file, max_output_lines=0)
+    record_history(logger, RUN_HISTORY.start_run, log_file, environment, invoice_type, account_no)
+    log_event(logger, 'run_start', environment=environment, invoice_type=invoice_type, account_no=account_no)
+    RUNS_IN_FLIGHT.inc(environment=environment)
+    started = time.monotonic()
+    
+    try:
+        with timed_phase(logger, PHASE_SECONDS, 'total', environment=environment) as span:
+            payload, status_code = run_invoice_and_respond(environment, invoice_type, account_no, logger, log_path,
+                                                           tracker, stream_output=job is not None)
+            if not payload.get('success'):
+                span['outcome'] = 'error'
+    finally:
+        RUNS_IN_FLIGHT.dec(environment=environment)
+    
+    duration = round(time.monotonic() - started, 3)
+    outcome = STATUS_SUCCEEDED if payload.get('success') else STATUS_FAILED
+    exit_code = tracker.exit_code
+    RUNS_TOTAL.inc(environment=environment, invoice_type=invoice_type, outcome=outcome,
+                   exit_code='none' if exit_code is None else exit_code)
+    log_event(logger, 'run_end', environment=environment, invoice_type=invoice_type, outcome=outcome,
+              exit_code=exit_code, duration=duration)
+    record_history(logger, RUN_HISTORY.finish_run, log_file, outcome,
+                   exit_code=exit_code, duration=duration,
+                   external_id=payload.get('external_id'), message=payload.get('message'))
+    return payload, status_code
+
+def record_history(logger, func, *args, **kwargs):
+    """Write to the run history without letting database errors fail the run"""
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"Could not update run history: {str(e)}")
+
+def run_invoice_and_respond(environment, invoice_type, account_no, logger, log_path, job, stream_output=False):
+    """Run the invoice script and build the response payload, returns (payload, status_code)"""
     ssh_client = None
     try:
-        data = request.get_json()
-        environment = data.get('environment', '').strip()
-        invoice_type = data.get('invoice_type', '').strip()
-        account_no = data.get('account_no', '').strip()
-        
-        # Log input parameters
-        logger.info("Input Parameters:")
-        logger.info(f"  Environment: {environment}")
-        logger.info(f"  Invoice Type: {invoice_type}")
-        logger.info(f"  Customer ID: {account_no}")
-        
-        # Validate inputs
-        logger.info("Validating input parameters...")
-        if not environment:
-            logger.error("Validation failed: Environment is required")
-            return jsonify({'success': False, 'message': 'Environment is required', 'log_file': os.path.basename(log_path)}), 400
-        
-        if not invoice_type:
-            logger.error("Validation failed: Invoice type is required")
-            return jsonify({'success': False, 'message': 'Invoice type is required', 'log_file': os.path.basename(log_path)}), 400
-        
-        if not account_no:
-            logger.error("Validation failed: Customer ID is required")
-            return jsonify({'success': False, 'message': 'Customer ID is required', 'log_file': os.path.basename(log_path)}), 400
-        
-        logger.info("Input validation passed")
-        
-        # Get environment configuration
-        logger.info(f"Loading configuration for environment: {environment}")
-        env_config = ENVIRONMENTS.get(environment)
-        if not env_config:
-            logger.error(f"Unknown environment: {environment}")
-            return jsonify({'success': False, 'message': f'Unknown environment: {environment}', 'log_file': os.path.basename(log_path)}), 400
-        
-        # Log server connection details (mask password)
-        logger.info("Server Connection Details:")
-        logger.info(f"  Host: {env_config.get('host', 'Not configured')}")
-        logger.info(f"  Port: {env_config.get('port', 22)}")
-        logger.info(f"  Username: {env_config.get('username', 'Not configured')}")
-        logger.info(f"  Auth Method: {'SSH Key' if env_config.get('key_file') else 'Password'}")
-        logger.info(f"  Script Path: {env_config['script_paths'].get(invoice_type, 'Not configured')}")
-        logger.info(f"  Output Path: {env_config.get('output_path', 'Not configured')}")
-        
-        # Check if script path is configured
-        if not env_config['script_paths'].get(invoice_type):
-            logger.error(f"Script path not configured for {invoice_type}")
-            return jsonify({'success': False, 'message': f'Script path not configured for {invoice_type}', 'log_file': os.path.basename(log_path)}), 400
-        
         # Run the script on remote server
         logger.info("="*80)
         logger.info("EXECUTING INVOICE SCRIPT ON REMOTE SERVER")
         logger.info("Script will handle invoice generation and email delivery")
         logger.info("="*80)
         
-        result = run_remote_invoice_script(environment, invoice_type, account_no, logger)
+        result = run_remote_invoice_script(environment, invoice_type, account_no, logger, job=job)
         
         if len(result) == 4:
             success, stdout, stderr, ssh_client = result
@@ -559,17 +829,21 @@ def generate_invoice():
             logger.info("="*80)
             logger.info("INVOICE GENERATION FAILED")
             logger.info("="*80)
-            return jsonify({
+            payload = {
                 'success': False,
                 'message': f'Script execution failed: {stderr}',
-                'output': stdout,
                 'log_file': os.path.basename(log_path)
-            }), 500
+            }
+            payload.update(output_fields(stdout, job if stream_output else None))
+            return payload, 500
         
-        # Close SSH connection
+        external_id = job.script_values.get('external_id')
+        invoice_fields = locate_invoice_file(environment, invoice_type, external_id, ssh_client, logger)
+        
+        # Return SSH connection to the pool
         if ssh_client:
-            ssh_client.close()
-            logger.info("SSH connection closed")
+            SSH_POOL.release(ssh_client)
+            logger.info("SSH connection returned to pool")
         
         # Script handles email sending, so we're done
         logger.info("="*80)
@@ -578,12 +852,16 @@ def generate_invoice():
         logger.info("="*80)
         logger.info(f"Log file: {os.path.basename(log_path)}")
         
-        return jsonify({
+        payload = {
             'success': True,
             'message': f'{invoice_type} invoice for {environment} environment generated successfully. Email sent by script.',
-            'output': stdout,
             'log_file': os.path.basename(log_path)
-        })
+        }
+        if external_id:
+            payload['external_id'] = external_id
+        payload.update(invoice_fields)
+        payload.update(output_fields(stdout, job if stream_output else None))
+        return payload, 200
     
     except Exception as e:
         logger.exception("Unexpected error during invoice generation")
@@ -592,16 +870,489 @@ def generate_invoice():
         logger.info("="*80)
         if ssh_client:
             try:
-                ssh_client.close()
+                SSH_POOL.release(ssh_client, discard=True)
             except:
                 pass
+        return {'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}, 500
+
+def record_rejected_run(logger, log_path, data, error):
+    """Record a request that failed validation in the run history"""
+    record_history(logger, RUN_HISTORY.record, os.path.basename(log_path),
+                   data.get('environment'), data.get('invoice_type'), str(data.get('account_no') or ''),
+                   STATUS_REJECTED, message=error, accounts=data.get('accounts'))
+    # Only known values become metric labels
+    environment = data.get('environment') if data.get('environment') in ENVIRONMENTS else 'unknown'
+    invoice_type = data.get('invoice_type') if data.get('invoice_type') in ('Proforma', 'Definitive') else 'unknown'
+    RUNS_TOTAL.inc(environment=environment, invoice_type=invoice_type, outcome=STATUS_REJECTED, exit_code='none')
+
+def wants_async_job(data):
+    """Return True when the client asked for background job mode"""
+    mode = request.args.get('mode', '') or str(data.get('mode', ''))
+    return mode.lower() == 'job' or bool(data.get('async'))
+
+def job_links(job, message):
+    """Response body pointing a client at a background job"""
+    return {
+        'success': True,
+        'message': message,
+        'job_id': job.id,
+        'status_url': url_for('job_status', job_id=job.id),
+        'result_url': url_for('job_result', job_id=job.id),
+        'stream_url': url_for('job_stream', job_id=job.id),
+        'log_file': job.log_file
+    }
+
+def finish_background_run(run_key, job, logger):
+    """Called when a background run finishes"""
+    RUN_REGISTRY.release(run_key, job)
+    close_invoice_logger(logger)
+
+def coalesced_response(job, background, logger, log_path, params):
+    """
+    Answer a request that matched an in-flight run or an idempotency key
+    Background requests get the existing job; synchronous ones wait for its result.
+    """
+    logger.info(f"Identical request attached to run {job.log_file} (job {job.id}, {job.state})")
+    record_history(logger, RUN_HISTORY.record, os.path.basename(log_path),
+                   params['environment'], params['invoice_type'], params['account_no'],
+                   STATUS_COALESCED, message=f"Attached to {job.log_file}")
+    
+    if background:
+        body = job_links(job, f'Attached to the {params["invoice_type"]} run already started for this account.')
+        body['coalesced'] = True
+        return jsonify(body), 202
+    
+    if not job.wait(APP_SETTINGS['coalescing']['wait_timeout']):
+        body = job_links(job, 'An identical invoice run is still in progress.')
+        body.update({'success': False, 'coalesced': True})
+        return jsonify(body), 202
+    
+    payload = dict(job.result)
+    payload['coalesced'] = True
+    return jsonify(payload), job.status_code
+
+@app.route('/generate_invoice', methods=['POST'])
+def generate_invoice():
+    """Handle invoice generation request (synchronous, or as a background job with mode=job)"""
+    # Setup logger for this run
+    logger, log_path = setup_invoice_logger()
+    
+    logger.info("="*80)
+    logger.info("INVOICE GENERATION STARTED")
+    logger.info("="*80)
+    
+    # The background job closes the logger when it runs asynchronously
+    handed_off = False
+    try:
+        data = request.get_json() or {}
+        params, error = validate_invoice_request(data, logger)
+        if error:
+            record_rejected_run(logger, log_path, data, error)
+            return jsonify({'success': False, 'message': error, 'log_file': os.path.basename(log_path)}), 400
+        
+        run_key = (params['environment'], params['invoice_type'], params['account_no'])
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        background = wants_async_job(data)
+        
+        def create_job():
+            if background:
+                return JOB_MANAGER.submit(
+                    execute_invoice_run, *run_key, logger, log_path,
+                    params=params, log_file=os.path.basename(log_path),
+                    on_done=lambda job: finish_background_run(run_key, job, logger)
+                )
+            return JOB_MANAGER.track(Job(params=params, log_file=os.path.basename(log_path), max_output_lines=0))
+        
+        try:
+            job, attached = RUN_REGISTRY.claim(run_key, create_job, idempotency_key)
+        except JobQueueFull as e:
+            logger.error(str(e))
+            return jsonify({'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}), 503
+        except IdempotencyConflict as e:
+            logger.error(str(e))
+            return jsonify({'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}), 409
+        
+        if attached:
+            return coalesced_response(job, background, logger, log_path, params)
+        
+        if background:
+            handed_off = True
+            logger.info(f"Invoice run queued as background job {job.id}")
+            return jsonify(job_links(job, f'{params["invoice_type"]} invoice for {params["environment"]} queued.')), 202
+        
+        # Synchronous run in this request thread; the tracker job lets identical requests wait for it
+        job.start()
+        try:
+            payload, status_code = execute_invoice_run(*run_key, logger, log_path, tracker=job)
+        except Exception as e:
+            logger.exception("Unexpected error during invoice generation")
+            payload, status_code = {'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}, 500
+        job.complete(payload, status_code)
+        RUN_REGISTRY.release(run_key, job)
+        return jsonify(payload), status_code
+    
+    except Exception as e:
+        logger.exception("Unexpected error during invoice generation")
+        return jsonify({'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}), 500
+    finally:
+        if not handed_off:
+            close_invoice_logger(logger)
+
+BATCH_FIELDS = ('environment', 'invoice_type', 'account_no')
+
+def parse_batch_rows(data, upload=None):
+    """
+    Build batch rows from a JSON list, CSV text or an uploaded CSV file
+    CSV may have a header row (environment,invoice_type,account_no) or just three columns
+    """
+    if upload is not None:
+        text = upload.read().decode('utf-8-sig', errors='replace')
+    elif isinstance(data.get('rows'), list):
+        return [dict(row) if isinstance(row, dict) else dict(zip(BATCH_FIELDS, row)) for row in data['rows']]
+    else:
+        text = data.get('csv', '')
+    
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    reader = csv.reader(lines)
+    first = next(reader)
+    header = [col.strip().lower() for col in first]
+    rows = []
+    if all(field in header for field in BATCH_FIELDS):
+        positions = [header.index(field) for field in BATCH_FIELDS]
+        for values in reader:
+            rows.append({field: values[pos] if pos < len(values) else ''
+                         for field, pos in zip(BATCH_FIELDS, positions)})
+    else:
+        for values in [first] + list(reader):
+            rows.append(dict(zip(BATCH_FIELDS, values)))
+    return rows
+
+def precheck_batch_row(row):
+    """Normalize a batch row and attach an 'error' when it cannot be run"""
+    row = {field: str(row.get(field) or '').strip() for field in BATCH_FIELDS}
+    missing = [field for field in BATCH_FIELDS if not row[field]]
+    if missing:
+        row['error'] = f"Missing {', '.join(missing)}"
+    elif row['environment'] not in ENVIRONMENTS:
+        row['error'] = f"Unknown environment: {row['environment']}"
+    elif not ENVIRONMENTS[row['environment']]['script_paths'].get(row['invoice_type']):
+        row['error'] = f"Script path not configured for {row['invoice_type']}"
+    return row
+
+def batch_limit(environment):
+    """Maximum concurrent batch rows for an environment"""
+    settings = APP_SETTINGS['batch']
+    return settings['limits'].get(environment, settings['default_limit'])
+
+def run_batch_row(row, job=None):
+    """Run one batch row through the normal invoice path with its own log file"""
+    logger, log_path = setup_invoice_logger()
+    if job:
+        job.log_file = os.path.basename(log_path)
+    
+    logger.info("="*80)
+    logger.info("INVOICE GENERATION STARTED (BATCH)")
+    logger.info("="*80)
+    
+    try:
+        params, error = validate_invoice_request(row, logger)
+        if error:
+            record_rejected_run(logger, log_path, row, error)
+            return {'success': False, 'message': error, 'log_file': os.path.basename(log_path)}, 400
+        
+        run_key = (params['environment'], params['invoice_type'], params['account_no'])
+        owner, attached = RUN_REGISTRY.claim(run_key, lambda: job)
+        if attached:
+            logger.info(f"Identical run already in progress ({owner.log_file}), waiting for its result")
+            record_history(logger, RUN_HISTORY.record, os.path.basename(log_path), *run_key,
+                           STATUS_COALESCED, message=f"Attached to {owner.log_file}")
+            if not owner.wait(APP_SETTINGS['coalescing']['wait_timeout']):
+                return {'success': False, 'message': 'An identical invoice run is still in progress',
+                        'log_file': owner.log_file}, 504
+            return dict(owner.result, coalesced=True), owner.status_code
+        
+        try:
+            return execute_invoice_run(*run_key, logger, log_path, job=job)
+        finally:
+            RUN_REGISTRY.release(run_key, job)
+    finally:
+        close_invoice_logger(logger)
+
+@app.route('/batch')
+def batch_page():
+    """Render the bulk invoice generation page"""
+    env_list = [{'key': k, 'name': v['name']} for k, v in ENVIRONMENTS.items()]
+    return render_template('batch.html', environments=env_list)
+
+@app.route('/generate_invoice_batch', methods=['POST'])
+def generate_invoice_batch():
+    """Queue invoice generation for many (environment, invoice_type, account_no) rows"""
+    try:
+        data = request.get_json(silent=True) or request.form.to_dict()
+        rows = parse_batch_rows(data, request.files.get('file'))
+        if not rows:
+            return jsonify({'success': False, 'message': 'No rows supplied'}), 400
+        
+        max_rows = APP_SETTINGS['batch']['max_rows']
+        if len(rows) > max_rows:
+            return jsonify({'success': False, 'message': f'Too many rows ({len(rows)}), maximum is {max_rows}'}), 400
+        
+        rows = [precheck_batch_row(row) for row in rows]
+        batch = JOB_MANAGER.submit_batch(rows, run_batch_row, batch_limit)
+        return jsonify({
+            'success': True,
+            'message': f'{len(rows)} invoice runs queued',
+            'batch_id': batch.id,
+            'status_url': url_for('batch_status', batch_id=batch.id)
+        }), 202
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    """Report per-row results and summary of a batch"""
+    batch = JOB_MANAGER.get_batch(batch_id)
+    if not batch:
+        return jsonify({'success': False, 'message': 'Batch not found'}), 404
+    
+    data = batch.to_dict()
+    data['success'] = True
+    return jsonify(data)
+
+def parse_account_list(value):
+    """Account numbers from a JSON list or from text separated by commas, spaces or new lines"""
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item for item in re.split(r'[\s,;]+', str(value or '')) if item]
+
+def run_definitive_batch(environment, accounts, logger, log_path, job=None):
+    """Invoice many accounts in one Definitive batch, returns (payload, status_code)"""
+    log_file = os.path.basename(log_path)
+    env_config = ENVIRONMENTS[environment]
+    record_history(logger, RUN_HISTORY.start_run, log_file, environment, 'Definitive', None, accounts=accounts)
+    log_event(logger, 'run_start', environment=environment, invoice_type='Definitive', accounts=len(accounts))
+    RUNS_IN_FLIGHT.inc(environment=environment)
+    started = time.monotonic()
+    
+    # Accounts with a single run in flight are left out of the batch
+    claimed, busy = [], []
+    for account_no in dict.fromkeys(accounts):
+        run_key = (environment, 'Definitive', account_no)
+        owner, attached = RUN_REGISTRY.claim(run_key, lambda: job)
+        (busy if attached else claimed).append(account_no)
+    
+    outcomes = [{'account_no': account_no, 'status': STATUS_REJECTED, 'stage': 'validate',
+                 'message': 'An invoice run for this account is already in progress'} for account_no in busy]
+    ssh_client = None
+    try:
+        logger.info("="*80)
+        logger.info(f"DEFINITIVE BATCH FOR {len(claimed)} ACCOUNTS")
+        logger.info("="*80)
+        if claimed:
+            job.set_progress(f"Connecting to {environment}")
+            with timed_phase(logger, PHASE_SECONDS, 'ssh_connect', environment=environment) as span:
+                ssh_client, error = SSH_POOL.acquire(environment, env_config, logger)
+                if error:
+                    span['outcome'] = 'error'
+            if error:
+                raise RuntimeError(f"SSH connection failed: {error}")
+            
+            def on_text(text):
+                job.append_output(text)
+                for line in text.splitlines():
+                    logger.info(line)
+            
+            pipeline = create_definitive_pipeline(environment, env_config, ssh_client, logger)
+            batch = DefinitiveBatch(pipeline, environment, claimed, on_text=on_text, on_progress=job.set_progress,
+                                    timeout=APP_SETTINGS['pipeline']['batch_timeout'])
+            outcomes = batch.run() + outcomes
+        SSH_POOL.release(ssh_client)
+    except Exception as e:
+        logger.exception("Definitive batch failed")
+        SSH_POOL.release(ssh_client, discard=True)
+        outcomes += [{'account_no': account_no, 'status': STATUS_FAILED, 'stage': None, 'message': str(e)}
+                     for account_no in claimed if account_no not in {o['account_no'] for o in outcomes}]
+    finally:
+        RUNS_IN_FLIGHT.dec(environment=environment)
+        for account_no in claimed:
+            RUN_REGISTRY.release((environment, 'Definitive', account_no), job)
+    
+    summary = summarize_outcomes(outcomes)
+    for outcome in outcomes:
+        RUNS_TOTAL.inc(environment=environment, invoice_type='Definitive', outcome=outcome['status'], exit_code='none')
+    success = summary[STATUS_SUCCEEDED] == len(outcomes)
+    job.set_exit_code(0 if success else 1)
+    message = (f"Definitive batch finished: {summary[STATUS_SUCCEEDED]} succeeded, {summary[STATUS_FAILED]} failed, "
+               f"{summary[STATUS_REJECTED]} rejected")
+    duration = round(time.monotonic() - started, 3)
+    
+    logger.info(message)
+    logger.info("="*80)
+    logger.info("INVOICE GENERATION COMPLETED SUCCESSFULLY" if success else "INVOICE GENERATION FAILED")
+    logger.info("="*80)
+    log_event(logger, 'run_end', environment=environment, invoice_type='Definitive',
+              outcome=STATUS_SUCCEEDED if success else STATUS_FAILED, duration=duration, **summary)
+    record_history(logger, RUN_HISTORY.finish_run, log_file, STATUS_SUCCEEDED if success else STATUS_FAILED,
+                   exit_code=0 if success else 1, duration=duration, message=message)
+    record_history(logger, RUN_HISTORY.finish_accounts, log_file, outcomes)
+    payload = {'success': success, 'message': message, 'log_file': log_file, 'summary': summary,
+               'accounts': outcomes}
+    return payload, 200 if summary[STATUS_SUCCEEDED] else 500
+
+@app.route('/generate_definitive_batch', methods=['POST'])
+def generate_definitive_batch():
+    """Queue one Definitive run for many accounts of an environment (python backend only)"""
+    logger, log_path = setup_invoice_logger()
+    
+    logger.info("="*80)
+    logger.info("INVOICE GENERATION STARTED (DEFINITIVE BATCH)")
+    logger.info("="*80)
+    
+    handed_off = False
+    try:
+        data = request.get_json(silent=True) or request.form.to_dict()
+        environment = (data.get('environment') or '').strip()
+        accounts = parse_account_list(data.get('accounts'))
+        max_rows = APP_SETTINGS['batch']['max_rows']
+        logger.info(f"  Environment: {environment}")
+        logger.info(f"  Accounts: {', '.join(accounts)}")
+        
+        error = None
+        if environment not in ENVIRONMENTS:
+            error = f'Unknown environment: {environment}'
+        elif get_script_setting(ENVIRONMENTS[environment], 'backends', 'Definitive', 'script') != 'python':
+            error = f'Definitive batches need the python backend for {environment}'
+        elif not accounts:
+            error = 'No accounts supplied'
+        elif len(accounts) > max_rows:
+            error = f'Too many accounts ({len(accounts)}), maximum is {max_rows}'
+        if error:
+            logger.error(f"Validation failed: {error}")
+            record_rejected_run(logger, log_path, {'environment': environment, 'invoice_type': 'Definitive',
+                                                   'accounts': accounts}, error)
+            return jsonify({'success': False, 'message': error, 'log_file': os.path.basename(log_path)}), 400
+        
+        try:
+            job = JOB_MANAGER.submit(run_definitive_batch, environment, accounts, logger, log_path,
+                                     params={'environment': environment, 'invoice_type': 'Definitive',
+                                             'accounts': accounts},
+                                     log_file=os.path.basename(log_path),
+                                     on_done=lambda job: close_invoice_logger(logger))
+        except JobQueueFull as e:
+            logger.error(str(e))
+            return jsonify({'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}), 503
+        
+        handed_off = True
+        logger.info(f"Definitive batch queued as background job {job.id}")
+        return jsonify(job_links(job, f'Definitive batch for {len(accounts)} accounts queued.')), 202
+    
+    except Exception as e:
+        logger.exception("Unexpected error queueing Definitive batch")
         return jsonify({'success': False, 'message': str(e), 'log_file': os.path.basename(log_path)}), 500
+    finally:
+        if not handed_off:
+            close_invoice_logger(logger)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report progress of a background invoice job"""
+    job = JOB_MANAGER.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    data = job.to_dict(include_result=False)
+    data['success'] = True
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """Stream script output lines of a background job as Server-Sent Events"""
+    job = JOB_MANAGER.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    start = request.headers.get('Last-Event-ID', request.args.get('from', '0'))
+    start = int(start) if str(start).isdigit() else 0
+    
+    def generate():
+        index = start
+        while True:
+            next_index, lines, finished = job.read_output(index)
+            first = next_index - len(lines)
+            for offset, line in enumerate(lines):
+                yield f"id: {first + offset + 1}\ndata: {line}\n\n"
+            index = next_index
+            if finished:
+                yield f"event: done\ndata: {json.dumps({'state': job.state, 'exit_code': job.exit_code})}\n\n"
+                return
+            if not lines:
+                yield ": keepalive\n\n"
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Return the final result of a background invoice job"""
+    job = JOB_MANAGER.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    data = job.to_dict()
+    if 'result' not in data:
+        data['success'] = False
+        data['message'] = f'Job is still {job.state}'
+        return jsonify(data), 202
+    
+    payload = dict(data.pop('result'))
+    payload.update(data)
+    return jsonify(payload), job.status_code
+
+def check_environment(env_key, env_config):
+    """Live connection check used by the health prober, returns (ok, error)"""
+    # The probe never waits for a slot: when invoice runs hold them all, the host is busy, not down
+    ssh_client, error = SSH_POOL.acquire(env_key, env_config, timeout=0)
+    if error and SSH_POOL.saturated(env_key, env_config):
+        raise EnvironmentBusy(f"All {SSH_POOL.max_size} pooled SSH connections are in use by invoice runs")
+    if error:
+        return False, error
+    try:
+        stdin, stdout, stderr = ssh_client.exec_command('echo "Connection successful"', timeout=30)
+        result = stdout.read().decode().strip()
+    except Exception:
+        SSH_POOL.release(ssh_client, discard=True)
+        raise
+    SSH_POOL.release(ssh_client)
+    return (True, None) if result else (False, 'Connection failed')
+
+def health_response(result, cached):
+    """JSON body for a health result"""
+    age = int(time.time() - result['checked_at']) if result.get('checked_at') else None
+    if result['status'] == STATUS_OK:
+        message = 'Connection successful!'
+    elif result['status'] == STATUS_BUSY:
+        message = f"Connected, busy: {result['error']}"
+    else:
+        message = result.get('error') or 'Connection failed'
+    if cached and age is not None:
+        message += f" (checked {age}s ago)"
+    return {
+        'success': result['status'] in (STATUS_OK, STATUS_BUSY),
+        'message': message,
+        'status': result['status'],
+        'latency_ms': result.get('latency_ms'),
+        'checked_at': result.get('checked_at'),
+        'age_seconds': age,
+        'cached': cached
+    }
 
 @app.route('/test_connection', methods=['POST'])
 def test_connection():
-    """Test SSH connection to an environment"""
+    """Return the cached connection status of an environment, or check it live with force=1"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         env_key = data.get('environment')
         
         if env_key not in ENVIRONMENTS:
@@ -612,63 +1363,256 @@ def test_connection():
         if not env_config.get('host'):
             return jsonify({'success': False, 'message': 'Server host not configured'}), 400
         
-        ssh_client, error = create_ssh_client(env_config)
-        
-        if error:
-            return jsonify({'success': False, 'message': error}), 500
-        
-        # Test connection by running simple command
-        stdin, stdout, stderr = ssh_client.exec_command('echo "Connection successful"')
-        result = stdout.read().decode().strip()
-        ssh_client.close()
+        force = request.args.get('force') == '1' or str(data.get('force', '')) in ('1', 'true', 'True')
+        result = HEALTH_PROBER.status(env_key)
+        cached = not force and result['status'] in (STATUS_OK, STATUS_ERROR, STATUS_BUSY)
+        if not cached:
+            result = HEALTH_PROBER.probe(env_key, env_config)
         
-        if result:
-            return jsonify({'success': True, 'message': 'Connection successful!'})
-        else:
-            return jsonify({'success': False, 'message': 'Connection failed'}), 500
+        return jsonify(health_response(result, cached)), 200 if result['status'] in (STATUS_OK, STATUS_BUSY) else 500
     
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/health')
+def health():
+    """Cached health of every environment"""
+    return jsonify({env_key: health_response(result, True)
+                    for env_key, result in HEALTH_PROBER.statuses().items()})
+
+@app.route('/account_route')
+def account_route():
+    """Customer database and group_id of an account, from the route index or external_id_acct_map"""
+    environment = request.args.get('environment', '').strip()
+    account_no = request.args.get('account_no', '').strip()
+    if environment not in ENVIRONMENTS:
+        return jsonify({'success': False, 'message': f'Unknown environment: {environment}'}), 400
+    if not account_no.isdigit():
+        return jsonify({'success': False, 'message': 'Account number must be numeric'}), 400
+    
+    source = 'index'
+    route = ROUTE_INDEX.lookup(environment, account_no)
+    if route is None:
+        databases = ENVIRONMENTS[environment].get('databases')
+        if not databases:
+            return jsonify({'success': False, 'message': f'Account {account_no} is not in the route index'}), 404
+        try:
+            dialect = get_dialect(databases)
+            with DB_POOL.connection((environment, LOOKUP_DB_INDEX), dialect) as conn:
+                cursor = conn.cursor()
+                cursor.execute(dialect.sql('account_map'), {'account_no': account_no})
+                rows = cursor.fetchall()
+                cursor.close()
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'Lookup failed: {e}'}), 500
+        if not rows or rows[0][0] is None:
+            return jsonify({'success': False, 'message': f'Account {account_no} not found in external_id_acct_map'}), 404
+        ROUTE_INDEX.record(environment, [(account_no,) + tuple(row) for row in rows])
+        route = ROUTE_INDEX.lookup(environment, account_no)
+        source = 'database'
+    
+    payload = {'success': True, 'environment': environment, 'account_no': account_no, 'source': source, **route,
+               'db_index': SERVER_DB_INDEX.get(route['server_id'])}
+    try:
+        payload['group_id'], payload['account_type'] = group_for_account_types(set(route['external_id_types']),
+                                                                               route['server_id'])
+    except StageFailed as e:
+        payload['group_id'], payload['account_type'], payload['message'] = None, None, str(e)
+    return jsonify(payload)
+
+@app.route('/account_routes/status')
+def account_routes_status():
+    """Indexed accounts and last refresh of the route index per environment"""
+    return jsonify(ROUTE_INDEX.status())
+
+@app.route('/download_invoice')
+def download_invoice():
+    """Send an invoice file found by a run, through the local download cache"""
+    environment = request.args.get('environment', '')
+    remote_path = request.args.get('path', '')
+    if environment not in ENVIRONMENTS or not ENVIRONMENTS[environment].get('output_path'):
+        return jsonify({'success': False, 'message': f'Unknown environment: {environment}'}), 400
+    # Only files in the invoice index can be downloaded; its size and mtime key the cache
+    invoice = INVOICE_INDEXES.get(environment, ENVIRONMENTS[environment]['output_path']).get(remote_path)
+    if invoice is None:
+        return jsonify({'success': False, 'message': 'Invoice file not found'}), 404
+    
+    logger = logging.getLogger(__name__)
+    ssh_client, error = SSH_POOL.acquire(environment, ENVIRONMENTS[environment], logger)
+    if error:
+        return jsonify({'success': False, 'message': f'SSH connection failed: {error}'}), 503
+    local_path = os.path.join(TEMP_DIR, environment, invoice.name)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    success, error = download_file_from_server(ssh_client, invoice.path, local_path, logger, environment,
+                                               size=invoice.size, mtime=invoice.mtime)
+    SSH_POOL.release(ssh_client, discard=not success)
+    if not success:
+        return jsonify({'success': False, 'message': error}), 502
+    return send_file(local_path, as_attachment=True, download_name=invoice.name)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of run metrics"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+def parse_date_arg(name, end_of_day=False):
+    """Epoch seconds for a YYYY-MM-DD query argument, or None"""
+    value = request.args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+    if end_of_day:
+        day += timedelta(days=1)
+    return day.timestamp()
+
 @app.route('/logs')
 def view_logs():
-    """View recent log files"""
+    """View invoice runs from the run history, with filters and pagination"""
+    filters = {column: request.args.get(column, '').strip() for column in FILTER_COLUMNS}
+    filters['date_from'] = parse_date_arg('date_from')
+    filters['date_to'] = parse_date_arg('date_to', end_of_day=True)
+    
+    settings = APP_SETTINGS['history']
+    page = max(int_arg('page', 1), 1)
+    per_page = min(max(int_arg('per_page', settings['page_size']), 1), 200)
+    
     try:
-        log_files = []
-        if os.path.exists(LOG_DIR):
-            files = glob.glob(os.path.join(LOG_DIR, 'invoice_*.log'))
-            files.sort(key=os.path.getmtime, reverse=True)
-            
-            for log_file in files[:10]:  # Show latest 10 logs
-                log_files.append({
-                    'name': os.path.basename(log_file),
-                    'path': log_file,
-                    'modified': datetime.fromtimestamp(os.path.getmtime(log_file)).strftime('%Y-%m-%d %H:%M:%S')
-                })
-        
-        return render_template('logs.html', logs=log_files)
+        runs, total = RUN_HISTORY.query(filters, page=page, per_page=per_page)
+        for run in runs:
+            run['started'] = datetime.fromtimestamp(run['started_at']).strftime('%Y-%m-%d %H:%M:%S')
+        
+        # Query string without the page number, for pagination links
+        page_args = {k: v for k, v in request.args.items() if k != 'page' and v}
+        return render_template('logs.html',
+                               logs=runs,
+                               total=total,
+                               page=page,
+                               per_page=per_page,
+                               pages=max((total + per_page - 1) // per_page, 1),
+                               page_query=urlencode(page_args),
+                               args=request.args,
+                               options={column: RUN_HISTORY.distinct(column)
+                                        for column in ('environment', 'invoice_type', 'status')})
     except Exception as e:
-        return render_template('logs.html', logs=[], error=str(e))
+        return render_template('logs.html', logs=[], total=0, page=1, pages=1, page_query='',
+                               args=request.args, options={}, error=str(e))
+
+def resolve_log_path(log_name):
+    """Return the absolute path of a log inside LOG_DIR, or None if it escapes it"""
+    log_path = os.path.abspath(os.path.join(LOG_DIR, log_name))
+    if not log_path.startswith(os.path.abspath(LOG_DIR) + os.sep):
+        return None
+    return log_path
+
+def int_arg(name, default):
+    """Read a non-negative integer query parameter"""
+    value = request.args.get(name, '')
+    return int(value) if value.isdigit() else default
 
 @app.route('/view_log/<path:log_name>')
 def view_log_content(log_name):
-    """View content of a specific log file"""
+    """
+    View content of a specific log file
+    Query parameters select what is read: offset/limit for a page of bytes,
+    tail=N for the last N lines, or q=text to search within the log
+    """
     try:
-        log_path = os.path.join(LOG_DIR, log_name)
+        log_path = resolve_log_path(log_name)
         
         # Security check
-        if not os.path.abspath(log_path).startswith(os.path.abspath(LOG_DIR)):
+        if not log_path:
             return "Invalid log file", 403
         
-        if os.path.exists(log_path):
-            with open(log_path, 'r') as f:
-                content = f.read()
-            return render_template('log_content.html', log_name=log_name, content=content)
-        else:
+        if not os.path.exists(log_path):
             return "Log file not found", 404
+        
+        settings = APP_SETTINGS['log_viewer']
+        view = {'log_name': log_name, 'mode': 'page', 'query': request.args.get('q', '')}
+        
+        if view['query']:
+            matches, truncated = log_reader.search_log(log_path, view['query'], settings['max_search_matches'])
+            view.update(mode='search', matches=matches, truncated=truncated,
+                        file_size=os.path.getsize(log_path),
+                        content='\n'.join(f"{number:>6}: {line}" for number, _, line in matches))
+        elif 'tail' in request.args:
+            lines = int_arg('tail', settings['tail_lines'])
+            content, start, size = log_reader.read_tail(log_path, lines)
+            view.update(mode='tail', content=content, offset=start, end_offset=size, file_size=size, tail=lines,
+                        prev_offset=log_reader.page_start_before(log_path, start, settings['page_bytes']) if start else None)
+        else:
+            limit = min(int_arg('limit', settings['page_bytes']), settings['max_page_bytes'])
+            offset = int_arg('offset', 0)
+            content, next_offset, size = log_reader.read_page(log_path, offset, limit)
+            view.update(content=content, offset=offset, end_offset=next_offset, file_size=size, limit=limit,
+                        next_offset=next_offset if next_offset < size else None,
+                        prev_offset=log_reader.page_start_before(log_path, offset, limit) if offset else None)
+        
+        return render_template('log_content.html', **view)
     except Exception as e:
         return f"Error reading log: {str(e)}", 500
 
+RUN_END_MARKERS = ('INVOICE GENERATION COMPLETED SUCCESSFULLY', 'INVOICE GENERATION FAILED')
+
+@app.route('/follow_log/<path:log_name>')
+def follow_log(log_name):
+    """Stream lines appended to a log file as Server-Sent Events until the run ends"""
+    log_path = resolve_log_path(log_name)
+    if not log_path:
+        return "Invalid log file", 403
+    if not os.path.exists(log_path):
+        return "Log file not found", 404
+    
+    settings = APP_SETTINGS['log_viewer']
+    offset = int_arg('offset', os.path.getsize(log_path))
+    
+    def generate():
+        position = offset
+        idle_since = last_ping = time.monotonic()
+        while True:
+            text, position = log_reader.read_new(log_path, position)
+            if text:
+                idle_since = time.monotonic()
+                for line in text.splitlines():
+                    yield f"data: {line}\n\n"
+                if any(marker in text for marker in RUN_END_MARKERS):
+                    yield f"event: done\ndata: {position}\n\n"
+                    return
+            elif time.monotonic() - idle_since > settings['follow_idle_timeout']:
+                yield f"event: done\ndata: {position}\n\n"
+                return
+            else:
+                if time.monotonic() - last_ping > 15:
+                    last_ping = time.monotonic()
+                    yield ": keepalive\n\n"
+                time.sleep(settings['follow_interval'])
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def shutdown_services(drain_timeout=0):
+    """
+    Stop background work before the process exits
+    Waits up to drain_timeout seconds for queued and running jobs, then stops the
+    pollers, closes pooled connections and writes the run log records still queued.
+    """
+    deadline = time.monotonic() + drain_timeout
+    if JOB_MANAGER.active_count() and drain_timeout:
+        print(f"Waiting up to {drain_timeout}s for {JOB_MANAGER.active_count()} invoice run(s) in progress...")
+    while JOB_MANAGER.active_count() and time.monotonic() < deadline:
+        time.sleep(1)
+    if JOB_MANAGER.active_count():
+        print(f"Stopping with {JOB_MANAGER.active_count()} invoice run(s) still in progress")
+    with CONFIG_LOCK:
+        ROUTE_REFRESHER.stop()
+        BATCH_POLLER.stop()
+        HEALTH_PROBER.stop()
+        SSH_POOL.close_all()
+        DB_POOL.close_all()
+        RUN_LOGS.stop()
+
 if __name__ == '__main__':
     # Load configuration on startup
     load_config()
@@ -678,7 +1622,7 @@ if __name__ == '__main__':
     print("="*60)
     print(f"Configuration file: {CONFIG_FILE}")
     print(f"Log directory: {LOG_DIR}")
-    print("\nStarting Flask application...")
+    print("\nStarting Flask development server (use serve.py in production)...")
     print("Access the UI at: http://localhost:5000")
     print("="*60 + "\n")
     
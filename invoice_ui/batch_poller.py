@@ -0,0 +1,159 @@
+"""
+Shared ESTUNI/MERGER status poller
+Runs waiting for an ESTUNI or MERGER batch register with one poller per process
+instead of polling on their own. Each tick reads CRM_BIL_CON_VIEW_ELAB_BATCH once
+per customer database for every waiting CODE_ID_LANCIO and wakes the runs whose
+batch has ended. Each waiter is polled every min_interval seconds at first, and
+the interval grows by backoff up to max_interval while the batch keeps running.
+"""
+
+import logging
+import threading
+import time
+
+from definitive_pipeline import StageFailed, batch_outcome
+
+
+class BatchWaiter:
+    """One run waiting for a module's batch with a given CODE_ID_LANCIO"""
+
+    def __init__(self, db_key, module, id_lancio, after, on_status, interval):
+        self.db_key = db_key
+        self.module = module
+        self.id_lancio = id_lancio
+        self.after = after
+        self.on_status = on_status
+        self.interval = interval
+        self.next_due = time.monotonic()
+        self.last_status = None
+        self.result = None
+        self.done = threading.Event()
+
+
+class BatchStatusPoller:
+    """
+    Waits for ESTUNI/MERGER batches on behalf of pipeline runs
+    Used as the pipeline's waiter: wait(run, module, id_lancio, after) blocks the run
+    until its batch reaches SUCC or ERRO and returns (outcome, code_stato, code_uscita).
+    """
+
+    def __init__(self, db_pool, get_dialect, min_interval=2, max_interval=60, backoff=1.5, logger=None):
+        self.db_pool = db_pool
+        self.get_dialect = get_dialect
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self._waiters = set()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+        self.ticks = 0
+
+    def wait(self, run, module, id_lancio, after=None):
+        def on_status(code_stato):
+            run.emit(f"{module} STARTER still running or unknown status ('{code_stato}'). Waiting...")
+
+        waiter = BatchWaiter(run.db_key, module, id_lancio, after, on_status, self.min_interval)
+        with self._cond:
+            self._waiters.add(waiter)
+            self._start()
+            self._cond.notify()
+        try:
+            timeout = None if run.deadline is None else max(0, run.deadline - time.monotonic())
+            if not waiter.done.wait(timeout):
+                raise StageFailed(f"Timed out waiting for {module} (CODE_ID_LANCIO={id_lancio})")
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+        return waiter.result
+
+    def waiting(self):
+        """Number of runs currently waiting per module"""
+        with self._cond:
+            counts = {}
+            for waiter in self._waiters:
+                counts[waiter.module] = counts.get(waiter.module, 0) + 1
+            return counts
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name='batch-poller', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stop:
+                    pending = [w for w in self._waiters if not w.done.is_set()]
+                    if pending:
+                        delay = min(w.next_due for w in pending) - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if self._stop:
+                    return
+                # Poll every database with a due waiter, for all of its waiters
+                now = time.monotonic()
+                due_keys = {w.db_key for w in pending if w.next_due <= now}
+                by_key = {}
+                for waiter in pending:
+                    if waiter.db_key in due_keys:
+                        by_key.setdefault(waiter.db_key, []).append(waiter)
+            for db_key, waiters in by_key.items():
+                self._poll(db_key, waiters)
+
+    def _poll(self, db_key, waiters):
+        """One query for every waiter on a database, then wake or reschedule each of them"""
+        self.ticks += 1
+        dialect = self.get_dialect(db_key)
+        ids = sorted({w.id_lancio for w in waiters})
+        binds = {f'id{i}': value for i, value in enumerate(ids)}
+        sql = dialect.sql('batch_statuses').format(ids=', '.join(f':{name}' for name in binds))
+        try:
+            with self.db_pool.connection(db_key, dialect) as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql, binds)
+                rows = cursor.fetchall()
+                cursor.close()
+        except Exception as e:
+            self.logger.warning(f"Batch status query failed for {db_key[0]}/{db_key[1]}: {e}")
+            rows = None
+
+        now = time.monotonic()
+        for waiter in waiters:
+            if rows is not None:
+                status = self._latest(waiter, rows)
+                code_stato, code_uscita = status if status else ('', None)
+                outcome = batch_outcome(waiter.module, code_stato, code_uscita)
+                if outcome:
+                    waiter.result = (outcome, code_stato, code_uscita)
+                    waiter.done.set()
+                    continue
+                if code_stato != waiter.last_status:
+                    waiter.last_status = code_stato
+                    try:
+                        waiter.on_status(code_stato)
+                    except Exception as e:
+                        self.logger.warning(f"Batch status callback failed: {e}")
+            waiter.next_due = now + waiter.interval
+            waiter.interval = min(waiter.interval * self.backoff, self.max_interval)
+
+    @staticmethod
+    def _latest(waiter, rows):
+        """(code_stato, code_uscita) of the waiter's latest batch; rows are ordered by start time"""
+        status = None
+        for module, id_lancio, code_stato, code_uscita, started in rows:
+            if str(module).strip() != waiter.module or str(id_lancio).strip() != str(waiter.id_lancio):
+                continue
+            if waiter.after is not None and started <= waiter.after:
+                continue
+            status = (str(code_stato or '').strip(), code_uscita)
+        return status
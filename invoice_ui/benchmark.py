@@ -0,0 +1,247 @@
+"""
+End-to-end benchmark for the invoice UI
+Starts the fake Kenan SSH server (fake_kenan_server.py), points every
+environment at it and drives /generate_invoice and /test_connection at the
+requested concurrency. Reports throughput, p50/p95/p99 latency and peak memory.
+
+Examples:
+  python benchmark.py --requests 200 --concurrency 8
+  python benchmark.py --scenario test_connection --requests 1000 --concurrency 16
+  python benchmark.py --line-delay 0.05 --fail-rate 0.1 --json
+  python benchmark.py --url http://localhost:5000 --ssh-port 2222
+    (app already running with config.json pointing at 127.0.0.1:2222)
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_kenan_server import FakeKenanServer, ScriptProfile
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class InProcessClient:
+    """Calls the Flask app through its test client, one client per thread"""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(path, json=payload)
+        return response.status_code
+
+
+class HTTPClient:
+    """Calls a running instance of the app over HTTP"""
+
+    def __init__(self, base_url, timeout=900):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def post(self, path, payload):
+        request = urllib.request.Request(self.base_url + path, data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def prepare_app(args, server, work_dir):
+    """Import the app and point it at the fake server and a scratch log directory"""
+    import app
+    from run_history import RunHistory
+    from run_logs import RunLogManager
+    from sftp_download import SFTPDownloader
+    from ssh_pool import SSHConnectionPool
+
+    log_dir = os.path.join(work_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    app.LOG_DIR = log_dir
+    app.RUN_LOGS.stop()
+    app.RUN_LOGS = RunLogManager(log_dir, **app.APP_SETTINGS['run_logs'])
+    app.RUN_HISTORY = RunHistory(os.path.join(log_dir, 'run_history.db'))
+    app.DOWNLOADER = SFTPDownloader(os.path.join(work_dir, 'cache'), **app.APP_SETTINGS['downloads'])
+
+    for env_config in app.ENVIRONMENTS.values():
+        env_config.update({'host': '127.0.0.1', 'port': server.port, 'user': 'bench',
+                           'password': 'bench', 'key_file': '', 'output_path': server.stampe_dir})
+
+    pool_settings = dict(app.APP_SETTINGS['ssh_pool'])
+    pool_settings['max_size'] = args.pool_size
+    pool_settings['acquire_timeout'] = max(pool_settings['acquire_timeout'], 900)
+    app.SSH_POOL.close_all()
+    app.SSH_POOL = SSHConnectionPool(app.create_ssh_client, **pool_settings)
+    return app
+
+
+def build_requests(args):
+    """List of (path, payload) in the order they are issued"""
+    generate = ('/generate_invoice', {'environment': args.env, 'invoice_type': args.invoice_type})
+    connect = ('/test_connection?force=1' if args.live_checks else '/test_connection', {'environment': args.env})
+    plan = []
+    for i in range(args.requests):
+        if args.scenario == 'generate' or (args.scenario == 'mixed' and i % 2 == 0):
+            path, payload = generate
+            plan.append((path, dict(payload, account_no=str(args.first_account + i))))
+        else:
+            plan.append(connect)
+    return plan
+
+
+def run(client, plan, concurrency):
+    """Issue the plan with concurrency workers, returns (results, wall_seconds)"""
+    def issue(item):
+        path, payload = item
+        started = time.perf_counter()
+        try:
+            status = client.post(path, payload)
+        except Exception:
+            status = 0
+        return path, status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(issue, plan))
+    return results, time.perf_counter() - started
+
+
+def summarize(results, wall):
+    """Per-endpoint throughput and latency percentiles"""
+    report = {}
+    for path in sorted({r[0] for r in results}):
+        latencies = sorted(r[2] for r in results if r[0] == path)
+        errors = sum(1 for r in results if r[0] == path and not 200 <= r[1] < 300)
+        report[path] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(latencies[-1] * 1000, 1),
+        }
+    return report
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, or None where unsupported"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def print_report(summary):
+    print("\n" + "=" * 88)
+    print(f"Scenario: {summary['scenario']}  requests: {summary['requests']}  "
+          f"concurrency: {summary['concurrency']}  wall: {summary['wall_seconds']}s")
+    print("=" * 88)
+    print(f"{'endpoint':<28}{'reqs':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for path, row in summary['endpoints'].items():
+        print(f"{path:<28}{row['requests']:>6}{row['errors']:>8}{row['throughput_rps']:>9}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print("-" * 88)
+    if summary['peak_traced_mb'] is not None:
+        print(f"Peak traced Python memory: {summary['peak_traced_mb']} MB")
+    if summary['peak_rss_mb'] is not None:
+        print(f"Peak RSS: {summary['peak_rss_mb']} MB")
+    print(f"SSH connections accepted by fake server: {summary['ssh_connections']}")
+    print("=" * 88)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the invoice UI against a fake Kenan host')
+    parser.add_argument('--scenario', choices=('generate', 'test_connection', 'mixed'), default='generate')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--env', default='IT')
+    parser.add_argument('--invoice-type', choices=('Definitive', 'Proforma'), default='Definitive')
+    parser.add_argument('--first-account', type=int, default=100000)
+    parser.add_argument('--line-delay', type=float, default=0.01, help='seconds between script output lines')
+    parser.add_argument('--prompt-delay', type=float, default=0.1, help='seconds before the account prompt')
+    parser.add_argument('--batch-polls', type=int, default=2, help='ESTUNI/MERGER "still running" polls')
+    parser.add_argument('--poll-delay', type=float, default=0.05)
+    parser.add_argument('--exit-code', type=int, default=0)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of runs that exit with code 1')
+    parser.add_argument('--live-checks', action='store_true',
+                        help='force live /test_connection checks instead of cached health')
+    parser.add_argument('--pool-size', type=int, default=4, help='SSH connections per environment')
+    parser.add_argument('--url', help='benchmark a running app instead of importing it')
+    parser.add_argument('--ssh-port', type=int, default=0, help='fake server port (0 picks a free one)')
+    parser.add_argument('--work-dir', help='directory for logs and STAMPE files (default: temporary)')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='invoice_bench_')
+    profile = ScriptProfile(line_delay=args.line_delay, prompt_delay=args.prompt_delay,
+                            exit_code=args.exit_code, fail_rate=args.fail_rate,
+                            batch_polls=args.batch_polls, poll_delay=args.poll_delay)
+    server = FakeKenanServer(os.path.join(work_dir, 'STAMPE'), profile, port=args.ssh_port).start()
+
+    tracemalloc.start()
+    try:
+        if args.url:
+            print(f"Fake Kenan server on 127.0.0.1:{server.port}; the app at {args.url} must point at it")
+            client = HTTPClient(args.url)
+        else:
+            client = InProcessClient(prepare_app(args, server, work_dir).app)
+
+        plan = build_requests(args)
+        results, wall = run(client, plan, args.concurrency)
+        peak_traced = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = {
+        'scenario': args.scenario,
+        'requests': len(plan),
+        'concurrency': args.concurrency,
+        'wall_seconds': round(wall, 3),
+        'endpoints': summarize(results, wall),
+        # Only meaningful in-process; with --url this is the harness itself
+        'peak_traced_mb': round(peak_traced / (1024 * 1024), 1),
+        'peak_rss_mb': peak_rss_mb(),
+        'ssh_connections': server.connections,
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+    return 0 if all(row['errors'] == 0 for row in summary['endpoints'].values()) or args.fail_rate else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Event-driven collection of remote script output from a paramiko channel
+Waits on the channel itself with select instead of polling with sleeps,
+buffers output with a memory cap that spills to disk and decodes UTF-8
+incrementally so multibyte characters split across chunks are kept intact
+"""
+
+import codecs
+import re
+import selectors
+import tempfile
+import time
+
+
+class OutputBuffer:
+    """
+    Byte buffer for script output
+    Stays in memory up to spill_threshold bytes, then spills to a temporary
+    file. Anything beyond max_bytes is counted but discarded; the cut is made
+    on a character boundary.
+    """
+
+    def __init__(self, spill_threshold=1024 * 1024, max_bytes=50 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.truncated = False
+        self._file = tempfile.SpooledTemporaryFile(max_size=spill_threshold, mode='w+b')
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def write(self, data):
+        """Store a raw chunk and return the newly decodable text"""
+        room = self.max_bytes - self.size
+        if len(data) > room:
+            self.truncated = True
+            # Never keep the first bytes of a multibyte character without the rest
+            while room > 0 and data[room] & 0xC0 == 0x80:
+                room -= 1
+        if room > 0:
+            self._file.write(data[:room])
+        self.size += len(data)
+        return self._decoder.decode(data)
+
+    def finish(self):
+        """Flush any incomplete trailing sequence from the decoder"""
+        return self._decoder.decode(b'', final=True)
+
+    @property
+    def spilled(self):
+        return self._file._rolled
+
+    def getvalue(self, limit=None):
+        """
+        Return the stored output as text
+        With limit, only the last limit bytes are read, starting on a character boundary.
+        """
+        stored = self._file.tell()
+        start = max(stored - limit, 0) if limit else 0
+        self._file.seek(start)
+        data = self._file.read()
+        self._file.seek(0, 2)
+        if start:
+            skip = 0
+            while skip < min(len(data), 3) and data[skip] & 0xC0 == 0x80:
+                skip += 1
+            data = data[skip:]
+        text = data.decode('utf-8', errors='replace')
+        if start:
+            text = f"[Output too long: showing the last {len(data)} of {stored} bytes]\n" + text
+        if self.truncated:
+            text += f"\n[Output truncated: {self.size} bytes received, first {stored} kept]"
+        return text
+
+    def close(self):
+        self._file.close()
+
+
+def wait_for_prompt(channel, buffer, prompt, timeout=60, chunk_size=32768, on_text=None):
+    """
+    Read from channel until the prompt regex appears in the output
+    Output seen while waiting is stored in buffer like any other output.
+    Returns True when the prompt was seen, False on timeout or EOF.
+    """
+    pattern = re.compile(prompt)
+    deadline = time.monotonic() + timeout
+    window = ''
+    selector = selectors.DefaultSelector()
+    selector.register(channel, selectors.EVENT_READ)
+    try:
+        while True:
+            if not channel.recv_ready():
+                if channel.eof_received or channel.closed:
+                    return False
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    return False
+                continue
+
+            text = buffer.write(channel.recv(chunk_size))
+            if not text:
+                continue
+            if on_text:
+                on_text(text)
+            # Only keep enough trailing text to match a prompt split across chunks
+            window = (window + text)[-(len(text) + 512):]
+            if pattern.search(window):
+                return True
+    finally:
+        selector.close()
+
+
+def read_channel_output(channel, buffer, timeout=600, chunk_size=32768, on_text=None):
+    """
+    Read from channel until EOF, storing chunks in buffer
+    on_text(text) is called with each decoded piece as it arrives.
+    Raises TimeoutError if no EOF is seen within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    selector.register(channel, selectors.EVENT_READ)
+    try:
+        while True:
+            # Drain whatever is already buffered before waiting again
+            if not channel.recv_ready() and not channel.eof_received:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No end of output after {timeout} seconds")
+                if not selector.select(remaining):
+                    continue
+
+            data = channel.recv(chunk_size)
+            if not data:
+                break
+            text = buffer.write(data)
+            if text and on_text:
+                on_text(text)
+    finally:
+        selector.close()
+        tail = buffer.finish()
+        if tail and on_text:
+            on_text(tail)
@@ -0,0 +1,364 @@
+"""
+Multi-account Definitive runs
+Definitive.sh invoices one account per run, so every account pays for its own
+runbip, ESTUNI and multi-minute MERGER cycle. DefinitiveBatch validates a list of
+accounts and, per server_id/group_id, runs BIP once with an IN (...) selection,
+allocates the group's SIN range in one transaction and drives ESTUNI and MERGER
+once for the group. Every account gets its own outcome.
+"""
+
+import time
+
+from definitive_pipeline import (LOOKUP_DB_INDEX, SERVER_DB_INDEX, SIN_RANGES, ESTUNI_ID_LANCIO, PipelineRun,
+                                 Stage, StageFailed, format_yyyymmdd, group_for_account_types, last_batch,
+                                 reset_merger, run_merger)
+
+STATUS_PENDING = 'pending'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+STATUS_REJECTED = 'rejected'
+
+
+def bind_list(prefix, values):
+    """Placeholders and binds for an IN (...) list"""
+    binds = {f'{prefix}{i}': value for i, value in enumerate(values)}
+    return ', '.join(f':{name}' for name in binds), binds
+
+
+class AccountGroup:
+    """Accounts of one server_id/group_id that are still being processed"""
+
+    def __init__(self, server_id, group_id, accounts, statement_date=None):
+        self.server_id = server_id
+        self.group_id = group_id
+        self.accounts = list(accounts)
+        self.statement_date = statement_date
+
+    @property
+    def label(self):
+        label = f"server_id={self.server_id} group_id={self.group_id}"
+        return f"{label} statement_date={self.statement_date}" if self.statement_date else label
+
+
+class DefinitiveBatch:
+    """
+    Definitive run for many accounts
+    run() returns the outcome of every account: status (succeeded, failed or rejected),
+    the stage that stopped it, a message and the values found on the way.
+    """
+
+    def __init__(self, pipeline, environment, accounts, on_text=None, on_progress=None, timeout=None):
+        self.pipeline = pipeline
+        self.environment = environment
+        self.accounts = accounts
+        self.on_progress = on_progress
+        self.run_state = PipelineRun(pipeline, environment, '', on_text, timeout)
+        self.outcomes = {}
+        self.routed = set()
+
+    @property
+    def output(self):
+        return ''.join(self.run_state.output)
+
+    def emit(self, message):
+        self.run_state.emit(message)
+
+    def run(self):
+        try:
+            groups = self.validate()
+            for group in groups:
+                self.run_stages(group, PREPARE_STAGES)
+                for sub_group in self.split_by_statement_date(group):
+                    self.run_stages(sub_group, PROCESS_STAGES)
+        finally:
+            self.run_state.release_database()
+        return list(self.outcomes.values())
+
+    def run_stages(self, group, stages):
+        run = self.run_state
+        run.values.update(server_id=group.server_id, link_id=group.server_id - 2, group_id=group.group_id)
+        if not group.accounts:
+            return
+        try:
+            # A failed stage discards the connection, so every group checks one out again
+            run.use_database(SERVER_DB_INDEX[group.server_id])
+        except Exception as e:
+            self.emit(f"ERROR: {group.label}: database connection failed: {e}")
+            self.fail_all(group, stages[0].name, f"Database connection failed: {e}")
+            return
+        for stage in stages:
+            if not group.accounts:
+                return
+            if self.on_progress:
+                self.on_progress(f"{stage.name} for {group.label} ({len(group.accounts)} accounts)")
+            started = time.monotonic()
+            outcome = 'ok'
+            try:
+                stage.run(self, group)
+            except StageFailed as e:
+                outcome = 'error'
+                self.emit(f"ERROR: {group.label}: {e}")
+                self.fail_all(group, stage.name, str(e))
+            except Exception as e:
+                outcome = 'error'
+                self.emit(f"ERROR: {group.label}: {stage.name} failed: {e}")
+                run.release_database(discard=True)
+                self.fail_all(group, stage.name, str(e))
+            finally:
+                if self.pipeline.on_stage:
+                    self.pipeline.on_stage(f"batch_{stage.name}", time.monotonic() - started, outcome)
+
+    def query(self, query, lists=None, **binds):
+        """Run a query whose {accounts}/{sins} placeholders are filled from lists, returns all rows"""
+        sql = self.pipeline.dialect.sql(query, self.run_state.link_id)
+        placeholders = {}
+        for name, values in (lists or {}).items():
+            placeholders[name], list_binds = bind_list(name[0], values)
+            binds.update(list_binds)
+        cursor = self.run_state.conn.cursor()
+        try:
+            cursor.execute(sql.format(**placeholders) if placeholders else sql, binds)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def fail(self, group, account_no, stage, message, status=STATUS_FAILED):
+        if group and account_no in group.accounts:
+            group.accounts.remove(account_no)
+        self.outcomes[account_no].update(status=status, stage=stage, message=message)
+        self.emit(f"Account {account_no} {status} at {stage}: {message}")
+
+    def fail_all(self, group, stage, message):
+        for account_no in list(group.accounts):
+            self.fail(group, account_no, stage, message)
+
+    def validate(self):
+        """Normalize the account list, resolve every account in one query and group them"""
+        for raw in self.accounts:
+            account_no = str(raw).strip()
+            if account_no and account_no not in self.outcomes:
+                self.outcomes[account_no] = {'account_no': account_no, 'status': STATUS_PENDING,
+                                             'stage': None, 'message': None}
+        for account_no in self.outcomes:
+            if not account_no.isdigit():
+                self.fail(None, account_no, 'validate', 'Account number must be numeric', STATUS_REJECTED)
+        valid = [a for a, o in self.outcomes.items() if o['status'] == STATUS_PENDING]
+        self.emit(f"Definitive batch for {len(valid)} accounts ({len(self.outcomes) - len(valid)} rejected)")
+        if not valid:
+            return []
+
+        run = self.run_state
+        run.values.pop('link_id', None)
+        routes = self.pipeline.routes.lookup_many(self.environment, valid) if self.pipeline.routes else {}
+        rows_by_account = {account_no: [(route['server_id'], external_id_type, route['external_id'])
+                                        for external_id_type in route['external_id_types'] or [None]]
+                           for account_no, route in routes.items()}
+        if routes:
+            self.routed = set(routes)
+            self.emit(f"{len(routes)} accounts routed from the local route index")
+        missing = [account_no for account_no in valid if account_no not in routes]
+        if missing:
+            run.use_database(LOOKUP_DB_INDEX)
+            found = self.query('batch_account_map', {'accounts': missing})
+            for account_no, server_id, external_id_type, external_id in found:
+                rows_by_account.setdefault(str(account_no).strip(), []).append((server_id, external_id_type, external_id))
+            if self.pipeline.routes and found:
+                self.pipeline.routes.record(self.environment, [row for row in found if row[1] is not None])
+
+        groups = {}
+        for account_no in valid:
+            rows = rows_by_account.get(account_no)
+            if not rows or rows[0][0] is None:
+                self.fail(None, account_no, 'validate', 'Failed to fetch valid server_id', STATUS_REJECTED)
+                continue
+            server_id = int(rows[0][0])
+            if server_id not in SERVER_DB_INDEX:
+                self.fail(None, account_no, 'validate', f"Unknown server_id: {server_id}", STATUS_REJECTED)
+                continue
+            types = {str(row[1]).strip() for row in rows if row[1] is not None}
+            try:
+                group_id, account_type = group_for_account_types(types, server_id)
+            except StageFailed as e:
+                self.fail(None, account_no, 'validate', str(e), STATUS_REJECTED)
+                continue
+            self.outcomes[account_no].update(server_id=server_id, group_id=group_id, account_type=account_type,
+                                             external_id=str(rows[0][2] or '').strip().strip("'"))
+            groups.setdefault((server_id, group_id), []).append(account_no)
+
+        for (server_id, group_id), accounts in sorted(groups.items()):
+            self.emit(f"server_id={server_id} group_id={group_id}: {len(accounts)} accounts")
+        return [AccountGroup(server_id, group_id, accounts) for (server_id, group_id), accounts in sorted(groups.items())]
+
+    def split_by_statement_date(self, group):
+        """ESTUNI takes one statement date, so accounts are processed per statement date"""
+        by_date = {}
+        for account_no in group.accounts:
+            by_date.setdefault(self.outcomes[account_no]['statement_date'], []).append(account_no)
+        return [AccountGroup(group.server_id, group.group_id, accounts, statement_date)
+                for statement_date, accounts in sorted(by_date.items())]
+
+    def sin_range(self, group):
+        sins = [self.outcomes[account_no]['next_sin_seq'] for account_no in group.accounts]
+        return min(sins), max(sins)
+
+
+# Stages run once per server_id/group_id
+
+def batch_check_cmf(batch, group):
+    batch.run_state.use_database(SERVER_DB_INDEX[group.server_id])
+    batch.emit(f"Checking no_bill and date_inactive columns in cmf table for {len(group.accounts)} accounts")
+    billable = {str(row[0]).strip() for row in batch.query('batch_cmf_check', {'accounts': group.accounts})}
+    for account_no in list(group.accounts):
+        if account_no not in billable:
+            if account_no in batch.routed:
+                # The indexed route may be stale; the next run reads external_id_acct_map again
+                batch.pipeline.routes.forget(batch.environment, account_no)
+            batch.fail(group, account_no, 'check_cmf', 'Account either does not exist or is set to no_bill or '
+                                                       'date_inactive is not null in cmf table')
+
+
+def batch_run_bip(batch, group):
+    batch.emit(f"Running BIP for {len(group.accounts)} accounts")
+    selection = f"CMF.account_no IN ({', '.join(group.accounts)})"
+    exit_code, _ = batch.run_state.command(batch.pipeline.bip_command(group.server_id, selection))
+    if exit_code != 0:
+        batch.emit(f"runbip exited with code {exit_code}")
+
+
+def batch_allocate_sin(batch, group):
+    pipeline, run = batch.pipeline, batch.run_state
+    start_val, end_val = SIN_RANGES[group.group_id]
+    with pipeline.sin_lock(batch.environment, group.group_id):
+        # Rows are ordered by prep_date, so the last one per account is its latest bill
+        bills, statement_dates = {}, {}
+        for row in batch.query('batch_bills', {'accounts': group.accounts}):
+            account_no = str(row[0]).strip()
+            bills[account_no] = row[1:]
+            statement_dates[account_no] = max(statement_dates.get(account_no, row[4]), row[4])
+        for account_no in list(group.accounts):
+            if account_no not in bills:
+                batch.fail(group, account_no, 'allocate_sin', 'No valid statement_date found with prep_status=1 '
+                                                              'and no prep_error_code')
+        if not group.accounts:
+            return
+
+        row = run.fetchone('next_sin', group_id=group.group_id, start_val=start_val, end_val=end_val)
+        next_sin_seq = int(row[0])
+        ordered = sorted(group.accounts, key=lambda a: (format_yyyymmdd(statement_dates[a]), a))
+        if next_sin_seq + len(ordered) - 1 > end_val:
+            raise StageFailed(f"SIN range of group_id={group.group_id} is exhausted")
+
+        inserts = []
+        for offset, account_no in enumerate(ordered):
+            bill_ref_no, bill_ref_resets, prep_date, statement, payment_due_date = bills[account_no]
+            inserts.append({'bill_ref_no': bill_ref_no, 'bill_ref_resets': bill_ref_resets,
+                            'sin_seq': next_sin_seq + offset, 'group_id': group.group_id, 'prep_date': prep_date,
+                            'statement_date': statement, 'payment_due_date': payment_due_date})
+        cursor = run.conn.cursor()
+        try:
+            cursor.executemany(pipeline.dialect.sql('insert_sin', run.link_id), inserts)
+        except Exception:
+            run.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        run.conn.commit()
+
+    for values in inserts:
+        account_no = ordered[values['sin_seq'] - next_sin_seq]
+        batch.outcomes[account_no].update(next_sin_seq=values['sin_seq'],
+                                          statement_date=format_yyyymmdd(statement_dates[account_no]))
+    batch.emit(f"Insert completed for FULL_SIN_SEQ={next_sin_seq}..{next_sin_seq + len(ordered) - 1} "
+               f"and GROUP_ID={group.group_id}")
+
+
+# Stages run once per server_id/group_id and statement date
+
+def batch_estuni(batch, group):
+    pipeline, run = batch.pipeline, batch.run_state
+    first, last = batch.sin_range(group)
+    _, after = last_batch(run, 'ESTUNI')
+    batch.emit(f"Executing ESTUNI STARTER Command for {group.label}")
+    exit_code, _ = run.command(pipeline.estuni_command(first - 1, last, group.group_id, group.statement_date,
+                                                       group.server_id))
+    if exit_code != 0:
+        raise StageFailed("STARTER command failed.")
+    outcome, _, _ = pipeline.waiter.wait(run, 'ESTUNI', ESTUNI_ID_LANCIO, after)
+    if outcome != 'succeeded':
+        raise StageFailed("ESTUNI failed, check the log file in /appl_sw/custbill/LOG/FATTURAZIONE/ESTUNI path")
+    batch.emit("ESTUNI STARTER completed successfully. Proceeding...")
+
+
+def batch_check_post_body(batch, group):
+    statement_date = group.statement_date
+    rows = batch.query('batch_post_body', {'accounts': group.accounts},
+                       statement_date=batch.pipeline.dialect.date_value(statement_date))
+    # Ordered by full_sin_seq, so the last row per account holds its MAX(full_sin_seq)
+    found = {str(account_no).strip(): (int(full_sin_seq), amount) for account_no, full_sin_seq, amount in rows}
+    for account_no in list(group.accounts):
+        if account_no not in found:
+            batch.fail(group, account_no, 'check_post_body',
+                       f"full_sin_seq not found in crm_bil_post_body for statement_date={statement_date}")
+        elif not found[account_no][1]:
+            batch.fail(group, account_no, 'check_post_body',
+                       f"Amount is 0 in crm_bil_post_detail for full_sin_seq={found[account_no][0]}")
+        else:
+            batch.outcomes[account_no].update(full_sin_seq=found[account_no][0], amount=found[account_no][1])
+
+
+def batch_reset_merger(batch, group):
+    reset_merger(batch.pipeline, batch.run_state)
+
+
+def batch_merger(batch, group):
+    run_merger(batch.pipeline, batch.run_state)
+
+
+def batch_validate_invoice(batch, group):
+    sins = [batch.outcomes[account_no]['full_sin_seq'] for account_no in group.accounts]
+    elab = {(str(ext).strip(), int(sin)) for ext, sin in batch.query('batch_post_body_elab', {'sins': sins})}
+    fatture = {(str(ext).strip(), int(sin)) for ext, sin in batch.query('batch_fatture', {'sins': sins})}
+    for account_no in list(group.accounts):
+        outcome = batch.outcomes[account_no]
+        key = (outcome['external_id'], outcome['full_sin_seq'])
+        outcome['in_fatture_incassi'] = key in fatture
+        if key not in elab:
+            batch.fail(group, account_no, 'validate_invoice',
+                       f"No entry found in crm_bil_post_body_elab for external_id={key[0]}, full_sin_seq={key[1]}")
+
+
+def batch_text_file(batch, group):
+    run = batch.run_state
+    for account_no in list(group.accounts):
+        outcome = batch.outcomes[account_no]
+        exit_code, _ = run.command(batch.pipeline.text_file_command(account_no, outcome['external_id'],
+                                                                    outcome['full_sin_seq']))
+        if exit_code != 0:
+            batch.fail(group, account_no, 'text_file', f"text_file.sh exited with code {exit_code}")
+        else:
+            outcome.update(status=STATUS_SUCCEEDED, stage=None, message='Invoice generated')
+            batch.emit(f"Account {account_no} succeeded with FULL_SIN_SEQ={outcome['full_sin_seq']}")
+
+
+PREPARE_STAGES = (
+    Stage('check_cmf', batch_check_cmf),
+    Stage('run_bip', batch_run_bip),
+    Stage('allocate_sin', batch_allocate_sin),
+)
+
+PROCESS_STAGES = (
+    Stage('estuni', batch_estuni),
+    Stage('check_post_body', batch_check_post_body),
+    Stage('reset_merger', batch_reset_merger),
+    Stage('merger', batch_merger),
+    Stage('validate_invoice', batch_validate_invoice),
+    Stage('text_file', batch_text_file),
+)
+
+
+def summarize_outcomes(outcomes):
+    """Count of accounts per status"""
+    summary = {STATUS_SUCCEEDED: 0, STATUS_FAILED: 0, STATUS_REJECTED: 0}
+    for outcome in outcomes:
+        summary[outcome['status']] = summary.get(outcome['status'], 0) + 1
+    return summary
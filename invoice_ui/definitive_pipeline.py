@@ -0,0 +1,812 @@
+"""
+Native Definitive pipeline
+Runs the steps of Definitive.sh from Python as declarative stages over pooled
+DB-API connections. Queries use bind variables and values that the script read
+with separate sqlplus logins are fetched together, so a run costs one login per
+database and a handful of round-trips. Only runbip, STARTER and text_file.sh are
+run on the Kenan host. Progress is written as echolog lines, so the usual script
+output parsing, job progress and phase metrics work unchanged.
+
+create_standin_schema() builds the tables the pipeline uses in SQLite, so the
+stages can be exercised offline with the sqlite driver and a fake command runner.
+"""
+
+import logging
+import shlex
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import oracledb
+except ImportError:  # only needed for the Oracle driver
+    oracledb = None
+
+# Definitive.sh reads external_id_acct_map with the ARBCUST_6 credentials
+LOOKUP_DB_INDEX = 6
+
+# server_id -> customer database index (ARBCUST_n, COKCUn)
+SERVER_DB_INDEX = {3: 1, 4: 2, 5: 3, 6: 4, 7: 5, 8: 6}
+
+# SIN sequence range per group_id
+SIN_RANGES = {
+    11: (250000001, 300000000),
+    12: (300000001, 350000000),
+    13: (400000001, 450000000),
+    14: (500000001, 550000000),
+    15: (600000001, 650000000),
+    16: (800000001, 850000000),
+    31: (2500000201, 2599999999),
+    32: (3500000201, 3599999999),
+    33: (4500000201, 4599999999),
+    34: (5500000201, 5599999999),
+    35: (6500000201, 6599999999),
+    36: (8500000201, 8599999999),
+}
+
+ACCOUNT_TYPE_TV = '51'
+ACCOUNT_TYPE_BB = '61'
+LLAMA_ACCOUNT_TYPES = ('71', '81')
+
+ESTUNI_ID_LANCIO = 987654
+# MERGER ending in ERRO with this exit code has still produced the invoice
+MERGER_ACCEPTED_EXIT = '40'
+
+# SQL shared by both dialects; {kca}, {cust}, {coe}, {admin}, {trunc}, {today}
+# and {dual} are filled in per dialect and customer database link
+QUERIES = {
+    'account_map': (
+        "SELECT server_id, external_id_type, external_id FROM external_id_acct_map{kca} "
+        "WHERE account_no = :account_no"),
+    'cmf_check': (
+        "SELECT COUNT(*) FROM cmf WHERE account_no = :account_no "
+        "AND no_bill = 0 AND date_inactive IS NULL"),
+    # Latest bill of today, the statement date the script took with MAX() and the next
+    # free SIN sequence of the group in one round-trip
+    'bill_and_sin': (
+        "SELECT b.bill_ref_no, b.bill_ref_resets, b.prep_date, b.statement_date, b.payment_due_date, "
+        "MAX(b.statement_date) OVER (), "
+        "(SELECT COALESCE(MAX(s.full_sin_seq) + 1, :start_val) FROM sin_seq_no{cust} s "
+        "WHERE s.group_id = :group_id AND s.full_sin_seq BETWEEN :start_val AND :end_val) "
+        "FROM bill_invoice{cust} b WHERE b.account_no = :account_no "
+        "AND {trunc}(b.prep_date) = {today} AND b.prep_status = 1 AND b.prep_error_code IS NULL "
+        "ORDER BY b.prep_date DESC"),
+    'insert_sin': (
+        "INSERT INTO sin_seq_no{cust} (bill_ref_no, bill_ref_resets, open_item_id, sin_seq_ref_no, "
+        "sin_seq_ref_resets, full_sin_seq, group_id, prep_status, prep_date, statement_date, payment_due_date) "
+        "VALUES (:bill_ref_no, :bill_ref_resets, 0, :sin_seq, 1, :sin_seq, :group_id, 1, "
+        ":prep_date, :statement_date, :payment_due_date)"),
+    'batch_status': (
+        "SELECT code_stato_batch, code_uscita, code_id_lancio, data_ora_inizio_elab "
+        "FROM crm_bil_con_view_elab_batch "
+        "WHERE code_funzion_sist = :module AND {trunc}(data_ora_inizio_elab) = {today} "
+        "ORDER BY data_ora_inizio_elab DESC"),
+    # Latest batch of a module before a STARTER launch: the last CODE_ID_LANCIO and its start time
+    'last_batch': (
+        "SELECT code_id_lancio, data_ora_inizio_elab FROM crm_bil_con_view_elab_batch "
+        "WHERE code_funzion_sist = :module ORDER BY data_ora_inizio_elab DESC"),
+    # Every batch of today for the given modules and launch ids; {ids} is filled in per tick
+    'batch_statuses': (
+        "SELECT code_funzion_sist, code_id_lancio, code_stato_batch, code_uscita, data_ora_inizio_elab "
+        "FROM crm_bil_con_view_elab_batch "
+        "WHERE code_funzion_sist IN ('ESTUNI', 'MERGER') AND code_id_lancio IN ({{ids}}) "
+        "AND {trunc}(data_ora_inizio_elab) = {today} ORDER BY data_ora_inizio_elab"),
+    'post_body': (
+        "SELECT b.full_sin_seq, (SELECT COALESCE(SUM(d.imponibile), 0) FROM crm_bil_post_detail d "
+        "WHERE d.full_sin_seq = b.full_sin_seq AND d.statement_date = b.statement_date) "
+        "FROM crm_bil_post_body b WHERE b.account_no = :account_no AND b.statement_date = :statement_date "
+        "ORDER BY b.full_sin_seq DESC"),
+    'reset_merger': (
+        "UPDATE {admin}crm_bil_status_merger{coe} "
+        "SET num_righe = 0, status = 'OK', statement_date = :reset_date"),
+    'invoice_checks': (
+        "SELECT (SELECT COUNT(*) FROM bb_fatture_incassi "
+        "WHERE external_id = :external_id AND fattura = :full_sin_seq), "
+        "(SELECT COUNT(*) FROM crm_bil_post_body_elab{coe} "
+        "WHERE external_id = :external_id AND full_sin_seq = :full_sin_seq){dual}"),
+    # Multi-account variants for definitive_batch.py; {{accounts}} and {{sins}} are bind lists
+    'batch_account_map': (
+        "SELECT account_no, server_id, external_id_type, external_id FROM external_id_acct_map{kca} "
+        "WHERE account_no IN ({{accounts}})"),
+    'batch_cmf_check': (
+        "SELECT account_no FROM cmf WHERE account_no IN ({{accounts}}) "
+        "AND no_bill = 0 AND date_inactive IS NULL"),
+    'batch_bills': (
+        "SELECT account_no, bill_ref_no, bill_ref_resets, prep_date, statement_date, payment_due_date "
+        "FROM bill_invoice{cust} WHERE account_no IN ({{accounts}}) "
+        "AND {trunc}(prep_date) = {today} AND prep_status = 1 AND prep_error_code IS NULL "
+        "ORDER BY account_no, prep_date"),
+    'next_sin': (
+        "SELECT COALESCE(MAX(full_sin_seq) + 1, :start_val) FROM sin_seq_no{cust} "
+        "WHERE group_id = :group_id AND full_sin_seq BETWEEN :start_val AND :end_val"),
+    'batch_post_body': (
+        "SELECT b.account_no, b.full_sin_seq, (SELECT COALESCE(SUM(d.imponibile), 0) FROM crm_bil_post_detail d "
+        "WHERE d.full_sin_seq = b.full_sin_seq AND d.statement_date = b.statement_date) "
+        "FROM crm_bil_post_body b WHERE b.account_no IN ({{accounts}}) AND b.statement_date = :statement_date "
+        "ORDER BY b.account_no, b.full_sin_seq"),
+    'batch_post_body_elab': (
+        "SELECT external_id, full_sin_seq FROM crm_bil_post_body_elab{coe} WHERE full_sin_seq IN ({{sins}})"),
+    'batch_fatture': (
+        "SELECT external_id, fattura FROM bb_fatture_incassi WHERE fattura IN ({{sins}})"),
+    # Map rows activated since a watermark, for the local route index (account_routes.py)
+    # Every current row of the accounts with a row activated since the watermark, so a
+    # refresh replaces the whole route of a changed account
+    'route_changes': (
+        "SELECT account_no, server_id, external_id_type, external_id, active_date "
+        "FROM external_id_acct_map{kca} WHERE account_no IN "
+        "(SELECT account_no FROM external_id_acct_map{kca} WHERE active_date >= :since) ORDER BY account_no"),
+}
+
+
+class Dialect:
+    """SQL differences between Oracle and the SQLite stand-in"""
+
+    def __init__(self, name, tokens, ping):
+        self.name = name
+        self.tokens = tokens
+        self.ping = ping
+        self._rendered = {}
+
+    def sql(self, query, link_id=''):
+        key = (query, link_id)
+        sql = self._rendered.get(key)
+        if sql is None:
+            sql = self._rendered[key] = QUERIES[query].format(
+                **{k: v.format(link_id=link_id) for k, v in self.tokens.items()})
+        return sql
+
+    def date_value(self, yyyymmdd):
+        """Bind value for a YYYYMMDD date"""
+        value = datetime.strptime(yyyymmdd, '%Y%m%d')
+        return value if self.name == 'oracle' else value.strftime('%Y-%m-%d')
+
+    def timestamp_value(self, value):
+        """Bind value for a datetime"""
+        return value if self.name == 'oracle' else value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+ORACLE = Dialect('oracle', {
+    'kca': '@KCA1', 'cust': '@COKCU{link_id}', 'coe': '@coe111', 'admin': 'admincon.',
+    'trunc': 'TRUNC', 'today': 'TRUNC(SYSDATE)', 'dual': ' FROM dual',
+}, 'SELECT 1 FROM dual')
+
+SQLITE = Dialect('sqlite', {
+    'kca': '', 'cust': '', 'coe': '', 'admin': '',
+    'trunc': 'date', 'today': "date('now', 'localtime')", 'dual': '',
+}, 'SELECT 1')
+
+STANDIN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS external_id_acct_map (
+    account_no TEXT, external_id TEXT, external_id_type INTEGER, server_id INTEGER,
+    active_date TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS cmf (
+    account_no TEXT, no_bill INTEGER DEFAULT 0, date_inactive TEXT);
+CREATE TABLE IF NOT EXISTS bill_invoice (
+    account_no TEXT, bill_ref_no INTEGER, bill_ref_resets INTEGER, prep_date TEXT, statement_date TEXT,
+    payment_due_date TEXT, prep_status INTEGER, prep_error_code INTEGER);
+CREATE TABLE IF NOT EXISTS sin_seq_no (
+    bill_ref_no INTEGER, bill_ref_resets INTEGER, open_item_id INTEGER, sin_seq_ref_no INTEGER,
+    sin_seq_ref_resets INTEGER, full_sin_seq INTEGER, group_id INTEGER, prep_status INTEGER,
+    prep_date TEXT, statement_date TEXT, payment_due_date TEXT);
+CREATE TABLE IF NOT EXISTS crm_bil_con_view_elab_batch (
+    code_funzion_sist TEXT, code_id_lancio INTEGER, code_stato_batch TEXT, code_uscita TEXT,
+    data_ora_inizio_elab TEXT);
+CREATE TABLE IF NOT EXISTS crm_bil_post_body (
+    account_no TEXT, full_sin_seq INTEGER, statement_date TEXT);
+CREATE TABLE IF NOT EXISTS crm_bil_post_detail (
+    full_sin_seq INTEGER, statement_date TEXT, imponibile REAL);
+CREATE TABLE IF NOT EXISTS crm_bil_status_merger (
+    num_righe INTEGER, status TEXT, statement_date TEXT);
+CREATE TABLE IF NOT EXISTS bb_fatture_incassi (
+    external_id TEXT, fattura INTEGER, account_type TEXT, data_scadenza TEXT, data_emissione TEXT,
+    totale_da_pagare REAL);
+CREATE TABLE IF NOT EXISTS crm_bil_post_body_elab (
+    external_id TEXT, full_sin_seq INTEGER);
+"""
+
+
+def create_standin_schema(conn):
+    """Create the pipeline's tables in a SQLite database (links and schemas are dropped)"""
+    conn.executescript(STANDIN_SCHEMA)
+    conn.commit()
+
+
+def get_dialect(databases):
+    return SQLITE if databases.get('driver') == 'sqlite' else ORACLE
+
+
+def connect_database(databases, db_index):
+    """
+    Open a connection for customer database db_index from an environment's
+    'databases' config: {"driver": "sqlite", "path": ...} for the stand-in, otherwise
+    {"ARBCUST_n": {"user", "password", "dsn"}} entries for Oracle
+    """
+    if databases.get('driver') == 'sqlite':
+        return sqlite3.connect(databases['path'], check_same_thread=False)
+    if oracledb is None:
+        raise RuntimeError("The python Definitive backend needs the oracledb package (pip install oracledb)")
+    credentials = databases.get(f'ARBCUST_{db_index}')
+    if not credentials:
+        raise RuntimeError(f"Database ARBCUST_{db_index} is not configured")
+    return oracledb.connect(user=credentials['user'], password=credentials['password'],
+                            dsn=credentials['dsn'])
+
+
+class PoolExhausted(Exception):
+    """Raised when a database already has max_size connections checked out"""
+
+
+class DatabasePool:
+    """
+    Pooled DB-API connections keyed by (environment, database index)
+    Connections are checked out exclusively, validated with a cheap query after
+    validate_after idle seconds and closed once idle for idle_timeout seconds.
+    At most max_size connections (idle and checked out) exist per key; acquire
+    waits up to acquire_timeout seconds for one to be released.
+    """
+
+    def __init__(self, connect, max_idle=2, idle_timeout=300, validate_after=60, max_size=8, acquire_timeout=60):
+        self._connect = connect
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.validate_after = validate_after
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Condition()
+
+    def acquire(self, key, dialect):
+        self._evict_idle()
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._lock:
+                while True:
+                    idle = self._idle.get(key)
+                    if idle:
+                        conn, last_used = idle.pop()
+                        break
+                    if self._open.get(key, 0) < self.max_size:
+                        self._open[key] = self._open.get(key, 0) + 1
+                        conn = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted(f"All {self.max_size} connections to {key[0]}/{key[1]} are in use")
+                    self._lock.wait(remaining)
+            if conn is None:
+                try:
+                    return self._connect(key)
+                except Exception:
+                    self._forget(key)
+                    raise
+            if time.monotonic() - last_used < self.validate_after or self._valid(conn, dialect):
+                return conn
+            self._close(conn)
+            self._forget(key)
+
+    def release(self, key, conn, discard=False):
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if not discard and len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                self._lock.notify()
+                return
+        self._close(conn)
+        self._forget(key)
+
+    @contextmanager
+    def connection(self, key, dialect):
+        conn = self.acquire(key, dialect)
+        try:
+            yield conn
+        except Exception:
+            self.release(key, conn, discard=True)
+            raise
+        self.release(key, conn)
+
+    def stats(self):
+        with self._lock:
+            return {f'{key[0]}/{key[1]}': {'open': count, 'idle': len(self._idle.get(key, []))}
+                    for key, count in self._open.items() if count}
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            for key, conns in idle.items():
+                self._open[key] -= len(conns)
+        for conns in idle.values():
+            for conn, _ in conns:
+                self._close(conn)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, conns in self._idle.items():
+                keep = [(c, t) for c, t in conns if now - t <= self.idle_timeout]
+                stale = [c for c, t in conns if now - t > self.idle_timeout]
+                self._open[key] -= len(stale)
+                expired.extend(stale)
+                self._idle[key] = keep
+            if expired:
+                self._lock.notify_all()
+        for conn in expired:
+            self._close(conn)
+
+    def _forget(self, key):
+        """A connection of key was closed or never opened; let a waiter open another"""
+        with self._lock:
+            self._open[key] -= 1
+            self._lock.notify()
+
+    @staticmethod
+    def _valid(conn, dialect):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(dialect.ping)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class SSHCommandRunner:
+    """Runs a command on the Kenan host over a paramiko client, returns (exit_code, output)"""
+
+    def __init__(self, ssh_client, timeout=None):
+        self.ssh_client = ssh_client
+        self.timeout = timeout
+
+    def __call__(self, command, on_text=None):
+        channel = self.ssh_client.get_transport().open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.settimeout(self.timeout)
+            channel.exec_command(command)
+            channel.shutdown_write()
+            chunks = []
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                text = data.decode('utf-8', errors='replace')
+                chunks.append(text)
+                if on_text:
+                    on_text(text)
+            return channel.recv_exit_status(), ''.join(chunks)
+        finally:
+            channel.close()
+
+
+class StageFailed(Exception):
+    """A stage stopped the run; the message is written as an echolog ERROR line"""
+
+    def __init__(self, message, exit_code=1):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+class Stage:
+    def __init__(self, name, run):
+        self.name = name
+        self.run = run
+
+
+def batch_outcome(module, code_stato, code_uscita):
+    """'succeeded', 'failed' or None while an ESTUNI/MERGER batch is still running"""
+    if code_stato == 'SUCC':
+        return 'succeeded'
+    if code_stato == 'ERRO':
+        if module == 'MERGER' and str(code_uscita).strip() == MERGER_ACCEPTED_EXIT:
+            return 'succeeded'
+        return 'failed'
+    return None
+
+
+def format_yyyymmdd(value):
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y%m%d')
+    return str(value)[:10].replace('-', '')
+
+
+def group_for_account_types(types, server_id):
+    """Derive the SIN group from the account's external_id_types, returns (group_id, account_type)"""
+    if ACCOUNT_TYPE_TV in types:
+        return int(f"1{server_id - 2}"), 'TV'
+    if ACCOUNT_TYPE_BB in types:
+        return int(f"3{server_id - 2}"), 'BB'
+    if any(t in types for t in LLAMA_ACCOUNT_TYPES):
+        raise StageFailed("This is LLAMA Account, Please proceed for Wrapper LLAMA Execution, Exiting the Script")
+    raise StageFailed(f"Unsupported account types: {' '.join(sorted(types))}")
+
+
+class PipelineRun:
+    """State of one account's run: values found so far, the open connection and output"""
+
+    def __init__(self, pipeline, environment, account_no, on_text, timeout):
+        self.pipeline = pipeline
+        self.environment = environment
+        self.account_no = account_no
+        self.on_text = on_text
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.values = {}
+        self.output = []
+        self.db_key = None
+        self.conn = None
+
+    @property
+    def link_id(self):
+        return self.values.get('link_id', '')
+
+    def emit(self, message):
+        line = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {message}\n"
+        self.write(line)
+
+    def write(self, text):
+        self.output.append(text)
+        if self.on_text:
+            self.on_text(text)
+
+    def execute(self, query, **binds):
+        cursor = self.conn.cursor()
+        cursor.execute(self.pipeline.dialect.sql(query, self.link_id), binds)
+        return cursor
+
+    def fetchone(self, query, **binds):
+        cursor = self.execute(query, **binds)
+        try:
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def use_database(self, db_index):
+        """Switch the run to another customer database connection"""
+        key = (self.environment, db_index)
+        if key == self.db_key:
+            return
+        self.release_database()
+        self.conn = self.pipeline.db_pool.acquire(key, self.pipeline.dialect)
+        self.db_key = key
+
+    def release_database(self, discard=False):
+        if self.conn is not None:
+            self.pipeline.db_pool.release(self.db_key, self.conn, discard=discard)
+            self.conn = self.db_key = None
+
+    def command(self, command):
+        self.emit(f"Command: {command}")
+        return self.pipeline.run_command(command, self.write)
+
+    def sleep(self, seconds):
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise StageFailed("Timed out waiting for the batch to finish")
+            seconds = min(seconds, remaining)
+        time.sleep(seconds)
+
+
+class PollingWaiter:
+    """
+    Polls the run's own connection at a fixed interval per module, as Definitive.sh does
+    The app uses the shared batch_poller.BatchStatusPoller instead; this one needs no thread.
+    """
+
+    def __init__(self, intervals=None):
+        self.intervals = intervals or {'ESTUNI': 30, 'MERGER': 240}
+
+    def wait(self, run, module, id_lancio=None, after=None):
+        """
+        Block until the module's latest batch of today ends, returns (outcome, code_stato, code_uscita)
+        Batches that started at or before after (the snapshot taken before STARTER) are ignored.
+        """
+        while True:
+            row = run.fetchone('batch_status', module=module)
+            if row and after is not None and row[3] <= after:
+                row = None
+            code_stato, code_uscita = (str(row[0]).strip(), row[1]) if row else ('', None)
+            outcome = batch_outcome(module, code_stato, code_uscita)
+            if outcome:
+                return outcome, code_stato, code_uscita
+            run.emit(f"{module} STARTER still running or unknown status ('{code_stato}'). Waiting...")
+            run.sleep(self.intervals.get(module, 30))
+
+
+# Stages, in Definitive.sh order
+
+def resolve_account(pipeline, run):
+    run.emit(f"Fetching server_id for account_no={run.account_no}")
+    route = pipeline.routes.lookup(run.environment, run.account_no) if pipeline.routes else None
+    if route:
+        run.emit("Using server_id and external_id_type from the local route index")
+        rows = [(route['server_id'], external_id_type, route['external_id'])
+                for external_id_type in route['external_id_types']] or [(route['server_id'], None, route['external_id'])]
+        run.values['route_cached'] = True
+    else:
+        run.use_database(LOOKUP_DB_INDEX)
+        cursor = run.execute('account_map', account_no=run.account_no)
+        rows = cursor.fetchall()
+        cursor.close()
+        if pipeline.routes and rows and rows[0][0] is not None:
+            pipeline.routes.record(run.environment, [(run.account_no,) + tuple(row) for row in rows])
+    if not rows or rows[0][0] is None:
+        raise StageFailed("Failed to fetch valid server_id. Check if table exists and account_no is valid.")
+    server_id = int(rows[0][0])
+    run.emit(f"server_id={server_id}")
+    if server_id not in SERVER_DB_INDEX:
+        raise StageFailed(f"Unknown server_id: {server_id}")
+
+    types = {str(row[1]).strip() for row in rows if row[1] is not None}
+    run.emit("Checking the External_ID_Type of the account")
+    run.emit(f"Account has types: {' '.join(sorted(types))}")
+    group_id, account_type = group_for_account_types(types, server_id)
+    if ACCOUNT_TYPE_TV in types and ACCOUNT_TYPE_BB in types:
+        run.emit("Account has both TV and BB. Defaulting to TV.")
+    else:
+        run.emit(f"Account type: {account_type}")
+
+    run.values.update(server_id=server_id, db_index=SERVER_DB_INDEX[server_id], link_id=server_id - 2,
+                      group_id=group_id, external_id=str(rows[0][2] or '').strip().strip("'"))
+
+
+def check_cmf(pipeline, run):
+    run.use_database(run.values['db_index'])
+    run.emit("Checking no_bill and date_inactive columns in cmf table")
+    count = run.fetchone('cmf_check', account_no=run.account_no)[0]
+    if not count:
+        if run.values.get('route_cached'):
+            # The indexed route may be stale; the next run reads external_id_acct_map again
+            pipeline.routes.forget(run.environment, run.account_no)
+        raise StageFailed("Account either does not exist or is set to no_bill or date_inactive is not null "
+                          "in cmf table. Kindly check your account.")
+    run.emit("no_bill=0 and date_inactive is null in cmf table, Proceeding further steps")
+
+
+def run_bip(pipeline, run):
+    run.emit("Running BIP for the Test Account")
+    exit_code, _ = run.command(pipeline.bip_command(run.values['server_id'],
+                                                    f"CMF.account_no = {run.account_no}"))
+    # Like the script, a failed BIP shows up as a missing bill_invoice row in the next stage
+    if exit_code != 0:
+        run.emit(f"runbip exited with code {exit_code}")
+
+
+def allocate_sin(pipeline, run):
+    group_id = run.values['group_id']
+    start_val, end_val = SIN_RANGES[group_id]
+    run.emit("Fetching statement date")
+    # One process-wide lock per group, so concurrent runs do not read the same MAX(full_sin_seq)
+    with pipeline.sin_lock(run.environment, group_id):
+        row = run.fetchone('bill_and_sin', account_no=run.account_no, group_id=group_id,
+                           start_val=start_val, end_val=end_val)
+        if not row or row[5] is None:
+            raise StageFailed(f"No valid statement_date found for account_no={run.account_no} with prep_status=1 "
+                              "and no prep_error_code.Kindly check the bill_invoice table and log file for "
+                              "/appl_sw/kenan_sw/KFX4.0-1/data/log, Exiting now.")
+        bill_ref_no, bill_ref_resets, prep_date, statement, payment_due_date, max_statement, next_sin_seq = row
+        statement_date = format_yyyymmdd(max_statement)
+        next_sin_seq = int(next_sin_seq)
+        run.emit(f"statement_date={statement_date}")
+        run.emit(f"Next SIN sequence: {next_sin_seq}")
+        run.emit(f"Fetched BILL_REF_NO={bill_ref_no}, BILL_REF_RESETS={bill_ref_resets}, PREP_DATE={prep_date}, "
+                 f"STATEMENT_DATE={statement}, PAYMENT_DUE_DATE={payment_due_date}")
+
+        run.emit("Inserting new SIN sequence record into SIN_SEQ_NO")
+        cursor = run.execute('insert_sin', bill_ref_no=bill_ref_no, bill_ref_resets=bill_ref_resets,
+                             sin_seq=next_sin_seq, group_id=group_id, prep_date=prep_date,
+                             statement_date=statement, payment_due_date=payment_due_date)
+        inserted = cursor.rowcount
+        cursor.close()
+        if inserted != 1:
+            run.conn.rollback()
+            raise StageFailed("Insert into SIN_SEQ_NO failed.")
+        run.conn.commit()
+    run.emit(f"Insert completed for FULL_SIN_SEQ={next_sin_seq} and GROUP_ID={group_id}")
+    run.values.update(statement_date=statement_date, next_sin_seq=next_sin_seq)
+
+
+def last_batch(run, module):
+    """(code_id_lancio, start time) of the module's latest batch, (None, None) when there is none"""
+    row = run.fetchone('last_batch', module=module)
+    return (row[0], row[1]) if row else (None, None)
+
+
+def run_estuni(pipeline, run):
+    values = run.values
+    _, after = last_batch(run, 'ESTUNI')
+    run.emit("Executing ESTUNI STARTER Command")
+    exit_code, _ = run.command(pipeline.estuni_command(values['next_sin_seq'] - 1, values['next_sin_seq'],
+                                                       values['group_id'], values['statement_date'],
+                                                       values['server_id']))
+    if exit_code != 0:
+        raise StageFailed("STARTER command failed.")
+    run.emit("STARTER command executed successfully.")
+    run.emit("Waiting for ESTUNI STARTER command to complete...")
+    outcome, _, _ = pipeline.waiter.wait(run, 'ESTUNI', ESTUNI_ID_LANCIO, after)
+    if outcome != 'succeeded':
+        run.emit("ESTUNI STARTER failed with ERRO status. Exiting script.Check the log file in "
+                 "/appl_sw/custbill/LOG/FATTURAZIONE/ESTUNI path")
+        raise StageFailed("ESTUNI failed")
+    run.emit("ESTUNI STARTER completed successfully. Proceeding...")
+
+
+def check_post_body(pipeline, run):
+    statement_date = run.values['statement_date']
+    run.emit("check entry is there in crm_bil_post_body table and if entry is there, fetching the full_sin_seq")
+    row = run.fetchone('post_body', account_no=run.account_no,
+                       statement_date=pipeline.dialect.date_value(statement_date))
+    if not row or row[0] is None:
+        raise StageFailed(f"full_sin_seq not found for account_no={run.account_no} and "
+                          f"statement_date={statement_date}. Exiting.")
+    full_sin_seq, amount = int(row[0]), row[1]
+    run.emit(f"full_sin_seq={full_sin_seq}")
+    run.emit(f"Amount={amount}")
+    if not amount:
+        raise StageFailed(f"Amount is 0 in crm_bil_post_detail for full_sin_seq={full_sin_seq} and "
+                          f"statement_date={statement_date}.Check the log file in "
+                          "/appl_sw/custbill/LOG/FATTURAZIONE/ESTUNI path. Exiting the script.")
+    run.values['full_sin_seq'] = full_sin_seq
+
+
+def reset_merger(pipeline, run):
+    cursor = run.execute('reset_merger', reset_date=pipeline.dialect.date_value('19600101'))
+    cursor.close()
+    run.conn.commit()
+    run.emit("Updation in CRM_BIL_STATUS_MERGER table completed in admincon DB")
+    exit_code, _ = run.command(pipeline.clear_sqlloader_command())
+    if exit_code != 0:
+        raise StageFailed("Directory not found!, Exiting the Script")
+
+
+def run_merger(pipeline, run):
+    run.emit("Checking latest MERGER batch info...")
+    last_id, after = last_batch(run, 'MERGER')
+    id_lancio = int(last_id) + 1 if last_id is not None else 1
+    run.emit(f"Next CODE_ID_LANCIO: {id_lancio}")
+    command = pipeline.merger_command(run.values['server_id'], id_lancio)
+    run.emit(f"Executing MERGER STARTER: {command}")
+    exit_code, _ = pipeline.run_command(command, run.write)
+    if exit_code != 0:
+        raise StageFailed("Merger STARTER command failed.")
+    run.emit("Merger STARTER command executed successfully.")
+    run.emit("Waiting for MERGER STARTER command to complete...")
+    outcome, code_stato, code_uscita = pipeline.waiter.wait(run, 'MERGER', id_lancio, after)
+    if outcome != 'succeeded':
+        run.emit(f"MERGER STARTER failed (CODE_STATO='{code_stato}', CODE_USCITA='{code_uscita}'). Exiting script.")
+        raise StageFailed("MERGER failed, check the log file in /appl_sw/custbill/LOG/FATTURAZIONE/MERGER path")
+    run.emit("MERGER STARTER completed successfully. Proceeding...")
+
+
+def validate_invoice(pipeline, run):
+    external_id, full_sin_seq = run.values['external_id'], run.values['full_sin_seq']
+    run.emit(f"Validating entry in bb_fatture_incassi for external_id='{external_id}'")
+    fatture, elab = run.fetchone('invoice_checks', external_id=external_id, full_sin_seq=full_sin_seq)
+    if fatture:
+        run.emit(f"Entry is present in bb_fatture_incassi for external_id={external_id} and fattura={full_sin_seq}")
+    else:
+        run.emit(f"No entry present in bb_fatture_incassi for external_id={external_id} and fattura={full_sin_seq}")
+    if not elab:
+        raise StageFailed(f"No entry found for external_id={external_id}, full_sin_seq={full_sin_seq}. "
+                          "Check Estuni and Merger execution.")
+    run.emit("External_id found in the crm_bil_post_body_elab table")
+
+
+def generate_text_file(pipeline, run):
+    run.release_database()
+    run.emit("Upto Merger action completed.Now text file generation process steps will get start")
+    exit_code, _ = run.command(pipeline.text_file_command(run.account_no, run.values['external_id'],
+                                                          run.values['full_sin_seq']))
+    if exit_code != 0:
+        raise StageFailed(f"text_file.sh exited with code {exit_code}", exit_code)
+
+
+STAGES = (
+    Stage('resolve_account', resolve_account),
+    Stage('check_cmf', check_cmf),
+    Stage('run_bip', run_bip),
+    Stage('allocate_sin', allocate_sin),
+    Stage('estuni', run_estuni),
+    Stage('check_post_body', check_post_body),
+    Stage('reset_merger', reset_merger),
+    Stage('merger', run_merger),
+    Stage('validate_invoice', validate_invoice),
+    Stage('text_file', generate_text_file),
+)
+
+_SIN_LOCKS = {}
+_SIN_LOCKS_GUARD = threading.Lock()
+
+
+class DefinitivePipeline:
+    """
+    Runs STAGES for one account
+    run_command(command, on_text) -> (exit_code, output) executes the Kenan-side
+    commands, normally an SSHCommandRunner. on_stage(name, seconds, outcome) is
+    called after every stage.
+    """
+
+    def __init__(self, db_pool, dialect, run_command, waiter=None, on_stage=None, stages=STAGES, routes=None,
+                 arborbin='/appl_sw/kenan_sw/KFX4.0-1/bin', starter='/appl_sw/custbill/BIN/STARTER',
+                 text_file_script='/appl_sw/custbill/BIN/Testing/text_file.sh',
+                 merger_dir='/appl_sw/custbill/LOG/FATTURAZIONE/MERGER/DEFINITIVO', logger=None):
+        self.db_pool = db_pool
+        self.dialect = dialect
+        self.run_command = run_command
+        self.waiter = waiter or PollingWaiter()
+        self.on_stage = on_stage
+        self.stages = stages
+        self.routes = routes
+        self.arborbin = arborbin
+        self.starter = starter
+        self.text_file_script = text_file_script
+        self.merger_dir = merger_dir
+        self.logger = logger or logging.getLogger(__name__)
+
+    def run(self, environment, account_no, on_text=None, timeout=None):
+        """Run every stage, returns (exit_code, output, values)"""
+        run = PipelineRun(self, environment, str(account_no).strip(), on_text, timeout)
+        exit_code = 0
+        try:
+            for stage in self.stages:
+                started = time.monotonic()
+                outcome = 'ok'
+                try:
+                    stage.run(self, run)
+                except StageFailed as e:
+                    outcome = 'error'
+                    run.emit(f"ERROR: {e}")
+                    exit_code = e.exit_code
+                    break
+                except Exception as e:
+                    outcome = 'error'
+                    run.emit(f"ERROR: {stage.name} failed: {e}")
+                    run.release_database(discard=True)
+                    exit_code = 1
+                    break
+                finally:
+                    if self.on_stage:
+                        self.on_stage(stage.name, time.monotonic() - started, outcome)
+        finally:
+            run.release_database()
+        return exit_code, ''.join(run.output), run.values
+
+    @staticmethod
+    def sin_lock(environment, group_id):
+        with _SIN_LOCKS_GUARD:
+            return _SIN_LOCKS.setdefault((environment, group_id), threading.Lock())
+
+    def bip_command(self, server_id, selection):
+        return (f"ARBORBIN={shlex.quote(self.arborbin)}; export ARBORBIN; "
+                f"\"$ARBORBIN/runbip\" bip01 0 {int(server_id)} {shlex.quote(selection)}")
+
+    def estuni_command(self, sin_seq, next_sin_seq, group_id, statement_date, server_id):
+        args = (f"CO$ESTUNI$AP$_$D${int(sin_seq)}${int(next_sin_seq)}$1${int(group_id)}${statement_date}"
+                f"$1$0$CUST_ID={int(server_id)}$ID_LANCIO={ESTUNI_ID_LANCIO}$2$M")
+        return f"{shlex.quote(self.starter)} {shlex.quote(args)}"
+
+    def merger_command(self, server_id, id_lancio):
+        args = f"CI$MERGER$AP$_$2$0$CUST_ID={int(server_id)}$ID_LANCIO={int(id_lancio)}$1$M"
+        return f"{shlex.quote(self.starter)} {shlex.quote(args)}"
+
+    def clear_sqlloader_command(self):
+        return f"cd {shlex.quote(self.merger_dir)} && rm -f -- *.SQLLOADER"
+
+    def text_file_command(self, account_no, external_id, full_sin_seq):
+        return " ".join(shlex.quote(str(arg)) for arg in
+                        (self.text_file_script, account_no, external_id, full_sin_seq))
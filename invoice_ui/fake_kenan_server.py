@@ -0,0 +1,316 @@
+"""
+Local SSH server standing in for a Kenan host, for benchmarks and offline checks
+Built on paramiko's server interface. It emulates Definitive.sh/Proforma.sh:
+the account prompt in interactive shells (or the account as first argument
+with exec), echolog-style timestamped output streamed with configurable
+delays, a configurable exit code, and an invoice .txt file written to a local
+STAMPE directory. SFTP is served from the local filesystem so the invoice
+index and downloads can be exercised too.
+"""
+
+import hashlib
+import os
+import random
+import shlex
+import socket
+import threading
+import time
+from datetime import datetime
+
+import paramiko
+
+# paramiko sends the reply to a shell/exec request after the check_* method
+# returns; handlers wait this long so their output and close come after it
+REPLY_GRACE = 0.01
+
+PROMPTS = {
+    'Definitive': 'Enter the Account no to run Definitive: ',
+    'Proforma': 'Enter the Account no to run Proforma: ',
+}
+
+
+class ScriptProfile:
+    """How the emulated script behaves"""
+
+    def __init__(self, line_delay=0.01, prompt_delay=0.1, exit_code=0, fail_rate=0.0,
+                 batch_polls=2, poll_delay=0.05, write_invoice=True):
+        self.line_delay = line_delay
+        self.prompt_delay = prompt_delay
+        self.exit_code = exit_code
+        self.fail_rate = fail_rate
+        self.batch_polls = batch_polls
+        self.poll_delay = poll_delay
+        self.write_invoice = write_invoice
+
+
+def echolog(message):
+    return f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {message}\n"
+
+
+def definitive_steps(account_no, profile):
+    """(line, delay) pairs mirroring the echolog output of Definitive.sh"""
+    server_id = 3 + int(account_no) % 6 if account_no.isdigit() else 3
+    # Odd accounts are broadband (external_id_type 61), even ones TV (51); groups as derived by Definitive.sh
+    if account_no.isdigit() and int(account_no) % 2:
+        external_id_type, account_type, group_id = 61, 'BB', int(f"3{server_id - 2}")
+    else:
+        external_id_type, account_type, group_id = 51, 'TV', int(f"1{server_id - 2}")
+    next_sin_seq = 100000000 * (server_id - 2) + random.randint(1000, 9999)
+    statement_date = datetime.now().strftime('%Y%m%d')
+    external_id = f"EXT{account_no}"
+    lines = [
+        f"Fetching server_id for account_no={account_no}",
+        f"server_id={server_id}",
+        "Checking the External_ID_Type of the account",
+        f"Account has types: {external_id_type}",
+        f"Account type: {account_type}",
+        "Checking no_bill and date_inactive columns in cmf table",
+        "no_bill=0 and date_inactive is null in cmf table, Proceeding further steps",
+        "Running BIP for the Test Account",
+        "Fetching statement date",
+        f"statement_date={statement_date}",
+        f"Fetching next SIN sequence for group_id={group_id}",
+        f"Next SIN sequence: {next_sin_seq}",
+        f"Fetching billing details from bill_invoice for account_no={account_no}",
+        f"Fetched BILL_REF_NO={random.randint(10**8, 10**9)}, BILL_REF_RESETS=0, PREP_DATE={statement_date}, "
+        f"STATEMENT_DATE={statement_date}, PAYMENT_DUE_DATE={statement_date}",
+        "Inserting new SIN sequence record into SIN_SEQ_NO",
+        f"Insert completed for FULL_SIN_SEQ={next_sin_seq} and GROUP_ID={group_id}",
+        "Checking the full_sin_seq in bill_invoice & sin_seq_no tables",
+        "Query executed successfully, Entry is there.",
+        "Executing ESTUNI STARTER Command",
+        f"{next_sin_seq - 1}",
+        "STARTER command executed successfully.",
+        "Checking CRM_BIL_CON_VIEW_ELAB_BATCH",
+        "Waiting for ESTUNI STARTER command to complete...",
+    ]
+    steps = [(line, profile.line_delay) for line in lines]
+    steps += [("ESTUNI STARTER still running or unknown status ('ELAB'). Waiting...", profile.poll_delay)] * profile.batch_polls
+    steps += [(line, profile.line_delay) for line in [
+        "ESTUNI STARTER completed successfully. Proceeding...",
+        "check entry is there in crm_bil_post_body table and if entry is there, fetching the full_sin_seq",
+        "check entry is there in crm_bil_post_deatil table",
+        "Rows found in crm_bil_post_detail. Proceeding...",
+        "Updation in CRM_BIL_STATUS_MERGER table completed in admincon DB",
+        "Checking latest MERGER batch info...",
+        f"Next CODE_ID_LANCIO: {random.randint(1000, 9999)}",
+        "Merger STARTER command executed successfully.",
+        "Checking CRM_BIL_CON_VIEW_ELAB_BATCH table",
+        "Waiting for MERGER STARTER command to complete...",
+    ]]
+    steps += [("MERGER STARTER still running or unknown status ('ELAB'). Waiting...", profile.poll_delay)] * profile.batch_polls
+    steps += [(line, profile.line_delay) for line in [
+        "MERGER STARTER completed successfully. Proceeding...",
+        f"Fetching external_id for the account_no={account_no}",
+        f"Validating entry in bb_fatture_incassi for external_id='{external_id}'",
+        f"Entry is present in bb_fatture_incassi for external_id={external_id} and fattura={next_sin_seq}",
+        "Checking if External_id exists in crm_bil_post_body_elab table",
+        "External_id found in the crm_bil_post_body_elab table",
+        "Upto Merger action completed.Now text file generation process steps will get start",
+    ]]
+    file_name = f"{statement_date}_BILR_{external_id}_{next_sin_seq % 100000:05d}_N.txt"
+    return steps, external_id, file_name
+
+
+def proforma_steps(account_no, profile):
+    """(line, delay) pairs for a Proforma run"""
+    external_id = f"PF{account_no}"
+    today = datetime.now().strftime('%Y%m%d')
+    lines = [
+        f"Fetching server_id for account_no={account_no}",
+        f"server_id={3 + int(account_no) % 6 if account_no.isdigit() else 3}",
+        "Running BIP for the Test Account",
+        f"statement_date={today}",
+        f"external_id={external_id}",
+        "Proforma text file generation completed",
+    ]
+    file_name = f"{external_id}_{today}_{datetime.now().strftime('%Y%m%d%H%M%S')}.txt"
+    return [(line, profile.line_delay) for line in lines], external_id, file_name
+
+
+class FakeKenanServer:
+    """Threaded SSH server on 127.0.0.1; call start() and point ENVIRONMENTS at .port"""
+
+    def __init__(self, stampe_dir, profile=None, host='127.0.0.1', port=0):
+        self.stampe_dir = stampe_dir
+        self.profile = profile or ScriptProfile()
+        self.host = host
+        self.port = port
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.connections = 0
+        self.runs = 0
+        self._sock = None
+        self._stopped = threading.Event()
+        os.makedirs(stampe_dir, exist_ok=True)
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen(100)
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept_loop, name='fake-kenan-accept', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._sock:
+            self._sock.close()
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServer)
+            try:
+                transport.start_server(server=_ServerInterface(self))
+            except Exception:
+                transport.close()
+
+    def run_script(self, channel, script_path, account_no=None):
+        """Emulate an invoice script on channel and return its exit code"""
+        invoice_type = 'Proforma' if 'proforma' in os.path.basename(script_path).lower() else 'Definitive'
+        profile = self.profile
+        if account_no is None:
+            time.sleep(profile.prompt_delay)
+            channel.send(PROMPTS[invoice_type].encode())
+            account_no = _read_line(channel)
+        self.runs += 1
+
+        build = definitive_steps if invoice_type == 'Definitive' else proforma_steps
+        steps, external_id, file_name = build(account_no.strip(), profile)
+        exit_code = profile.exit_code
+        if exit_code == 0 and profile.fail_rate and random.random() < profile.fail_rate:
+            exit_code = 1
+            steps = steps[:len(steps) // 2] + [("ERROR: STARTER command failed.", 0)]
+
+        for line, delay in steps:
+            if delay:
+                time.sleep(delay)
+            channel.send(echolog(line).encode())
+
+        if exit_code == 0 and profile.write_invoice:
+            with open(os.path.join(self.stampe_dir, file_name), 'w') as f:
+                f.write(f"INVOICE {external_id} {account_no}\n" * 200)
+        return exit_code
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=self._shell, args=(channel,), daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _shell(self, channel):
+        time.sleep(REPLY_GRACE)
+        # The app sends "bash <script>; exit $?"
+        words = shlex.split(_read_line(channel).split(';')[0])
+        code = self.server.run_script(channel, words[-1]) if words else 127
+        _finish(channel, code)
+
+    def _exec(self, channel, command):
+        time.sleep(REPLY_GRACE)
+        words = shlex.split(command)
+        if words[:1] == ['echo']:
+            channel.send((' '.join(words[1:]) + '\n').encode())
+            code = 0
+        elif words[:1] == ['sha256sum'] and words[-1] and os.path.exists(words[-1]):
+            with open(words[-1], 'rb') as f:
+                channel.send(f"{hashlib.sha256(f.read()).hexdigest()}  {words[-1]}\n".encode())
+            code = 0
+        elif words[:1] == ['bash'] and len(words) >= 2:
+            code = self.server.run_script(channel, words[1], words[2] if len(words) > 2 else None)
+        else:
+            channel.send_stderr(f"{words[0] if words else ''}: command not found\n".encode())
+            code = 127
+        _finish(channel, code)
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """Read-only SFTP over the local filesystem"""
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            handle = paramiko.SFTPHandle(flags)
+            handle.readfile = open(path, 'rb')
+            return handle
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+def _read_line(channel):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = channel.recv(1)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode(errors='replace').strip()
+
+
+def _finish(channel, code):
+    try:
+        channel.send_exit_status(code)
+    finally:
+        channel.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the fake Kenan SSH server')
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--stampe-dir', default=os.path.join(os.path.dirname(__file__), 'bench_stampe'))
+    parser.add_argument('--line-delay', type=float, default=0.01)
+    parser.add_argument('--exit-code', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeKenanServer(args.stampe_dir, ScriptProfile(line_delay=args.line_delay, exit_code=args.exit_code),
+                             port=args.port).start()
+    print(f"Fake Kenan server listening on 127.0.0.1:{server.port}, STAMPE dir {args.stampe_dir}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
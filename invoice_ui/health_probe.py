@@ -0,0 +1,135 @@
+"""
+Background health probing of environments
+Each configured environment is checked on an interval with random jitter;
+failing environments are retried with exponential backoff. The latest status,
+round-trip latency and error are cached so connection tests answer at once.
+An environment whose connections are all taken by running invoices is reported
+as busy, without backing off.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_UNKNOWN = 'unknown'
+STATUS_UNCONFIGURED = 'unconfigured'
+STATUS_BUSY = 'busy'
+
+
+class EnvironmentBusy(Exception):
+    """Raised by a check that could not run because the environment is fully in use"""
+
+
+class HealthProber:
+    """
+    Periodically runs check(env_key, env_config) -> (ok, error) for every environment
+    get_environments() is called on each tick so configuration changes are picked up.
+    """
+
+    def __init__(self, check, get_environments, interval=60, jitter=0.2, max_backoff=600,
+                 max_workers=4, logger=None):
+        self.check = check
+        self.get_environments = get_environments
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self._results = {}
+        self._next_due = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='health-probe')
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='health-prober', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+    def status(self, env_key):
+        """Cached result for an environment"""
+        with self._lock:
+            result = self._results.get(env_key)
+            return dict(result) if result else {'environment': env_key, 'status': STATUS_UNKNOWN}
+
+    def statuses(self):
+        return {env_key: self.status(env_key) for env_key in self.get_environments()}
+
+    def probe(self, env_key, env_config):
+        """Check an environment now, update the cache and return the result"""
+        if not env_config.get('host'):
+            result = {'environment': env_key, 'status': STATUS_UNCONFIGURED,
+                      'error': 'Server host not configured', 'latency_ms': None,
+                      'checked_at': time.time(), 'consecutive_failures': 0}
+            with self._lock:
+                self._results[env_key] = result
+                self._next_due[env_key] = time.monotonic() + self.interval
+            return dict(result)
+
+        started = time.monotonic()
+        busy = None
+        try:
+            ok, error = self.check(env_key, env_config)
+        except EnvironmentBusy as e:
+            ok, error, busy = True, None, str(e)
+        except Exception as e:
+            ok, error = False, str(e)
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+
+        with self._lock:
+            previous = self._results.get(env_key, {})
+            failures = 0 if ok else previous.get('consecutive_failures', 0) + 1
+            result = {
+                'environment': env_key,
+                'status': STATUS_BUSY if busy else STATUS_OK if ok else STATUS_ERROR,
+                'error': busy if busy else None if ok else error,
+                'latency_ms': None if busy else latency_ms,
+                'checked_at': time.time(),
+                'consecutive_failures': failures,
+            }
+            self._results[env_key] = result
+            self._next_due[env_key] = time.monotonic() + self._delay(failures)
+        if not ok and failures == 1:
+            self.logger.warning(f"Health check failed for {env_key}: {error}")
+        return dict(result)
+
+    def _delay(self, failures):
+        """Seconds until the next check, backing off while an environment keeps failing"""
+        delay = min(self.interval * (2 ** failures), self.max_backoff) if failures else self.interval
+        return max(1.0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def _loop(self):
+        # Spread the first round of checks over a few seconds
+        with self._lock:
+            for env_key in self.get_environments():
+                self._next_due.setdefault(env_key, time.monotonic() + random.uniform(0, 5))
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for env_key, env_config in list(self.get_environments().items()):
+                with self._lock:
+                    due = self._next_due.setdefault(env_key, now)
+                    if due > now or env_key in self._running:
+                        continue
+                    self._running.add(env_key)
+                try:
+                    self._executor.submit(self._run_probe, env_key, env_config)
+                except RuntimeError:
+                    return
+            self._stop.wait(1)
+
+    def _run_probe(self, env_key, env_config):
+        try:
+            self.probe(env_key, env_config)
+        finally:
+            with self._lock:
+                self._running.discard(env_key)
@@ -0,0 +1,171 @@
+"""
+Incremental index of invoice files in a remote output directory
+Built from SFTP listdir_attr results: only directories whose mtime changed
+since the previous scan are listed again, and invoice file names are parsed
+into a lookup keyed by external_id
+Examples:
+  Definitive: 20240101_BILR_60784_00001_N.txt (60784 is external_id)
+  Proforma: FZ______FN_8_20211001_20260202165856.txt (FZ______FN_8 is external_id)
+"""
+
+import posixpath
+import re
+import stat
+import threading
+import time
+
+DEFINITIVE_PATTERN = re.compile(r'^(?P<date>\d{8})_BILR_(?P<external_id>[^_]+)_(?P<seq>[^_]+)_(?P<flag>[^_.]+)\.txt$')
+PROFORMA_PATTERN = re.compile(r'^(?P<external_id>.+)_(?P<date>\d{8})_(?P<timestamp>\d{14})\.txt$')
+
+
+class InvoiceFile:
+    """A parsed invoice file entry"""
+
+    __slots__ = ('path', 'name', 'mtime', 'size', 'invoice_type', 'external_id', 'date')
+
+    def __init__(self, path, mtime, size):
+        self.path = path
+        self.name = posixpath.basename(path)
+        self.mtime = mtime
+        self.size = size
+        self.invoice_type, self.external_id, self.date = parse_invoice_name(self.name)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def parse_invoice_name(name):
+    """Return (invoice_type, external_id, date) parsed from an invoice file name"""
+    match = DEFINITIVE_PATTERN.match(name)
+    if match:
+        return 'Definitive', match.group('external_id'), match.group('date')
+    match = PROFORMA_PATTERN.match(name)
+    if match:
+        return 'Proforma', match.group('external_id'), match.group('date')
+    return None, None, None
+
+
+class RemoteInvoiceIndex:
+    """
+    Index of *.txt files under one remote output path
+    The root directory is listed on every refresh because new invoices land
+    there; sub-directories are only listed again when their mtime changes.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path.rstrip('/') or '/'
+        self.files = {}
+        self.by_external_id = {}
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self.last_refresh = None
+        self.last_refresh_stats = {}
+
+    def refresh(self, sftp):
+        """Apply changes since the previous scan, returns number of new or changed files"""
+        with self._lock:
+            stats = {'listed_dirs': 0, 'skipped_dirs': 0, 'changed_files': 0, 'removed_files': 0}
+            seen_dirs = set()
+            self._scan_dir(sftp, self.output_path, None, stats, seen_dirs)
+            for path in [p for p in self._dirs if p not in seen_dirs]:
+                self._drop_dir(path, stats)
+            self.last_refresh = time.time()
+            self.last_refresh_stats = stats
+            return stats['changed_files']
+
+    def _scan_dir(self, sftp, path, mtime, stats, seen_dirs):
+        seen_dirs.add(path)
+        known = self._dirs.get(path)
+        if known is not None and mtime is not None and known['mtime'] == mtime:
+            # Unchanged directory: only its sub-directories can hold changes
+            stats['skipped_dirs'] += 1
+            for subdir in list(known['subdirs']):
+                sub_attr = sftp.stat(subdir)
+                self._scan_dir(sftp, subdir, sub_attr.st_mtime, stats, seen_dirs)
+            return
+
+        stats['listed_dirs'] += 1
+        entries = sftp.listdir_attr(path)
+        files, subdirs = set(), {}
+        for attr in entries:
+            child = posixpath.join(path, attr.filename)
+            if stat.S_ISDIR(attr.st_mode or 0):
+                subdirs[child] = attr.st_mtime
+            elif attr.filename.endswith('.txt'):
+                files.add(child)
+                existing = self.files.get(child)
+                if existing is None or existing.mtime != attr.st_mtime or existing.size != attr.st_size:
+                    self._add_file(InvoiceFile(child, attr.st_mtime, attr.st_size))
+                    stats['changed_files'] += 1
+
+        if known is not None:
+            for child in known['files'] - files:
+                self._remove_file(child)
+                stats['removed_files'] += 1
+
+        self._dirs[path] = {'mtime': mtime, 'files': files, 'subdirs': set(subdirs)}
+        for subdir, sub_mtime in subdirs.items():
+            self._scan_dir(sftp, subdir, sub_mtime, stats, seen_dirs)
+
+    def _drop_dir(self, path, stats):
+        for child in self._dirs.pop(path)['files']:
+            self._remove_file(child)
+            stats['removed_files'] += 1
+
+    def _add_file(self, entry):
+        self._remove_file(entry.path)
+        self.files[entry.path] = entry
+        if entry.external_id:
+            self.by_external_id.setdefault(entry.external_id, []).append(entry)
+
+    def _remove_file(self, path):
+        entry = self.files.pop(path, None)
+        if entry and entry.external_id:
+            entries = self.by_external_id.get(entry.external_id, [])
+            if entry in entries:
+                entries.remove(entry)
+            if not entries:
+                self.by_external_id.pop(entry.external_id, None)
+
+    def find(self, external_id=None, invoice_type=None, since=None):
+        """
+        Newest invoice file matching external_id and invoice_type
+        Only files modified at or after since (epoch seconds) are considered.
+        """
+        with self._lock:
+            candidates = self.by_external_id.get(external_id, []) if external_id else self.files.values()
+            matches = [f for f in candidates
+                       if (since is None or f.mtime >= since)
+                       and (invoice_type is None or f.invoice_type in (None, invoice_type))]
+            return max(matches, key=lambda f: f.mtime, default=None)
+
+    def get(self, path):
+        """Indexed entry of a remote path, or None"""
+        with self._lock:
+            return self.files.get(path)
+
+    def latest(self, since=None, limit=5):
+        """Most recently modified files, newest first"""
+        with self._lock:
+            files = [f for f in self.files.values() if since is None or f.mtime >= since]
+            return sorted(files, key=lambda f: f.mtime, reverse=True)[:limit]
+
+    def high_water_mark(self):
+        """Newest mtime in the index (remote clock), useful as a 'since' marker"""
+        with self._lock:
+            return max((f.mtime for f in self.files.values()), default=None)
+
+
+class InvoiceIndexRegistry:
+    """One RemoteInvoiceIndex per (environment, output_path)"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, environment, output_path):
+        key = (environment, output_path)
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = RemoteInvoiceIndex(output_path)
+            return self._indexes[key]
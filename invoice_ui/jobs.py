@@ -0,0 +1,418 @@
+"""
+Background job management for long-running invoice generation runs
+Jobs are executed on a bounded worker pool and tracked in memory so the
+web UI can poll for progress instead of holding the HTTP request open
+"""
+
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED)
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue has reached its pending limit"""
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused for a different run"""
+
+
+class Job:
+    """State of a single background invoice run"""
+
+    def __init__(self, params=None, log_file=None, max_output_lines=5000):
+        self.id = uuid.uuid4().hex
+        self.params = params or {}
+        self.log_file = log_file
+        self.state = JOB_QUEUED
+        self.progress = 'Queued'
+        self.exit_code = None
+        self.script_values = {}
+        self.result = None
+        self.status_code = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._output = deque(maxlen=max_output_lines)
+        self._line_count = 0
+        self._partial = ''
+
+    def append_output(self, text):
+        """Add streamed script output, split into complete lines"""
+        with self._cond:
+            lines = (self._partial + text.replace('\r', '')).split('\n')
+            self._partial = lines.pop()
+            self._output.extend(lines)
+            self._line_count += len(lines)
+            if lines:
+                self._cond.notify_all()
+
+    def read_output(self, start, timeout=15):
+        """
+        Return (next_index, lines, finished) for output lines from index start
+        Blocks up to timeout seconds when no new lines are available yet.
+        Lines that have already rotated out of the buffer are skipped.
+        """
+        with self._cond:
+            if self._line_count <= start and self.state not in FINISHED_STATES:
+                self._cond.wait(timeout)
+            first = self._line_count - len(self._output)
+            start = max(start, first)
+            lines = list(islice(self._output, start - first, None))
+            return self._line_count, lines, self.state in FINISHED_STATES
+
+    def output_tail(self, count=20):
+        """Last count lines of output"""
+        with self._cond:
+            return list(self._output)[-count:]
+
+    def set_progress(self, text):
+        """Update the human readable progress message"""
+        with self._lock:
+            self.progress = text
+
+    def set_exit_code(self, exit_code):
+        """Record the remote script exit code"""
+        with self._lock:
+            self.exit_code = exit_code
+
+    def start(self):
+        """Mark the job as running"""
+        with self._lock:
+            self.state = JOB_RUNNING
+            self.started = time.time()
+            self.progress = 'Starting'
+
+    def complete(self, payload, status_code):
+        """Store the result, mark the job finished and wake anyone waiting on it"""
+        with self._cond:
+            if self._partial:
+                self._output.append(self._partial)
+                self._line_count += 1
+                self._partial = ''
+            self.result = payload
+            self.status_code = status_code
+            self.state = JOB_SUCCEEDED if payload.get('success') else JOB_FAILED
+            self.progress = 'Completed' if self.state == JOB_SUCCEEDED else 'Failed'
+            self.finished = time.time()
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until the job has finished, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.state not in FINISHED_STATES:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def update_script_values(self, values):
+        """Record values parsed from the script output (server_id, external_id, ...)"""
+        with self._lock:
+            self.script_values.update(values)
+
+    def to_dict(self, include_result=True):
+        """Serialize job state for the status endpoint"""
+        with self._lock:
+            data = {
+                'job_id': self.id,
+                'state': self.state,
+                'progress': self.progress,
+                'exit_code': self.exit_code,
+                'script_values': dict(self.script_values),
+                'log_file': self.log_file,
+                'params': self.params,
+                'created': _format_time(self.created),
+                'started': _format_time(self.started),
+                'finished': _format_time(self.finished),
+                'duration': _duration(self.started, self.finished),
+                'output_lines': self._line_count,
+            }
+            if include_result and self.state in FINISHED_STATES:
+                data['result'] = self.result
+            return data
+
+
+class JobManager:
+    """Run jobs on a bounded thread pool and keep their state for polling"""
+
+    def __init__(self, max_workers=4, max_pending=50, retention_seconds=3600, max_output_lines=5000):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self.max_output_lines = max_output_lines
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='invoice-job')
+        self._jobs = {}
+        self._batches = {}
+        self._lock = threading.Lock()
+        # Batch rows running per environment, shared by all batches
+        self._env_active = {}
+        self._batch_lock = threading.RLock()
+
+    def submit(self, func, *args, params=None, log_file=None, on_done=None, **kwargs):
+        """
+        Queue func(*args, job=job, **kwargs) for background execution
+        func must return a (payload, status_code) tuple
+        on_done(job) is called after the job has finished
+        """
+        job = Job(params=params, log_file=log_file, max_output_lines=self.max_output_lines)
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if j.state not in FINISHED_STATES)
+            if pending >= self.max_workers + self.max_pending:
+                raise JobQueueFull(f"Too many invoice runs in progress ({pending}). Please retry later.")
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, args, kwargs, on_done)
+        return job
+
+    def track(self, job):
+        """Register a job that runs outside the pool (e.g. in a request thread) for status polling"""
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def submit_batch(self, rows, func, limit_for):
+        """
+        Start a batch that runs func(row, job=job) for every row
+        At most limit_for(row['environment']) rows run concurrently per environment.
+        Rows that already carry an 'error' are reported as failed without running.
+        Rows refused because the job queue is full stay queued and are submitted
+        again when a job finishes or the batch is polled.
+        """
+        batch = BatchRun(self, rows, func, limit_for)
+        with self._lock:
+            self._batches[batch.id] = batch
+        self.dispatch_batches()
+        return batch
+
+    def dispatch_batches(self):
+        """Start queued batch rows, oldest batch first, while environments have free slots"""
+        with self._lock:
+            batches = sorted((b for b in self._batches.values() if not b.finished), key=lambda b: b.created)
+        with self._batch_lock:
+            for batch in batches:
+                batch.dispatch(self._env_active)
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch and not batch.finished:
+            self.dispatch_batches()
+        return batch
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_count(self):
+        """Jobs queued or running, including tracked ones"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.state not in FINISHED_STATES)
+
+    def list_jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created, reverse=True)
+
+    def _run(self, job, func, args, kwargs, on_done=None):
+        job.start()
+        try:
+            payload, status_code = func(*args, job=job, **kwargs)
+        except Exception as e:
+            payload, status_code = {'success': False, 'message': str(e), 'log_file': job.log_file}, 500
+        job.complete(payload, status_code)
+        if on_done:
+            on_done(job)
+        # A slot is free now, for batch rows that found the queue full
+        self.dispatch_batches()
+
+    def _prune(self):
+        """Drop finished jobs older than the retention period (caller holds the lock)"""
+        cutoff = time.time() - self.retention_seconds
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        expired = [batch_id for batch_id, batch in self._batches.items()
+                   if batch.finished and batch.finished < cutoff]
+        for batch_id in expired:
+            del self._batches[batch_id]
+
+
+class RunRegistry:
+    """
+    Coalesces identical in-flight runs and remembers idempotency keys
+    Runs are keyed by (environment, invoice_type, account_no). While a run is in
+    flight, later requests for the same key attach to its job instead of starting
+    another. An idempotency key maps to the job it first started or joined, and is
+    kept for idempotency_ttl seconds after that job finishes. At most max_keys keys
+    are kept; when full, the oldest key of a finished job is dropped first, then the
+    oldest key (its run, if still in flight, is still coalesced by run key).
+    """
+
+    def __init__(self, idempotency_ttl=600, max_keys=10000):
+        self.idempotency_ttl = idempotency_ttl
+        self.max_keys = max_keys
+        self._in_flight = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def claim(self, run_key, create_job, idempotency_key=None):
+        """
+        Return (job, attached) for a run request
+        create_job() is called, under the registry lock, only when no matching job
+        exists; attached is True when an existing job was returned instead.
+        """
+        with self._lock:
+            self._prune()
+            if idempotency_key and idempotency_key in self._keys:
+                entry = self._keys[idempotency_key]
+                if entry['run_key'] != run_key:
+                    raise IdempotencyConflict(f"Idempotency key '{idempotency_key}' was used for a different request")
+                return entry['job'], True
+
+            job = self._in_flight.get(run_key)
+            attached = job is not None and job.state not in FINISHED_STATES
+            if not attached:
+                job = create_job()
+                self._in_flight[run_key] = job
+            if idempotency_key:
+                while len(self._keys) >= self.max_keys:
+                    self._evict()
+                self._keys[idempotency_key] = {'run_key': run_key, 'job': job}
+            return job, attached
+
+    def release(self, run_key, job):
+        """Forget an in-flight run once it has finished"""
+        with self._lock:
+            if self._in_flight.get(run_key) is job:
+                del self._in_flight[run_key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def _prune(self):
+        cutoff = time.time() - self.idempotency_ttl
+        expired = [key for key, entry in self._keys.items()
+                   if entry['job'].finished and entry['job'].finished < cutoff]
+        for key in expired:
+            del self._keys[key]
+
+    def _evict(self):
+        """Drop one idempotency key to make room, keys of finished jobs first (caller holds the lock)"""
+        # Keys are in insertion order, so the first match is the oldest
+        key = next((key for key, entry in self._keys.items() if entry['job'].finished), None)
+        del self._keys[key if key is not None else next(iter(self._keys))]
+
+
+class BatchRun:
+    """A set of invoice rows fanned out over the job pool with per-environment limits"""
+
+    def __init__(self, manager, rows, func, limit_for):
+        self.id = uuid.uuid4().hex
+        self.manager = manager
+        self.func = func
+        self.limit_for = limit_for
+        self.created = time.time()
+        self.finished = None
+        self.rows = []
+        for index, row in enumerate(rows):
+            entry = {'row': index + 1, 'params': row, 'job': None,
+                     'state': JOB_QUEUED, 'message': row.get('error')}
+            if entry['message']:
+                entry['state'] = JOB_FAILED
+            self.rows.append(entry)
+        self._lock = manager._batch_lock
+
+    def dispatch(self, env_active):
+        """Submit queued rows while their environment has free slots"""
+        with self._lock:
+            for entry in self.rows:
+                if entry['state'] != JOB_QUEUED or entry['job'] is not None:
+                    continue
+                env = entry['params'].get('environment')
+                if env_active.get(env, 0) >= self.limit_for(env):
+                    continue
+                try:
+                    entry['job'] = self.manager.submit(
+                        self.func, entry['params'], params=entry['params'],
+                        on_done=lambda job, entry=entry: self._row_done(entry, job)
+                    )
+                except JobQueueFull:
+                    # Stays queued; the next dispatch submits it again
+                    entry['message'] = "Waiting for a free slot in the job queue"
+                    break
+                entry['message'] = None
+                env_active[env] = env_active.get(env, 0) + 1
+            self._check_finished()
+
+    def _row_done(self, entry, job):
+        with self._lock:
+            entry['state'] = job.state
+            entry['message'] = (job.result or {}).get('message')
+            env = entry['params'].get('environment')
+            self.manager._env_active[env] -= 1
+            self._check_finished()
+
+    def _check_finished(self):
+        if self.finished is None and all(e['state'] in FINISHED_STATES for e in self.rows):
+            self.finished = time.time()
+
+    def to_dict(self):
+        """Per-row results and aggregate summary"""
+        with self._lock:
+            rows = []
+            summary = {'total': len(self.rows), JOB_QUEUED: 0, JOB_RUNNING: 0,
+                       JOB_SUCCEEDED: 0, JOB_FAILED: 0}
+            for entry in self.rows:
+                job = entry['job']
+                state = job.state if job and entry['state'] not in FINISHED_STATES else entry['state']
+                summary[state] += 1
+                rows.append({
+                    'row': entry['row'],
+                    'environment': entry['params'].get('environment'),
+                    'invoice_type': entry['params'].get('invoice_type'),
+                    'account_no': entry['params'].get('account_no'),
+                    'state': state,
+                    'progress': job.progress if job else None,
+                    'exit_code': job.exit_code if job else None,
+                    'log_file': job.log_file if job else None,
+                    'job_id': job.id if job else None,
+                    'message': entry['message'],
+                    'duration': _duration(job.started, job.finished) if job else None,
+                })
+            return {
+                'batch_id': self.id,
+                'finished': self.finished is not None,
+                'duration': _duration(self.created, self.finished),
+                'summary': summary,
+                'rows': rows,
+            }
+
+
+def _format_time(ts):
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _duration(started, finished):
+    if started is None:
+        return None
+    return round((finished or time.time()) - started, 1)
@@ -0,0 +1,98 @@
+"""
+Byte-range access to run log files
+Reads only the requested part of a log (a page, the last N lines or new
+data after an offset) and searches logs in chunks instead of loading them whole
+"""
+
+import os
+
+TAIL_BLOCK_SIZE = 8192
+
+
+def read_page(path, offset=0, limit=262144):
+    """
+    Read up to limit bytes starting at offset, ending on a line boundary
+    Returns (text, next_offset, file_size)
+    """
+    size = os.path.getsize(path)
+    offset = max(0, min(offset, size))
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(limit)
+    if offset + len(data) < size:
+        cut = data.rfind(b'\n')
+        if cut >= 0:
+            data = data[:cut + 1]
+    return data.decode('utf-8', errors='replace'), offset + len(data), size
+
+
+def page_start_before(path, offset, limit=262144):
+    """Offset of the page that ends at offset, aligned to the start of a line"""
+    start = max(0, offset - limit)
+    if start == 0:
+        return 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(offset - start)
+    cut = data.find(b'\n')
+    return start + cut + 1 if cut >= 0 else start
+
+
+def read_tail(path, lines=200):
+    """
+    Read the last lines of a file by scanning backwards in blocks
+    Returns (text, start_offset, file_size)
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        position = size
+        data = b''
+        # One extra newline so the first returned line is complete
+        while position > 0 and data.count(b'\n') <= lines:
+            step = min(TAIL_BLOCK_SIZE, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    parts = data.split(b'\n')
+    if data.endswith(b'\n'):
+        parts.pop()
+    keep = parts[-lines:] if lines else []
+    text = b'\n'.join(keep)
+    if keep and data.endswith(b'\n'):
+        text += b'\n'
+    return text.decode('utf-8', errors='replace'), size - len(text), size
+
+
+def read_new(path, offset, limit=65536):
+    """
+    Read complete lines appended after offset
+    Returns (text, next_offset); a trailing partial line is left for the next call
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(limit)
+    cut = data.rfind(b'\n')
+    if cut < 0:
+        return '', offset
+    data = data[:cut + 1]
+    return data.decode('utf-8', errors='replace'), offset + len(data)
+
+
+def search_log(path, query, max_matches=500, ignore_case=True):
+    """
+    Find lines containing query, reading the file line by line
+    Returns (matches, truncated) where matches are (line_number, offset, line)
+    """
+    needle = query.lower() if ignore_case else query
+    matches = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for line_number, raw in enumerate(f, 1):
+            line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+            haystack = line.lower() if ignore_case else line
+            if needle in haystack:
+                if len(matches) >= max_matches:
+                    return matches, True
+                matches.append((line_number, offset, line))
+            offset += len(raw)
+    return matches, False
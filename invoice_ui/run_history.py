@@ -0,0 +1,202 @@
+"""
+SQLite index of invoice generation runs
+Every run is recorded with its parameters, outcome and log file name so the
+/logs page can filter and paginate without scanning the log directory
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    log_file TEXT UNIQUE NOT NULL,
+    environment TEXT,
+    invoice_type TEXT,
+    account_no TEXT,
+    external_id TEXT,
+    status TEXT NOT NULL,
+    exit_code INTEGER,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    duration REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_started ON runs (started_at);
+CREATE INDEX IF NOT EXISTS idx_runs_env_started ON runs (environment, started_at);
+CREATE INDEX IF NOT EXISTS idx_runs_status_started ON runs (status, started_at);
+CREATE INDEX IF NOT EXISTS idx_runs_account ON runs (account_no);
+CREATE INDEX IF NOT EXISTS idx_runs_external_id ON runs (external_id);
+CREATE TABLE IF NOT EXISTS run_accounts (
+    log_file TEXT NOT NULL,
+    account_no TEXT NOT NULL,
+    status TEXT NOT NULL,
+    external_id TEXT,
+    message TEXT,
+    PRIMARY KEY (log_file, account_no)
+);
+CREATE INDEX IF NOT EXISTS idx_run_accounts_account ON run_accounts (account_no);
+"""
+
+FILTER_COLUMNS = ('environment', 'invoice_type', 'account_no', 'external_id', 'status')
+
+STATUS_RUNNING = 'running'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+STATUS_REJECTED = 'rejected'
+STATUS_COALESCED = 'coalesced'
+STATUS_UNKNOWN = 'unknown'
+
+
+class RunHistory:
+    """Thread-safe access to the run history database"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        is_new = not os.path.exists(db_path)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+        self.is_new = is_new
+
+    def start_run(self, log_file, environment, invoice_type, account_no, accounts=None):
+        """
+        Record a run that is about to execute
+        Batch runs pass accounts instead of account_no; each account gets its own
+        run_accounts row, so filtering by account finds the batch.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO runs (log_file, environment, invoice_type, account_no, status, started_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (log_file, environment, invoice_type, account_no, STATUS_RUNNING, time.time())
+            )
+            self._add_accounts(log_file, accounts, STATUS_RUNNING)
+
+    def finish_accounts(self, log_file, outcomes):
+        """Record the per-account outcomes of a batch run"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE run_accounts SET status = ?, external_id = ?, message = ? WHERE log_file = ? AND account_no = ?",
+                [(o['status'], o.get('external_id'), o.get('message'), log_file, o['account_no']) for o in outcomes]
+            )
+
+    def finish_run(self, log_file, status, exit_code=None, duration=None, external_id=None, message=None):
+        """Record the outcome of a run"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE runs SET status = ?, exit_code = ?, duration = ?, external_id = COALESCE(?, external_id), "
+                "message = ?, finished_at = ? WHERE log_file = ?",
+                (status, exit_code, duration, external_id, message, time.time(), log_file)
+            )
+
+    def record(self, log_file, environment, invoice_type, account_no, status, message=None, accounts=None):
+        """Record a run that finished without executing (e.g. rejected by validation)"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO runs (log_file, environment, invoice_type, account_no, status, "
+                "started_at, finished_at, duration, message) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                (log_file, environment, invoice_type, account_no, status, now, now, message)
+            )
+            self._add_accounts(log_file, accounts, status, message)
+
+    def _add_accounts(self, log_file, accounts, status, message=None):
+        """Per-account rows of a batch run; the caller holds the lock and the transaction"""
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO run_accounts (log_file, account_no, status, message) VALUES (?, ?, ?, ?)",
+            [(log_file, account_no, status, message) for account_no in dict.fromkeys(accounts or [])]
+        )
+
+    def query(self, filters=None, page=1, per_page=25):
+        """
+        Return (rows, total) for runs matching filters, newest first
+        filters may contain FILTER_COLUMNS plus date_from/date_to (epoch seconds)
+        """
+        clauses, params = [], []
+        for column in FILTER_COLUMNS:
+            value = (filters or {}).get(column)
+            if value and column in ('account_no', 'external_id'):
+                # Batch runs keep their accounts in run_accounts
+                clauses.append(f"({column} = ? OR log_file IN (SELECT log_file FROM run_accounts WHERE {column} = ?))")
+                params.extend([value, value])
+            elif value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if (filters or {}).get('date_from') is not None:
+            clauses.append("started_at >= ?")
+            params.append(filters['date_from'])
+        if (filters or {}).get('date_to') is not None:
+            clauses.append("started_at < ?")
+            params.append(filters['date_to'])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM runs {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT *, (SELECT COUNT(*) FROM run_accounts a WHERE a.log_file = runs.log_file) AS accounts "
+                f"FROM runs {where} ORDER BY started_at DESC LIMIT ? OFFSET ?",
+                params + [per_page, (max(page, 1) - 1) * per_page]
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def distinct(self, column):
+        """Distinct values of a filter column, for filter drop-downs"""
+        if column not in FILTER_COLUMNS:
+            raise ValueError(column)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT {column} FROM runs WHERE {column} IS NOT NULL ORDER BY {column}"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def backfill(self, log_dir):
+        """Import existing invoice_*.log files that are not in the database yet"""
+        with self._lock:
+            known = {row[0] for row in self._conn.execute("SELECT log_file FROM runs")}
+        imported = 0
+        for entry in os.scandir(log_dir):
+            if not (entry.name.startswith('invoice_') and entry.name.endswith('.log')) or entry.name in known:
+                continue
+            details = parse_log_summary(entry.path)
+            mtime = entry.stat().st_mtime
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO runs (log_file, environment, invoice_type, account_no, status, "
+                    "started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (entry.name, details.get('environment'), details.get('invoice_type'),
+                     details.get('account_no'), details.get('status', STATUS_UNKNOWN), mtime, mtime)
+                )
+            imported += 1
+        return imported
+
+
+LOG_FIELD_PATTERNS = {
+    'environment': re.compile(r' - INFO -\s+Environment: (\S+)'),
+    'invoice_type': re.compile(r' - INFO -\s+Invoice Type: (\S+)'),
+    'account_no': re.compile(r' - INFO -\s+Customer ID: (\S+)'),
+}
+
+
+def parse_log_summary(path, head_bytes=4096, tail_bytes=4096):
+    """Read run parameters from the head of a log and its outcome from the tail"""
+    details = {}
+    with open(path, 'rb') as f:
+        head = f.read(head_bytes).decode('utf-8', errors='replace')
+        f.seek(max(0, os.path.getsize(path) - tail_bytes))
+        tail = f.read().decode('utf-8', errors='replace')
+    for field, pattern in LOG_FIELD_PATTERNS.items():
+        match = pattern.search(head)
+        if match:
+            details[field] = match.group(1)
+    if 'INVOICE GENERATION COMPLETED SUCCESSFULLY' in tail:
+        details['status'] = STATUS_SUCCEEDED
+    elif 'INVOICE GENERATION FAILED' in tail or 'Validation failed' in head:
+        details['status'] = STATUS_FAILED
+    return details
@@ -0,0 +1,187 @@
+"""
+Per-run log files written by one background thread
+Each invoice run gets its own logger and invoice_YYYYMMDDHHMMSS_XXXXX.log file.
+Records are put on a bounded queue and written by a QueueListener thread, so
+request threads never wait on disk. Run loggers are not registered with the
+logging module, and their file handlers are closed when the run is closed.
+"""
+
+import logging
+import os
+import queue
+import re
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+SEQUENCE_PATTERN = re.compile(r'^invoice_(\d{8})\d{6}_(\d{5})\.log$')
+
+
+class RunLogQueueHandler(QueueHandler):
+    """Queue handler that tags records with the run's log file"""
+
+    def __init__(self, log_queue, log_path, put_timeout, on_drop):
+        super().__init__(log_queue)
+        self.log_path = log_path
+        self.put_timeout = put_timeout
+        self.on_drop = on_drop
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.run_log_path = self.log_path
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self.on_drop()
+
+
+class RunFileRouter(logging.Handler):
+    """
+    Writes each record to the file of the run it belongs to
+    Only used from the listener thread; files are opened on the first record
+    of a run and closed when the run's close marker arrives.
+    """
+
+    def __init__(self, formatter):
+        super().__init__(logging.DEBUG)
+        self.setFormatter(formatter)
+        self._files = {}
+
+    def handle(self, record):
+        log_path = getattr(record, 'run_log_path', None)
+        if log_path is None:
+            return False
+        if getattr(record, 'run_log_close', False):
+            handler = self._files.pop(log_path, None)
+            if handler:
+                handler.close()
+            return True
+        return super().handle(record)
+
+    def emit(self, record):
+        handler = self._files.get(record.run_log_path)
+        if handler is None:
+            handler = logging.FileHandler(record.run_log_path, encoding='utf-8')
+            handler.setFormatter(self.formatter)
+            self._files[record.run_log_path] = handler
+        handler.emit(record)
+
+    def close(self):
+        for handler in self._files.values():
+            handler.close()
+        self._files.clear()
+        super().close()
+
+
+class ConsoleFilter(logging.Filter):
+    """Keep close markers off the console"""
+
+    def filter(self, record):
+        return not getattr(record, 'run_log_close', False)
+
+
+class RunLogManager:
+    """Creates run loggers, numbers their files and owns the writer thread"""
+
+    def __init__(self, log_dir, queue_size=10000, put_timeout=1.0, console_level=logging.INFO):
+        self.log_dir = log_dir
+        self.put_timeout = put_timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._seq_lock = threading.Lock()
+        self._seq_day = None
+        self._seq_next = 1
+        self._active = {}
+        self._active_lock = threading.Lock()
+
+        formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+        self._router = RunFileRouter(formatter)
+        console = logging.StreamHandler()
+        console.setLevel(console_level)
+        console.setFormatter(formatter)
+        console.addFilter(ConsoleFilter())
+        self._listener = QueueListener(self._queue, self._router, console, respect_handler_level=True)
+        self._listener.start()
+
+    def next_sequence(self, day):
+        """Next sequence number for a day, the log directory is only scanned when the day changes"""
+        with self._seq_lock:
+            if day != self._seq_day:
+                self._seq_day = day
+                self._seq_next = self._scan_sequence(day) + 1
+            sequence = self._seq_next
+            self._seq_next += 1
+            return sequence
+
+    def _scan_sequence(self, day):
+        highest = 0
+        if os.path.isdir(self.log_dir):
+            for entry in os.scandir(self.log_dir):
+                match = SEQUENCE_PATTERN.match(entry.name)
+                if match and match.group(1) == day:
+                    highest = max(highest, int(match.group(2)))
+        return highest
+
+    def claim_log_file(self):
+        """
+        Create the file of a new run, returns (log_filename, log_path)
+        Files are created exclusively; if another process sharing the log directory
+        took the name first, the sequence is rescanned from disk and the next one tried.
+        """
+        while True:
+            now = datetime.now()
+            day = now.strftime('%Y%m%d')
+            sequence = self.next_sequence(day)
+            log_filename = f"invoice_{now.strftime('%Y%m%d%H%M%S')}_{sequence:05d}.log"
+            log_path = os.path.join(self.log_dir, log_filename)
+            try:
+                with open(log_path, 'x', encoding='utf-8'):
+                    return log_filename, log_path
+            except FileExistsError:
+                with self._seq_lock:
+                    self._seq_next = max(self._seq_next, self._scan_sequence(day) + 1)
+
+    def open_run(self):
+        """Create the logger for a new run, returns (logger, log_path)"""
+        log_filename, log_path = self.claim_log_file()
+
+        # Not created through logging.getLogger, so nothing keeps it alive after the run
+        logger = logging.Logger(log_filename, logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(RunLogQueueHandler(self._queue, log_path, self.put_timeout, self._record_drop))
+        with self._active_lock:
+            self._active[log_path] = logger
+        return logger, log_path
+
+    def close_run(self, logger):
+        """Detach the run's handler and close its file once queued records are written"""
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            if isinstance(handler, RunLogQueueHandler):
+                with self._active_lock:
+                    self._active.pop(handler.log_path, None)
+                marker = logging.LogRecord(logger.name, logging.DEBUG, '', 0, '', None, None)
+                marker.run_log_path = handler.log_path
+                marker.run_log_close = True
+                # Close markers must not be dropped or the file would stay open
+                self._queue.put(marker)
+            handler.close()
+
+    def _record_drop(self):
+        with self._active_lock:
+            self.dropped += 1
+
+    def stats(self):
+        with self._active_lock:
+            active = len(self._active)
+        return {'active_runs': active, 'queued_records': self._queue.qsize(), 'dropped_records': self.dropped}
+
+    def stop(self):
+        """Write everything still queued and close all files"""
+        self._listener.stop()
+        self._router.close()
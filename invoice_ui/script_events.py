@@ -0,0 +1,142 @@
+"""
+Incremental parser for invoice script output
+Definitive.sh/Proforma.sh write progress through echolog, which prefixes every
+line with a "YYYY-MM-DD HH:MM:SS " timestamp. The parser consumes output chunks
+as they arrive, matches only timestamped lines against precompiled patterns and
+emits typed events, so values such as server_id or external_id are known as
+soon as the script prints them, without scanning the full output afterwards.
+"""
+
+import re
+from datetime import datetime
+
+ECHOLOG_LINE = re.compile(r'^(?P<ts>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (?P<body>.*)$')
+
+# (event type, pattern matched against the text after the timestamp)
+EVENT_PATTERNS = [
+    ('server_id', re.compile(r'^server_id=(?P<server_id>\d+)$')),
+    ('account_types', re.compile(r'^Account has types: (?P<account_types>.*)$')),
+    ('account_type', re.compile(r'^Account type: (?P<account_type>\S+)')),
+    ('statement_date', re.compile(r'^statement_date=(?P<statement_date>\d{8})$')),
+    ('next_sin_seq', re.compile(r'^Next SIN sequence: (?P<next_sin_seq>\d+)$')),
+    ('bill_ref', re.compile(r'^Fetched BILL_REF_NO=(?P<bill_ref_no>[^,]*), BILL_REF_RESETS=(?P<bill_ref_resets>[^,]*)')),
+    ('full_sin_seq', re.compile(r'^Insert completed for FULL_SIN_SEQ=(?P<full_sin_seq>\d+) and GROUP_ID=(?P<group_id>\d+)')),
+    ('external_id', re.compile(r"^Validating entry in bb_fatture_incassi for external_id='(?P<external_id>[^']+)'")),
+    ('external_id', re.compile(r"^external_id='?(?P<external_id>[A-Za-z0-9_]+)'?$")),
+    ('batch_started', re.compile(r'^Executing (?P<module>ESTUNI|MERGER) STARTER')),
+    ('batch_waiting', re.compile(r"^(?P<module>ESTUNI|MERGER) STARTER still running or unknown status \('(?P<status>[^']*)'\)")),
+    ('batch_finished', re.compile(r'^(?P<module>ESTUNI|MERGER) STARTER completed successfully')),
+    ('batch_failed', re.compile(r'^(?P<module>ESTUNI|MERGER) STARTER failed')),
+    ('error', re.compile(r'^ERROR:\s*(?P<message>.*)$')),
+]
+
+# Values kept in ScriptOutputParser.values as they are seen
+VALUE_FIELDS = ('server_id', 'account_types', 'account_type', 'statement_date', 'next_sin_seq',
+                'bill_ref_no', 'bill_ref_resets', 'full_sin_seq', 'group_id', 'external_id')
+
+
+class ScriptEvent:
+    """A typed event parsed from one echolog line"""
+
+    __slots__ = ('type', 'timestamp', 'line_no', 'data')
+
+    def __init__(self, event_type, timestamp, line_no, data):
+        self.type = event_type
+        self.timestamp = timestamp
+        self.line_no = line_no
+        self.data = data
+
+    def to_dict(self):
+        return {'type': self.type, 'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'line_no': self.line_no, **self.data}
+
+
+class ScriptOutputParser:
+    """
+    Feed output chunks with feed(); complete lines are parsed immediately
+    on_event(event) is called for every event. values holds the latest value of
+    each VALUE_FIELDS entry, and batch modules (ESTUNI, MERGER) get a duration
+    in seconds on their batch_finished/batch_failed events.
+    """
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.events = []
+        self.values = {}
+        self.line_count = 0
+        self._partial = ''
+        self._batch_started = {}
+
+    @property
+    def external_id(self):
+        return self.values.get('external_id')
+
+    def feed(self, text):
+        """Parse complete lines in text, returns the events they produced"""
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        new_events = []
+        for line in lines:
+            self._parse_line(line, new_events)
+        return new_events
+
+    def finish(self):
+        """Parse a final line that was not newline terminated"""
+        new_events = []
+        if self._partial:
+            self._parse_line(self._partial, new_events)
+            self._partial = ''
+        return new_events
+
+    def _parse_line(self, line, new_events):
+        self.line_count += 1
+        # Cheap check before the regex: echolog lines start with the year
+        if len(line) < 20 or not line[:4].isdigit():
+            return
+        match = ECHOLOG_LINE.match(line.rstrip('\r'))
+        if not match:
+            return
+        body = match.group('body')
+        for event_type, pattern in EVENT_PATTERNS:
+            found = pattern.match(body)
+            if found:
+                timestamp = datetime.strptime(match.group('ts'), '%Y-%m-%d %H:%M:%S')
+                event = ScriptEvent(event_type, timestamp, self.line_count, found.groupdict())
+                self._track(event)
+                self.events.append(event)
+                new_events.append(event)
+                if self.on_event:
+                    self.on_event(event)
+                return
+
+    def _track(self, event):
+        for field in VALUE_FIELDS:
+            if field in event.data:
+                self.values[field] = event.data[field]
+        module = event.data.get('module')
+        if event.type == 'batch_started':
+            self._batch_started[module] = event.timestamp
+        elif event.type in ('batch_finished', 'batch_failed') and module in self._batch_started:
+            event.data['duration'] = (event.timestamp - self._batch_started.pop(module)).total_seconds()
+
+
+def describe_event(event):
+    """Short progress text for an event, or None when it is not worth showing"""
+    data = event.data
+    if event.type == 'server_id':
+        return f"Customer server {data['server_id']}"
+    if event.type == 'statement_date':
+        return f"Statement date {data['statement_date']}"
+    if event.type == 'full_sin_seq':
+        return f"SIN sequence {data['full_sin_seq']} allocated"
+    if event.type == 'batch_started':
+        return f"{data['module']} started"
+    if event.type == 'batch_waiting':
+        return f"Waiting for {data['module']} ({data['status'] or 'no status'})"
+    if event.type == 'batch_finished':
+        return f"{data['module']} completed"
+    if event.type == 'batch_failed':
+        return f"{data['module']} failed"
+    if event.type == 'external_id':
+        return f"External ID {data['external_id']}"
+    return None
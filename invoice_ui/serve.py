@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Production entry point for the Invoice Generation Web UI
+Serves app.py with waitress instead of the Werkzeug development server.
+Requests are handled by a pool of threads in one process: jobs, in-flight runs,
+SSE streams, log sequence numbers and the SSH/database pools all live in that
+process, so a lock file makes sure only one server runs per install directory.
+Waitress never times out a request the app is still working on; long runs are
+bounded by output.script_timeout, coalescing.wait_timeout and the pipeline
+timeouts, and channel_timeout only closes idle keep-alive connections.
+
+Examples:
+  python serve.py
+  python serve.py --port 8080 --threads 32
+"""
+
+import argparse
+import os
+import sys
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+LOCK_FILE = os.path.join(LOG_DIR, 'server.lock')
+
+
+def acquire_instance_lock(path):
+    """Open and lock the lock file, returns the open file or None when another server holds it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle = open(path, 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+def server_options(settings, args):
+    """waitress options from the 'server' settings, overridden by command line arguments"""
+    return {
+        'host': args.host or settings['host'],
+        'port': args.port or settings['port'],
+        'threads': args.threads or settings['threads'],
+        'connection_limit': settings['connection_limit'],
+        'channel_timeout': settings['channel_timeout'],
+        # select() is limited to 512 sockets on Windows; every SSE follower holds one
+        'asyncore_use_poll': True,
+        'ident': 'invoice-ui',
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the Invoice Generation Web UI with waitress')
+    parser.add_argument('--host', help="listen address (default: server.host in config.json)")
+    parser.add_argument('--port', type=int, help="listen port (default: server.port in config.json)")
+    parser.add_argument('--threads', type=int, help="request threads (default: server.threads in config.json)")
+    args = parser.parse_args(argv)
+
+    try:
+        from waitress import serve
+    except ImportError:
+        print("ERROR: waitress is not installed. Run: pip install -r requirements.txt")
+        return 1
+
+    lock = acquire_instance_lock(LOCK_FILE)
+    if lock is None:
+        print(f"ERROR: Another server is already running from this directory ({LOCK_FILE} is locked)")
+        return 1
+
+    # Imported after the lock, since importing the app starts its background threads
+    import app as webapp
+    webapp.load_config()
+    settings = webapp.APP_SETTINGS['server']
+    options = server_options(settings, args)
+
+    print("\n" + "="*60)
+    print("Multi-Environment Invoice Generator")
+    print("="*60)
+    print(f"Configuration file: {webapp.CONFIG_FILE}")
+    print(f"Log directory: {webapp.LOG_DIR}")
+    print(f"Request threads: {options['threads']}, invoice job workers: {webapp.APP_SETTINGS['jobs']['max_workers']}")
+    print(f"\nServing on http://{options['host']}:{options['port']}")
+    print("Press Ctrl+C to stop the server")
+    print("="*60 + "\n")
+
+    try:
+        serve(webapp.app, **options)
+    finally:
+        webapp.shutdown_services(settings['drain_timeout'])
+        lock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Pipelined, resumable SFTP downloads with a local content-addressed cache
+Files are fetched with pipelined readv requests, resumed from a partial
+download when one exists, verified against a remote sha256 checksum and
+stored by content hash. A key derived from (namespace, remote path, size, mtime)
+points at the stored content, so a file that was already fetched is served
+from disk without reading it from the server again
+"""
+
+import hashlib
+import os
+import shlex
+import shutil
+import threading
+import logging
+
+
+class SFTPDownloader:
+    """Download remote files through a local cache"""
+
+    def __init__(self, cache_dir, block_size=32768, max_concurrent_requests=64,
+                 verify_checksum=True, max_cache_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.max_concurrent_requests = max_concurrent_requests
+        self.verify_checksum = verify_checksum
+        self.max_cache_bytes = max_cache_bytes
+        self._blob_dir = os.path.join(cache_dir, 'blobs')
+        self._key_dir = os.path.join(cache_dir, 'keys')
+        self._partial_dir = os.path.join(cache_dir, 'partial')
+        for path in (self._blob_dir, self._key_dir, self._partial_dir):
+            os.makedirs(path, exist_ok=True)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def download(self, get_sftp, remote_path, local_path, namespace='', size=None, mtime=None,
+                 ssh_client=None, logger=None):
+        """
+        Copy remote_path to local_path, returns (success, error)
+        get_sftp() is only called when the server has to be contacted. When size and
+        mtime are already known (e.g. from the invoice index) a cached copy is used
+        without any server round trip. ssh_client is used for checksum verification.
+        """
+        logger = logger or logging.getLogger(__name__)
+        sftp = None
+        if size is None or mtime is None:
+            sftp = get_sftp()
+            attr = sftp.stat(remote_path)
+            size, mtime = attr.st_size, attr.st_mtime
+
+        key = hashlib.sha256(f"{namespace}|{remote_path}|{size}|{int(mtime)}".encode()).hexdigest()
+        with self._key_lock(key):
+            blob = self._cached_blob(key)
+            if blob:
+                logger.info(f"Serving {remote_path} from local cache")
+                shutil.copyfile(blob, local_path)
+                return True, None
+
+            if sftp is None:
+                sftp = get_sftp()
+            partial = os.path.join(self._partial_dir, key + '.part')
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            if offset > size:
+                offset = 0
+            if offset:
+                logger.info(f"Resuming download of {remote_path} at byte {offset} of {size}")
+
+            with sftp.open(remote_path, 'rb') as remote, open(partial, 'ab' if offset else 'wb') as local:
+                chunks = [(pos, min(self.block_size, size - pos))
+                          for pos in range(offset, size, self.block_size)]
+                if chunks:
+                    for data in remote.readv(chunks, self.max_concurrent_requests):
+                        local.write(data)
+
+            local_size = os.path.getsize(partial)
+            if local_size != size:
+                return False, f"Incomplete download of {remote_path}: {local_size} of {size} bytes"
+
+            digest = _file_sha256(partial)
+            if self.verify_checksum and ssh_client is not None:
+                remote_digest = remote_sha256(ssh_client, remote_path)
+                if remote_digest is None:
+                    logger.warning("Remote sha256sum unavailable, verified size only")
+                elif remote_digest != digest:
+                    os.remove(partial)
+                    return False, f"Checksum mismatch for {remote_path}"
+                else:
+                    logger.debug(f"Checksum verified: {digest}")
+
+            blob = os.path.join(self._blob_dir, digest)
+            os.replace(partial, blob)
+            with open(os.path.join(self._key_dir, key), 'w') as f:
+                f.write(digest)
+            shutil.copyfile(blob, local_path)
+
+        self.prune()
+        return True, None
+
+    def _cached_blob(self, key):
+        key_file = os.path.join(self._key_dir, key)
+        if not os.path.exists(key_file):
+            return None
+        with open(key_file) as f:
+            blob = os.path.join(self._blob_dir, f.read().strip())
+        if not os.path.exists(blob):
+            os.remove(key_file)
+            return None
+        os.utime(blob)
+        return blob
+
+    def _key_lock(self, key):
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def prune(self):
+        """Remove least recently used blobs until the cache fits max_cache_bytes"""
+        blobs = [os.path.join(self._blob_dir, name) for name in os.listdir(self._blob_dir)]
+        blobs = [(os.path.getmtime(p), os.path.getsize(p), p) for p in blobs]
+        total = sum(size for _, size, _ in blobs)
+        if total <= self.max_cache_bytes:
+            return
+        removed = set()
+        for _, size, path in sorted(blobs):
+            if total <= self.max_cache_bytes:
+                break
+            os.remove(path)
+            removed.add(os.path.basename(path))
+            total -= size
+        for name in os.listdir(self._key_dir):
+            key_file = os.path.join(self._key_dir, name)
+            with open(key_file) as f:
+                if f.read().strip() in removed:
+                    os.remove(key_file)
+
+
+def remote_sha256(ssh_client, remote_path):
+    """sha256 of a remote file using sha256sum, or None when unavailable"""
+    try:
+        stdin, stdout, stderr = ssh_client.exec_command(f"sha256sum -- {shlex.quote(remote_path)}", timeout=60)
+        output = stdout.read().decode().strip()
+        if stdout.channel.recv_exit_status() != 0 or not output:
+            return None
+        return output.split()[0].lower()
+    except Exception:
+        return None
+
+
+def _file_sha256(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
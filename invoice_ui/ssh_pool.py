@@ -0,0 +1,221 @@
+"""
+Persistent per-environment SSH connection pool
+Keeps authenticated paramiko clients open between invoice runs so each run
+does not repeat the TCP handshake, key exchange and gateway authentication
+"""
+
+import threading
+import time
+import logging
+
+
+class PooledConnection:
+    """An authenticated SSH client owned by the pool"""
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.sftp = None
+        self.created = time.time()
+        self.last_used = self.created
+        self.in_use = False
+
+    def is_alive(self):
+        transport = self.client.get_transport()
+        return bool(transport and transport.is_active() and transport.is_authenticated())
+
+    def ping(self):
+        """Cheap liveness probe that does not open a channel"""
+        try:
+            self.client.get_transport().send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            if self.sftp:
+                self.sftp.close()
+        except Exception:
+            pass
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionPool:
+    """
+    Pool of authenticated SSH connections keyed by environment
+    Connections are checked out exclusively, health checked on checkout,
+    kept alive while idle and evicted after idle_timeout seconds
+    """
+
+    def __init__(self, connect, max_size=2, idle_timeout=300, keepalive_interval=30,
+                 acquire_timeout=30, health_check_after=60):
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self._pools = {}
+        self._by_client = {}
+        self._cond = threading.Condition()
+        self._reaper = None
+        self._stop = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def pool_key(env_key, env_config):
+        """Connections are only reused while the target host and user are unchanged"""
+        return (env_key, env_config.get('host'), env_config.get('port', 22),
+                env_config.get('user', env_config.get('username', '')))
+
+    def acquire(self, env_key, env_config, logger=None, timeout=None):
+        """
+        Borrow a connection for env_key, returns (ssh_client, error)
+        Waits up to timeout seconds (default acquire_timeout) when every slot is in use.
+        """
+        logger = logger or self.logger
+        key = self.pool_key(env_key, env_config)
+        deadline = time.monotonic() + (self.acquire_timeout if timeout is None else timeout)
+        self._start_reaper()
+
+        with self._cond:
+            while True:
+                conns = self._pools.setdefault(key, [])
+                for conn in list(conns):
+                    if conn.in_use:
+                        continue
+                    if self._healthy(conn):
+                        conn.in_use = True
+                        conn.last_used = time.time()
+                        logger.info(f"Reusing pooled SSH connection for {env_key}")
+                        return conn.client, None
+                    logger.info(f"Discarding stale pooled SSH connection for {env_key}")
+                    self._remove(conn)
+                    conn.close()
+
+                if len(conns) < self.max_size:
+                    # Reserve a slot, then connect outside the lock
+                    placeholder = PooledConnection(key, None)
+                    placeholder.in_use = True
+                    conns.append(placeholder)
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, f"SSH connection pool exhausted for {env_key} ({self.max_size} in use)"
+                self._cond.wait(remaining)
+
+        client, error = self._connect(env_config)
+        with self._cond:
+            conns.remove(placeholder)
+            if error:
+                self._cond.notify()
+                return None, error
+            if self.keepalive_interval:
+                client.get_transport().set_keepalive(self.keepalive_interval)
+            conn = PooledConnection(key, client)
+            conn.in_use = True
+            conns.append(conn)
+            self._by_client[id(client)] = conn
+        logger.info(f"Opened new pooled SSH connection for {env_key}")
+        return client, None
+
+    def saturated(self, env_key, env_config):
+        """True when every slot of the environment's pool is checked out"""
+        with self._cond:
+            conns = self._pools.get(self.pool_key(env_key, env_config), [])
+            return len(conns) >= self.max_size and all(conn.in_use for conn in conns)
+
+    def release(self, ssh_client, discard=False):
+        """Return a borrowed client to the pool, closing it if discard or dead"""
+        if ssh_client is None:
+            return
+        with self._cond:
+            conn = self._by_client.get(id(ssh_client))
+            if conn is None:
+                ssh_client.close()
+                return
+            if discard or not conn.is_alive():
+                self._remove(conn)
+                conn.close()
+            else:
+                conn.in_use = False
+                conn.last_used = time.time()
+            self._cond.notify()
+
+    def open_sftp(self, ssh_client):
+        """Return an SFTP session on the client, reused for pooled connections"""
+        with self._cond:
+            conn = self._by_client.get(id(ssh_client))
+        if conn is None:
+            return ssh_client.open_sftp()
+        if conn.sftp is None or conn.sftp.sock.closed:
+            conn.sftp = ssh_client.open_sftp()
+        return conn.sftp
+
+    def close_sftp(self, ssh_client, sftp):
+        """Close an SFTP session unless it belongs to a pooled connection"""
+        with self._cond:
+            pooled = id(ssh_client) in self._by_client
+        if not pooled:
+            sftp.close()
+
+    def stats(self):
+        """Per-environment connection counts"""
+        with self._cond:
+            return {key[0]: {'open': len(conns), 'in_use': sum(1 for c in conns if c.in_use)}
+                    for key, conns in self._pools.items()}
+
+    def close_all(self):
+        self._stop.set()
+        with self._cond:
+            for conns in self._pools.values():
+                for conn in conns:
+                    if conn.client:
+                        conn.close()
+            self._pools.clear()
+            self._by_client.clear()
+
+    def _healthy(self, conn):
+        if not conn.is_alive():
+            return False
+        if time.time() - conn.last_used > self.health_check_after:
+            return conn.ping()
+        return True
+
+    def _remove(self, conn):
+        conns = self._pools.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+        self._by_client.pop(id(conn.client), None)
+
+    def _start_reaper(self):
+        if self._reaper and self._reaper.is_alive():
+            return
+        self._reaper = threading.Thread(target=self._reap_loop, name='ssh-pool-reaper', daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self):
+        interval = max(5, min(self.idle_timeout, 60))
+        while not self._stop.wait(interval):
+            self.evict_idle()
+
+    def evict_idle(self):
+        """Close idle connections past idle_timeout and any that have died"""
+        now = time.time()
+        expired = []
+        with self._cond:
+            for conns in self._pools.values():
+                for conn in list(conns):
+                    if conn.in_use or conn.client is None:
+                        continue
+                    if now - conn.last_used > self.idle_timeout or not conn.is_alive():
+                        self._remove(conn)
+                        expired.append(conn)
+        for conn in expired:
+            self.logger.info(f"Evicting idle SSH connection for {conn.key[0]}")
+            conn.close()
@@ -29,7 +29,7 @@ if %errorlevel% neq 0 (
     exit /b 1
 )
 
-python -c "import flask" >nul 2>&1
+python -c "import flask, waitress" >nul 2>&1
 if %errorlevel% neq 0 (
     echo Installing required packages...
     python -m pip install -r requirements.txt
@@ -41,13 +41,13 @@ if %errorlevel% neq 0 (
 )
 
 echo.
-echo Starting Flask application...
+echo Starting Invoice Generation Web UI...
 echo.
 echo Access the application at: http://localhost:5000
 echo Press Ctrl+C to stop the server
 echo.
 
-REM Start the Flask application
-python app.py
+REM Start the application under the waitress production server
+python serve.py
 
 pause